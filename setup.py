@@ -27,6 +27,7 @@ setup(
     entry_points={
         'tike.PtychoBackend': [
             'cudafft = libtike.cufft.ptycho:PtychoCuFFT',
+            'numpyfft = libtike.cufft.cpu:PtychoNumPy',
         ],
     },
 )
@@ -3,12 +3,13 @@
 // The main function is muloperator which computes multiplication by the probe
 // function or object function so as their adjoints. The operation is performed
 // with respect to indices for threads in the f, g, and prb matricies. Skip
-// computations if probe position is negative.
+// computations if probe position is negative. The object is interpolated once
+// per thread and reused for all Nmodes probe modes.
 
 void __global__ muloperator(float2 *f, float2 *g, float2 *prb,
   const float2 * const scan,
   const int Ntheta, const int Nz, const int N, const int Nscan, const int Nprb,
-  const int ndet, int flg)
+  const int ndet, const int Nmodes, int flg)
 {
   const int tx = blockDim.x * blockIdx.x + threadIdx.x;
   const int ty = blockDim.y * blockIdx.y + threadIdx.y;
@@ -33,7 +34,7 @@ void __global__ muloperator(float2 *f, float2 *g, float2 *prb,
       + (sy + iy) * N
       + tz * Nz * N
     );
-  // coordinates in the g array
+  // coordinates in the g array of the first mode
   int g_index = (
       // shift probe multiplication to min corner of nearplane array so that
       // FFTS are correct when probe and farplane sizes mismatch
@@ -42,14 +43,17 @@ void __global__ muloperator(float2 *f, float2 *g, float2 *prb,
       + ix
       + iy * ndet
       + ty * ndet * ndet
-      + tz * ndet * ndet * Nscan
+      + tz * ndet * ndet * Nscan * Nmodes
     );
-  // coordinates in the probe array
+  // coordinates in the probe array of the first mode
   int prb_index = (
       + ix
       + iy * Nprb
-      + tz * Nprb * Nprb
+      + tz * Nprb * Nprb * Nmodes
     );
+  // distance between consecutive modes in the g and probe arrays
+  const int g_mode = ndet * ndet * Nscan;
+  const int prb_mode = Nprb * Nprb;
 
   const float c = 1.0 / static_cast<float>(ndet); // fft constant
   float2 tmp; //tmp variable
@@ -57,8 +61,16 @@ void __global__ muloperator(float2 *f, float2 *g, float2 *prb,
   // Linear interpolation
   if(flg==0) //adjoint
   {
-    tmp.x = c * (prb[prb_index].x * g[g_index].x + prb[prb_index].y * g[g_index].y);
-    tmp.y = c * (prb[prb_index].x * g[g_index].y - prb[prb_index].y * g[g_index].x);
+    // sum the modes before scattering to reduce the number of atomics
+    tmp.x = 0;
+    tmp.y = 0;
+    for (int k = 0; k < Nmodes; k++)
+    {
+      const float2 p = prb[prb_index + k * prb_mode];
+      const float2 q = g[g_index + k * g_mode];
+      tmp.x += c * (p.x * q.x + p.y * q.y);
+      tmp.y += c * (p.x * q.y - p.y * q.x);
+    }
     atomicAdd(&f[f_index].x,     tmp.x*(1-sxf)*(1-syf));
     atomicAdd(&f[f_index].y,     tmp.y*(1-sxf)*(1-syf));
     atomicAdd(&f[f_index+1].x,   tmp.x*(sxf  )*(1-syf));
@@ -78,8 +90,12 @@ void __global__ muloperator(float2 *f, float2 *g, float2 *prb,
            f[f_index+1].y  *(sxf  )*(1-syf)+
            f[f_index+N].y  *(1-sxf)*(syf  )+
            f[f_index+1+N].y*(sxf  )*(syf  );
-           atomicAdd(&prb[prb_index].x, c * (g[g_index].x * tmp.x + g[g_index].y * tmp.y));
-           atomicAdd(&prb[prb_index].y, c * (g[g_index].y * tmp.x - g[g_index].x * tmp.y));
+    for (int k = 0; k < Nmodes; k++)
+    {
+      const float2 q = g[g_index + k * g_mode];
+      atomicAdd(&prb[prb_index + k * prb_mode].x, c * (q.x * tmp.x + q.y * tmp.y));
+      atomicAdd(&prb[prb_index + k * prb_mode].y, c * (q.y * tmp.x - q.x * tmp.y));
+    }
   }
   else if (flg==2) //forward
   {
@@ -91,7 +107,11 @@ void __global__ muloperator(float2 *f, float2 *g, float2 *prb,
            f[f_index+1].y  *(sxf  )*(1-syf)+
            f[f_index+N].y  *(1-sxf)*(syf  )+
            f[f_index+1+N].y*(sxf  )*(syf  );
-    g[g_index].x = c * (prb[prb_index].x * tmp.x - prb[prb_index].y * tmp.y);
-    g[g_index].y = c * (prb[prb_index].x * tmp.y + prb[prb_index].y * tmp.x);
+    for (int k = 0; k < Nmodes; k++)
+    {
+      const float2 p = prb[prb_index + k * prb_mode];
+      g[g_index + k * g_mode].x = c * (p.x * tmp.x - p.y * tmp.y);
+      g[g_index + k * g_mode].y = c * (p.x * tmp.y + p.y * tmp.x);
+    }
   }
 }
@@ -3,10 +3,10 @@
 
 // constructor, memory allocation
 ptychofft::ptychofft(size_t ptheta, size_t nz, size_t n, size_t nscan,
-  size_t ndet, size_t nprb
+  size_t ndet, size_t nprb, size_t nmodes
 ) :
   ptheta(ptheta), nz(nz), n(n), nscan(nscan), ndet(ndet),
-  nprb(nprb)
+  nprb(nprb), nmodes(nmodes)
 {
 	// create batched 2D FFT plan on GPU with sizes (ndet, ndet)
   // transform shape MUST be less than or equal to input and ouput shapes.
@@ -18,8 +18,21 @@ ptychofft::ptychofft(size_t ptheta, size_t nz, size_t n, size_t nscan,
     CUFFT_C2C,
     ptheta * nscan        // Number of FFTs to do simultaneously
   );
+  // create a second plan which transforms all probe modes at once
+  plan2dmodes = plan2d;
+  if (nmodes > 1)
+  {
+    cufftPlanMany(&plan2dmodes, 2,
+      ffts,                 // transform shape
+      ffts, 1, ndet * ndet, // input shape
+      ffts, 1, ndet * ndet, // output shape
+      CUFFT_C2C,
+      ptheta * nmodes * nscan // Number of FFTs to do simultaneously
+    );
+  }
   // create a place to put the FFT and IFFT output.
-  cudaMalloc((void**)&fft_out, ptheta * nscan * ndet * ndet * sizeof(float2));
+  cudaMalloc((void**)&fft_out,
+    ptheta * nmodes * nscan * ndet * ndet * sizeof(float2));
 
 	// init 3d thread block on GPU
 	BS3d.x = 32;
@@ -50,6 +63,7 @@ void ptychofft::free()
 {
   if(!is_free)
   {
+    if (nmodes > 1) cufftDestroy(plan2dmodes);
     cufftDestroy(plan2d);
     cudaFree(fft_out);
     is_free = true;
@@ -67,7 +81,7 @@ void ptychofft::fwd(size_t g_, size_t f_, size_t scan_, size_t prb_)
 
 	// probe multiplication of the object array
   cudaMemset(fft_out, 0, ptheta * nscan * ndet * ndet * sizeof(float2));
-	muloperator<<<GS3d0, BS3d>>>(f, fft_out, prb, scan, ptheta, nz, n, nscan, nprb, ndet, 2); //flg==2 forward transform
+	muloperator<<<GS3d0, BS3d>>>(f, fft_out, prb, scan, ptheta, nz, n, nscan, nprb, ndet, 1, 2); //flg==2 forward transform
 	// Fourier transform
 	cufftExecC2C(plan2d, (cufftComplex *)fft_out, (cufftComplex *)g, CUFFT_FORWARD);
 }
@@ -84,5 +98,37 @@ void ptychofft::adj(size_t f_, size_t g_, size_t scan_, size_t prb_, int flg)
 	// inverse Fourier transform
 	cufftExecC2C(plan2d, (cufftComplex *)g, (cufftComplex *)fft_out, CUFFT_INVERSE);
 	// adjoint probe (flg==0) or object (flg=1) multiplication operator
-	muloperator<<<GS3d0, BS3d>>>(f, fft_out, prb, scan, ptheta, nz, n, nscan, nprb, ndet, flg);
+	muloperator<<<GS3d0, BS3d>>>(f, fft_out, prb, scan, ptheta, nz, n, nscan, nprb, ndet, 1, flg);
+}
+
+// forward ptychography operator for all probe modes g_k = FQ_kf
+void ptychofft::fwd_modes(size_t g_, size_t f_, size_t scan_, size_t prb_)
+{
+  // convert pointers to correct type
+  f = (float2 *)f_;
+  g = (float2 *)g_;
+  scan = (float2 *)scan_;
+  prb = (float2 *)prb_;
+
+	// probe multiplication of the object array
+  cudaMemset(fft_out, 0, ptheta * nmodes * nscan * ndet * ndet * sizeof(float2));
+	muloperator<<<GS3d0, BS3d>>>(f, fft_out, prb, scan, ptheta, nz, n, nscan, nprb, ndet, nmodes, 2); //flg==2 forward transform
+	// Fourier transform
+	cufftExecC2C(plan2dmodes, (cufftComplex *)fft_out, (cufftComplex *)g, CUFFT_FORWARD);
+}
+
+// adjoint ptychography operator for all probe modes with respect to object
+// (flg==0) f = sum_k Q_k*F*g_k, or probes (flg==1) prb_k = Q*F*g_k
+void ptychofft::adj_modes(size_t f_, size_t g_, size_t scan_, size_t prb_, int flg)
+{
+  // convert pointers to correct type
+  f = (float2 *)f_;
+  g = (float2 *)g_;
+  scan = (float2 *)scan_;
+  prb = (float2 *)prb_;
+
+	// inverse Fourier transform
+	cufftExecC2C(plan2dmodes, (cufftComplex *)g, (cufftComplex *)fft_out, CUFFT_INVERSE);
+	// adjoint probe (flg==0) or object (flg=1) multiplication operator
+	muloperator<<<GS3d0, BS3d>>>(f, fft_out, prb, scan, ptheta, nz, n, nscan, nprb, ndet, nmodes, flg);
 }
@@ -6,13 +6,14 @@ namespace py = pybind11;
 PYBIND11_MODULE(ptychofft, m){
 
   py::class_<ptychofft>(m, "ptychofft")
-    .def(py::init<int, int, int, int, int, int>(),
+    .def(py::init<int, int, int, int, int, int, int>(),
       py::arg("ptheta"),
       py::arg("nz"),
       py::arg("n"),
       py::arg("nscan"),
       py::arg("detector_shape"),
-      py::arg("probe_shape")
+      py::arg("probe_shape"),
+      py::arg("nmodes") = 1
     )
     .def_readonly("ptheta", &ptychofft::ptheta)
     .def_readonly("nz", &ptychofft::nz)
@@ -20,8 +21,11 @@ PYBIND11_MODULE(ptychofft, m){
     .def_readonly("nscan", &ptychofft::nscan)
     .def_readonly("ndet", &ptychofft::ndet)
     .def_readonly("nprb", &ptychofft::nprb)
+    .def_readonly("nmodes", &ptychofft::nmodes)
     .def("fwd", &ptychofft::fwd)
     .def("adj", &ptychofft::adj)
+    .def("fwd_modes", &ptychofft::fwd_modes)
+    .def("adj_modes", &ptychofft::adj_modes)
     .def("free", &ptychofft::free)
     ;
 }
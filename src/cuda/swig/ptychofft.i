@@ -15,12 +15,15 @@ public:
   size_t nscan;  // number of scan positions for 1 projection
   size_t ndet;   // detector y size
   size_t nprb;   // probe size in 1 dimension
+  size_t nmodes; // number of probe modes
 
   %mutable;
   ptychofft(size_t ptheta, size_t nz, size_t n, size_t nscan,
-            size_t detector_shape, size_t probe_shape);
+            size_t detector_shape, size_t probe_shape, size_t nmodes = 1);
   ~ptychofft();
   void fwd(size_t g_, size_t f_, size_t scan_, size_t prb_);
   void adj(size_t f_, size_t g_, size_t scan_, size_t prb_, int flg);
+  void fwd_modes(size_t g_, size_t f_, size_t scan_, size_t prb_);
+  void adj_modes(size_t f_, size_t g_, size_t scan_, size_t prb_, int flg);
   void free();
 };
@@ -14,6 +14,7 @@ class ptychofft
   // Negative scan positions are skipped in kernel executions.
 
 	cufftHandle plan2d;		 // 2D FFT plan
+	cufftHandle plan2dmodes; // 2D FFT plan for all probe modes
   float2 *fft_out;       // Buffer to store FFT output
 
 	dim3 BS3d; // 3d thread block on GPU
@@ -30,16 +31,21 @@ public:
   size_t nscan;  // number of scan positions for 1 projection
   size_t ndet;  // detector size in 1 dimension
   size_t nprb;   // probe size in 1 dimension
+  size_t nmodes; // number of probe modes
 
 	// constructor, memory allocation
 	ptychofft(size_t ptheta, size_t nz, size_t n,
-			  size_t nscan, size_t ndet, size_t nprb);
+			  size_t nscan, size_t ndet, size_t nprb, size_t nmodes = 1);
 	// destructor, memory deallocation
 	~ptychofft();
 	// forward ptychography operator FQ
 	void fwd(size_t g_, size_t f_, size_t scan_, size_t prb_);
 	// adjoint ptychography operator with respect to object (fgl==0) f = Q*F*g, or probe (flg==1) prb = Q*F*g
 	void adj(size_t f_, size_t g_, size_t scan_, size_t prb_, int flg);
+	// forward ptychography operator FQ_k for all probe modes at once
+	void fwd_modes(size_t g_, size_t f_, size_t scan_, size_t prb_);
+	// adjoint ptychography operators for all probe modes at once
+	void adj_modes(size_t f_, size_t g_, size_t scan_, size_t prb_, int flg);
   void free();
 };
 
@@ -1,6 +1,21 @@
 from pkg_resources import get_distribution, DistributionNotFound
 
-from libtike.cufft.ptycho import *
+from libtike.cufft.base import *
+from libtike.cufft.cg import *
+from libtike.cufft.cpu import *
+from libtike.cufft.minibatch import *
+from libtike.cufft.models import *
+from libtike.cufft.packed import *
+from libtike.cufft.parallel import *
+from libtike.cufft.storage import *
+from libtike.cufft.tiled import *
+
+try:
+    from libtike.cufft.ptycho import *
+except ImportError:
+    # cupy or the compiled ptychofft extension is not available; only the CPU
+    # engine can be used
+    pass
 
 try:
     __version__ = get_distribution(__name__).version
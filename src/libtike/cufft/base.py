@@ -0,0 +1,497 @@
+"""A module for the array backend independent parts of ptychography solvers.
+
+The base class in this module implements the context manager protocol, the
+data shuffle between host and device, and the partitioning of the data along
+the angular dimension. It does not implement the ptychography operators
+themselves. Engines (e.g. `PtychoCuFFT` or `PtychoNumPy`) inherit from this
+class, set the `array_module` and `asnumpy` hooks, and implement the `fwd`,
+`adj`, `adj_probe`, and `free` methods.
+
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+
+import numpy as np
+
+from libtike.cufft.trace import traced, tracer
+
+
+def roi(scan, nprb, nz, n):
+    """Return the origins [ntheta, 2] and the shape of the object crops.
+
+    The crop of an angle is the bounding box of its valid positions plus the
+    probe and the pixel past it which interpolation reads. All angles share
+    the largest shape, so one solver fits all of the partitions.
+    """
+    corner = np.trunc(np.asarray(scan))
+    valid = np.all(corner >= 0, axis=-1, keepdims=True)
+    lo = np.min(np.where(valid, corner, np.inf), axis=1)
+    hi = np.max(np.where(valid, corner + nprb + 1, -np.inf), axis=1)
+    # angles without positions are cropped at the origin
+    empty = ~np.any(valid[..., 0], axis=1)
+    lo[empty], hi[empty] = 0, 1
+    size = np.array([nz, n])
+    shape = np.minimum(np.max(hi - lo, axis=0), size).astype(int)
+    origin = np.minimum(lo, size - shape).astype(int)
+    return origin, tuple(int(s) for s in shape)
+
+
+class Workspace(object):
+    """A pool of named work arrays which are reused between calls.
+
+    Solvers request their large temporaries from a workspace by name instead
+    of allocating new arrays in every iteration. An array is only allocated
+    when its name is requested for the first time or with a different shape
+    or dtype. The arrays are kept until `clear` is called.
+
+    Attribtues
+    ----------
+    nbytes : int
+        The number of bytes currently held by the workspace.
+    peak : int
+        The largest number of bytes held by the workspace at once.
+    """
+
+    def __init__(self, array_module):
+        self.xp = array_module
+        self.arrays = {}
+        self.nbytes = 0
+        self.peak = 0
+
+    def empty(self, name, shape, dtype='complex64'):
+        """Return the uninitialized array called name."""
+        shape = tuple(shape)
+        x = self.arrays.get(name)
+        if x is None or x.shape != shape or x.dtype != dtype:
+            self.release(name)
+            x = self.xp.empty(shape, dtype=dtype)
+            self.arrays[name] = x
+            self.nbytes += x.nbytes
+            self.peak = max(self.peak, self.nbytes)
+        return x
+
+    def zeros(self, name, shape, dtype='complex64'):
+        """Return the array called name filled with zeros."""
+        x = self.empty(name, shape, dtype)
+        x.fill(0)
+        return x
+
+    def release(self, name):
+        """Drop the array called name from the workspace."""
+        x = self.arrays.pop(name, None)
+        if x is not None:
+            self.nbytes -= x.nbytes
+
+    def clear(self):
+        """Drop all arrays from the workspace."""
+        for name in list(self.arrays):
+            self.release(name)
+
+
+class PreparedScan(object):
+    """Scan positions of a partition with precomputed interpolation tables.
+
+    Scan positions do not change while a partition is solved, so the integer
+    offsets, the bilinear weights, and the mask of valid (non-negative)
+    positions are computed once by `Ptycho.prepare_scan` and reused by every
+    operator call. Engines add the tables which their operators consume.
+
+    Attribtues
+    ----------
+    scan : array
+        The raw scan positions [ptheta, nscan, 2].
+    valid : array
+        Whether each of the [ptheta, nscan] positions is non-negative.
+    """
+
+    def __init__(self, scan, valid, **tables):
+        self.scan = scan
+        self.valid = valid
+        self.__dict__.update(tables)
+
+
+class Ptycho(object):
+    """Base class for ptychography solvers independent of the array backend.
+
+    This class is a context manager which provides the batching helpers
+    required to implement a ptychography solver on top of an engine's
+    operators.
+
+    Attribtues
+    ----------
+    nmodes : int
+        The number of probe modes of the `*_modes` operators whose plans are
+        made at construction; other numbers of modes are also accepted.
+    array_module : module
+        The array module used by the engine's operators (e.g. cupy or numpy).
+    asnumpy : function
+        Moves an array of the array_module to host memory as a numpy array.
+    workspace : Workspace
+        Reusable work arrays of the solver which are kept until the end of
+        the with-block. `workspace.peak` reports their peak memory in bytes.
+    line_search_block : int or None
+        The number of elements per block of the multi-step line search, or
+        None for one block of all elements.
+    """
+
+    array_module = np
+    asnumpy = staticmethod(np.asarray)
+    # small blocks stay in the CPU caches
+    line_search_block = 2**18
+
+    def __enter__(self):
+        """Return self at start of a with-block."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Free memory due at interruptions or with-block exit."""
+        for solver in getattr(self, '_crops', {}).values():
+            solver.__exit__(type, value, traceback)
+        self._crops = {}
+        self.workspace.clear()
+        self.free()
+
+    @property
+    def workspace(self):
+        """The pool of reusable work arrays of this solver."""
+        if getattr(self, '_workspace', None) is None:
+            self._workspace = Workspace(self.array_module)
+        return self._workspace
+
+    def _zeros(self, out, shape, dtype='complex64'):
+        """Return out filled with zeros, or a new array of zeros."""
+        if out is None:
+            return self.array_module.zeros(shape, dtype=dtype)
+        out.fill(0)
+        return out
+
+    def free(self):
+        """Free the engine's memory."""
+        raise NotImplementedError("Cannot free a base class.")
+
+    @staticmethod
+    def use_device(device):
+        """Make device the current device of this process or thread."""
+        pass
+
+    def _resized(self, nprb, ndet, nz, n):
+        """Return a new solver of this class with different sizes."""
+        return type(self)(self.nscan, nprb, ndet, self.ptheta, nz, n,
+                          nmodes=self.nmodes)
+
+    def _cropped(self, nz, n):
+        """Return the solver of crops [nz, n], which is kept until exit."""
+        if getattr(self, '_crops', None) is None:
+            self._crops = {}
+        if (nz, n) not in self._crops:
+            self._crops[nz, n] = self._resized(self.nprb, self.ndet, nz, n)
+        return self._crops[nz, n]
+
+    def prepare_scan(self, scan):
+        """Return a PreparedScan of scan positions for this engine.
+
+        Operators accept either raw scan arrays or prepared scans; passing a
+        prepared scan avoids recomputing its tables in each call.
+        """
+        if isinstance(scan, PreparedScan):
+            return scan
+        assert scan.dtype == np.float32, f"{scan.dtype}"
+        xp = self.array_module
+        # integer parts as computed by modf in the muloperator kernel
+        valid = xp.all(xp.trunc(scan) >= 0, axis=-1)
+        return PreparedScan(scan, valid)
+
+    def _parts(self, ntheta):
+        """Return the angle slices of each partition of ptheta angles.
+
+        The last partition is shorter when ptheta does not divide ntheta.
+        Slices are used, so that lazy arrays (e.g. np.memmap or h5py
+        datasets) read each partition as one contiguous block.
+        """
+        return [
+            slice(k, min(k + self.ptheta, ntheta))
+            for k in range(0, ntheta, self.ptheta)
+        ]
+
+    def _pad(self, x, fill=0):
+        """Pad the angular dimension of a partition to ptheta with fill."""
+        x = np.asarray(x)
+        if x.shape[0] == self.ptheta:
+            return x
+        pad = np.full([self.ptheta - x.shape[0], *x.shape[1:]], fill,
+                      dtype=x.dtype)
+        return np.concatenate([x, pad])
+
+    def _batch(self, function, output, *inputs):
+        """Does data shuffle between host and device.
+
+        The inputs are processed in partitions of ptheta angles. A last
+        partition with fewer angles is padded with zeros; the second input
+        must be the scan, which is padded with negative positions so the
+        padding is skipped by the operators. Only one partition of the inputs
+        is read at a time, so inputs and output may be lazy arrays which
+        support slicing along the first dimension.
+        """
+        for ids in self._parts(inputs[0].shape[0]):
+            inputs_gpu = self._stage(*[
+                self._pad(x[ids], fill=-1 if i == 1 else 0)
+                for i, x in enumerate(inputs)
+            ])
+            output[ids] = self._drain(
+                [function(*inputs_gpu)],
+                self._ready())[0][:ids.stop - ids.start]
+        return output
+
+    def fwd(self, psi, scan, probe, out=None):
+        """Ptychography transform (FQ)."""
+        raise NotImplementedError("Cannot transform with a base class.")
+
+    def fwd_ptycho_batch(self, psi, scan, probe, out=None):
+        """Batch of Ptychography transform (FQ).
+
+        The result is written into out when an array is given.
+        """
+        if out is None:
+            out = np.zeros([scan.shape[0], self.nscan, self.ndet, self.ndet],
+                           dtype='complex64')
+        return self._batch(self.fwd, out, psi, scan, probe)
+
+    def adj(self, farplane, scan, probe, out=None):
+        """Adjoint ptychography transform (Q*F*)."""
+        raise NotImplementedError("Cannot transform with a base class.")
+
+    def adj_ptycho_batch(self, farplane, scan, probe, out=None):
+        """Batch of Ptychography transform (FQ).
+
+        The result is written into out when an array is given.
+        """
+        if out is None:
+            out = np.zeros([scan.shape[0], self.nz, self.n], dtype='complex64')
+        return self._batch(self.adj, out, farplane, scan, probe)
+
+    def adj_probe(self, farplane, scan, psi, out=None):
+        """Adjoint ptychography probe transform (O*F*), object is fixed."""
+        raise NotImplementedError("Cannot transform with a base class.")
+
+    def fwd_modes(self, psi, scan, probe, out=None):
+        """Ptychography transform (FQ_k) of all probe modes at once.
+
+        Returns the farplane [ptheta, nmodes, nscan, ndet, ndet] and the
+        intensity sum_k |FQ_k psi|^2 [ptheta, nscan, ndet, ndet]. Both are
+        written into the arrays of the out tuple when it is given.
+        """
+        raise NotImplementedError("Cannot transform with a base class.")
+
+    def adj_modes(self, farplane, scan, probe, out=None):
+        """Adjoint ptychography transform (sum_k Q_k*F*) of all probe modes."""
+        raise NotImplementedError("Cannot transform with a base class.")
+
+    def adj_probe_modes(self, farplane, scan, psi, out=None):
+        """Adjoint ptychography probe transform (O*F*) of all probe modes."""
+        raise NotImplementedError("Cannot transform with a base class.")
+
+    def intensity(self, farplane, out=None):
+        """Return the intensity sum_k |farplane_k|^2 of all probe modes.
+
+        The farplane [ptheta, nmodes, nscan, ndet, ndet] is accumulated one
+        mode at a time into out [ptheta, nscan, ndet, ndet], so the only
+        temporary is a workspace array of one mode. Engines override this
+        with fused implementations.
+        """
+        xp = self.array_module
+        out = self._zeros(out, [farplane.shape[0], *farplane.shape[2:]],
+                          dtype='float32')
+        tmp = self.workspace.empty('intensity_mode', out.shape, 'float32')
+        for m in range(farplane.shape[1]):
+            xp.abs(farplane[:, m], out=tmp)
+            tmp *= tmp
+            out += tmp
+        return out
+
+    def residual(self, model, farplane, intensity, d, out=None, cost=False):
+        """Return the residual farplane * (1 - d / g(intensity)) of a model.
+
+        The farplane may have a modes dimension after the first one, which
+        intensity and the data term d do not have. When cost is True, the
+        total cost of the intensity is computed in the same pass and is
+        returned as a float after the residual; otherwise None is returned.
+        Engines override this with fused elementwise implementations.
+        """
+        xp = self.array_module
+        ratio = model.ratio(xp, intensity, d)
+        if farplane.ndim > intensity.ndim:
+            ratio = ratio[:, xp.newaxis]
+        out = xp.multiply(farplane, ratio, out=out)
+        if cost:
+            return out, float(xp.sum(model.cost(xp, intensity, d)))
+        return out, None
+
+    def adj_ptycho_batch_prb(self, farplane, scan, psi, out=None):
+        """Batch of Ptychography transform (FQ).
+
+        The result is written into out when an array is given.
+        """
+        if out is None:
+            out = np.zeros([scan.shape[0], self.nprb, self.nprb],
+                           dtype='complex64')
+        return self._batch(self.adj_probe, out, farplane, scan, psi)
+
+    def run(self, data, psi, scan, probe, **kwargs):
+        """Placehold for a child's solving function."""
+        raise NotImplementedError("Cannot run a base class.")
+
+    @traced('stage')
+    def _stage(self, *arrays):
+        """Copy host arrays to the device; may run in a background thread."""
+        xp = self.array_module
+        return [xp.array(x) for x in arrays]
+
+    def _ready(self):
+        """Return a marker after which all queued device work is complete."""
+        return None
+
+    def synchronize(self):
+        """Wait until all queued device work is complete."""
+        pass
+
+    @traced('drain')
+    def _drain(self, arrays, ready=None):
+        """Copy device arrays to the host once the ready marker is reached.
+
+        This method may run in a background thread.
+        """
+        return [self.asnumpy(x) for x in arrays]
+
+    def run_batch(self, data, psi, scan, probe, nbuffers=1, out=None,
+                  crop=True, **kwargs):
+        """Run by dividing the work into batches.
+
+        The data, psi, scan, and probe may be lazy arrays (e.g. np.memmap,
+        h5py datasets, or any object which supports slicing along the first
+        dimension); each partition is read only when it is staged.
+
+        Parameters
+        ----------
+        out : dict
+            Arrays with keys 'psi' and 'probe' (e.g. writable np.memmap) into
+            which the results of each partition are written as soon as the
+            partition is solved. By default the results are written to
+            in-memory copies of psi and probe. The per iteration 'history'
+            and the 'stop' reason of each partition are appended to the lists
+            out['history'] and out['stop'] when the solver returns them.
+        nbuffers : int
+            The number of angle partitions which are on the device at once.
+            With one buffer the partitions are copied, solved and copied back
+            serially. With two (double buffering) or three (triple buffering)
+            buffers, the next partitions are copied to the device and the
+            results of the previous partition are copied back to the host on
+            background threads while a partition is being solved.
+        crop : bool or (array, tuple)
+            Whether to solve only the region of interest (see `roi`) of the
+            objects when it is smaller than the grid, or the origins and shape
+            of the crops. The crops are solved by a resized solver with
+            shifted scan positions and pasted back into the full objects; the
+            pixels outside of the crops are unchanged. The resized solver of
+            each crop shape is kept until the end of the with-block.
+
+        """
+        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
+        assert nbuffers >= 1, "nbuffers must be positive, not %d" % nbuffers
+
+        if out is None:
+            out = {'psi': np.array(psi), 'probe': np.array(probe)}
+
+        # angle partitions in ptychography; the last partition is padded
+        # with angles whose scan positions are negative, which contribute
+        # nothing to the solution of the other angles
+        parts = self._parts(scan.shape[0])
+
+        solver = self
+        origin = np.zeros([scan.shape[0], 2], dtype=int)
+        if crop is True:
+            crop = roi(scan[:], self.nprb, self.nz, self.n)
+        if crop:
+            origin, (nz, n) = crop
+            if (nz, n) != (self.nz, self.n):
+                solver = self._cropped(nz, n)
+        nz, n = solver.nz, solver.n
+
+        def stage(ids):
+            psi_part = np.asarray(psi[ids])
+            scan_part = np.array(scan[ids])
+            extra = {}
+            if solver is not self:
+                # the relative update and the probe normalization are of the
+                # full objects, not the crops
+                amplitude = np.abs(psi_part)
+                for x, (y, z) in zip(amplitude, origin[ids]):
+                    x[y:y + nz, z:z + n] = 0
+                extra['outside'] = float(np.sum(amplitude.astype('float64')**2))
+                extra['outside_max'] = float(np.max(amplitude, initial=0))
+                psi_part = np.stack([
+                    x[y:y + nz, z:z + n]
+                    for x, (y, z) in zip(psi_part, origin[ids])
+                ])
+                # negative positions stay negative
+                scan_part -= origin[ids, np.newaxis].astype(scan_part.dtype)
+            return solver._stage(
+                self._pad(data[ids]),
+                self._pad(psi_part),
+                self._pad(scan_part, fill=-1),
+                self._pad(probe[ids]),
+            ), extra
+
+        def solve(ids, inputs):
+            inputs, extra = inputs
+            with tracer.span('partition', angles=[ids.start, ids.stop]):
+                return solver.run(*inputs, **extra, **kwargs)
+
+        def drain(ids, result, ready):
+            psi_host, probe_host = solver._drain(
+                [result['psi'], result['probe']], ready)
+            if solver is not self:
+                window = psi_host
+                psi_host = np.array(psi[ids])
+                for x, w, (y, z) in zip(psi_host, window, origin[ids]):
+                    x[y:y + nz, z:z + n] = w
+            out['psi'][ids] = psi_host[:ids.stop - ids.start]
+            out['probe'][ids] = probe_host[:ids.stop - ids.start]
+            for key in ('history', 'stop'):
+                if key in result:
+                    out.setdefault(key, []).append(result[key])
+
+        if nbuffers == 1:
+            for ids in parts:
+                # solve cg ptychography problem for the part
+                result = solve(ids, stage(ids))
+                drain(ids, result, solver._ready())
+        else:
+            with ThreadPoolExecutor(1) as stager, \
+                    ThreadPoolExecutor(1) as drainer:
+                staged = deque()
+                drained = None
+                todo = iter(parts)
+                for _ in parts:
+                    if not staged:
+                        ids = next(todo)
+                        staged.append((ids, stager.submit(stage, ids)))
+                    ids, inputs = staged.popleft()
+                    # stage up to nbuffers - 1 partitions ahead of this one
+                    for ids_next in itertools.islice(
+                            todo, nbuffers - 1 - len(staged)):
+                        staged.append(
+                            (ids_next, stager.submit(stage, ids_next)))
+                    inputs = inputs.result()
+                    result = solve(ids, inputs)
+                    del inputs
+                    # at most one partition is draining at a time
+                    if drained is not None:
+                        drained.result()
+                    drained = drainer.submit(drain, ids, result,
+                                             solver._ready())
+                    del result
+                if drained is not None:
+                    drained.result()
+        return out
@@ -0,0 +1,243 @@
+"""A module for benchmarking the operators and solvers of an engine.
+
+Each benchmark case is a problem size; the default matrix varies one of
+nscan, ndet/nprb, nmodes, ptheta, or the object size at a time around a base
+case, so the results are scaling curves along each of these dimensions. The
+operators, the batch helpers, and one iteration of the conjugate gradient
+solver are timed for each case, and the results are written as JSON.
+
+```bash
+python -m libtike.cufft.benchmark --engine numpy --output new.json
+python -m libtike.cufft.benchmark --engine cuda --baseline old.json
+```
+
+When a baseline is given, each result is compared with the baseline result of
+the same case and operation, and the exit status is 1 if any of them is
+slower than the threshold.
+
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# the problem size around which the default matrix varies
+BASE = dict(nscan=256, ndet=64, nprb=32, nmodes=1, ptheta=1, n=256)
+# the values of each dimension of the default matrix
+AXES = dict(
+    nscan=[64, 256, 1024],
+    ndet=[(32, 16), (64, 32), (128, 64)],
+    nmodes=[1, 2, 4],
+    ptheta=[1, 2, 4],
+    n=[128, 256, 512],
+)
+# a small matrix for smoke tests
+QUICK = dict(nscan=[16, 32], ndet=[(16, 8)], nmodes=[1, 2], ptheta=[1],
+             n=[32])
+QUICK_BASE = dict(nscan=16, ndet=16, nprb=8, nmodes=1, ptheta=1, n=32)
+
+
+def matrix(base=BASE, axes=AXES):
+    """Return the cases which vary one dimension of base at a time."""
+    cases = []
+    for name, values in axes.items():
+        for value in values:
+            case = dict(base)
+            if name == 'ndet':
+                case['ndet'], case['nprb'] = value
+            else:
+                case[name] = value
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def solver_class(engine):
+    """Return the solver class of an engine name."""
+    if engine == 'numpy':
+        from libtike.cufft.cpu import CGPtychoNumPySolver
+        return CGPtychoNumPySolver
+    if engine == 'cuda':
+        from libtike.cufft.ptycho import CGPtychoSolver
+        return CGPtychoSolver
+    raise ValueError(f"{engine} is not one of ['numpy', 'cuda'].")
+
+
+def problem(case, ntheta, seed=0):
+    """Return a random object, raster scan, and probe of a case."""
+    rng = np.random.default_rng(seed)
+    n, nprb = case['n'], case['nprb']
+    psi = np.exp(1j * rng.random([ntheta, n, n]) - 0.1).astype('complex64')
+    probe = (rng.random([ntheta, case['nmodes'], nprb, nprb]) +
+             1j * rng.random([ntheta, case['nmodes'], nprb, nprb]))
+    side = int(np.ceil(np.sqrt(case['nscan'])))
+    grid = np.linspace(0, n - nprb - 1.5, side)
+    y, x = np.meshgrid(grid, grid, indexing='ij')
+    scan = np.stack([y, x], axis=-1).reshape(-1, 2)[:case['nscan']]
+    scan = np.tile(scan, [ntheta, 1, 1]).astype('float32')
+    return psi, scan, probe.astype('complex64')
+
+
+def measure(function, synchronize, repeat, xp):
+    """Return the median seconds and the peak bytes of calls of function.
+
+    The peak memory is measured in a separate call, so that tracing the host
+    allocations does not slow down the timed calls.
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        synchronize()
+        seconds.append(time.perf_counter() - start)
+    if xp is np:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        # the pool keeps the blocks which were used, so its size is the peak
+        xp.get_default_memory_pool().free_all_blocks()
+        function()
+        synchronize()
+        peak = xp.get_default_memory_pool().total_bytes()
+    return float(np.median(seconds)), int(peak)
+
+
+def run_case(cls, case, repeat=3):
+    """Return the results of all of the operations of one case."""
+    ntheta = 2 * case['ptheta']
+    nz = n = case['n']
+    args = (case['nscan'], case['nprb'], case['ndet'], case['ptheta'], nz, n)
+    psi, scan, probe = problem(case, ntheta)
+    results = []
+    with cls(*args, nmodes=case['nmodes']) as slv:
+        xp = slv.array_module
+        part = slice(0, case['ptheta'])
+        d_psi, d_scan, d_probe = (xp.asarray(x[part])
+                                  for x in (psi, scan, probe))
+        d_prepared = slv.prepare_scan(d_scan)
+        farplane = slv.fwd(d_psi, d_prepared, d_probe[:, 0])
+        data = slv.fwd_ptycho_batch(psi, scan, probe[:, 0])
+        data = np.abs(data)**2
+        d_data = xp.asarray(data[part])
+        # the farplane of the host batches is converted outside of the timing
+        h_farplane = data.astype('complex64')
+        operations = {
+            'fwd': (lambda: slv.fwd(d_psi, d_prepared, d_probe[:, 0]),
+                    case['ptheta']),
+            'adj': (lambda: slv.adj(farplane, d_prepared, d_probe[:, 0]),
+                    case['ptheta']),
+            'adj_probe': (lambda: slv.adj_probe(farplane, d_prepared, d_psi),
+                          case['ptheta']),
+            'fwd_ptycho_batch': (
+                lambda: slv.fwd_ptycho_batch(psi, scan, probe[:, 0]), ntheta),
+            'adj_ptycho_batch': (
+                lambda: slv.adj_ptycho_batch(h_farplane, scan, probe[:, 0]),
+                ntheta),
+            'adj_ptycho_batch_prb': (
+                lambda: slv.adj_ptycho_batch_prb(h_farplane, scan, psi),
+                ntheta),
+            'cg_iteration': (
+                lambda: slv.run(d_data, d_psi, d_scan, d_probe.copy(), 1,
+                                recover_prb=True), case['ptheta']),
+        }
+        for name, (function, nviews) in operations.items():
+            # the first call compiles kernels and makes plans
+            function()
+            seconds, peak = measure(function, slv.synchronize, repeat, xp)
+            results.append({
+                'case': case,
+                'operation': name,
+                'seconds': seconds,
+                'patterns_per_second': nviews * case['nscan'] / seconds,
+                'peak_bytes': peak,
+            })
+    return results
+
+
+def compare(results, baseline, threshold=1.1):
+    """Return the comparison of each result with the baseline result of the
+    same case and operation; slowdowns above threshold are regressions."""
+    known = {
+        (json.dumps(r['case'], sort_keys=True), r['operation']): r
+        for r in baseline['results']
+    }
+    comparison = []
+    for r in results:
+        old = known.get((json.dumps(r['case'], sort_keys=True),
+                         r['operation']))
+        if old is None:
+            continue
+        ratio = r['seconds'] / old['seconds']
+        comparison.append({
+            'case': r['case'],
+            'operation': r['operation'],
+            'speedup': 1 / ratio,
+            'regression': ratio > threshold,
+        })
+    return comparison
+
+
+def benchmark(engine='numpy', cases=None, repeat=3, baseline=None,
+              threshold=1.1):
+    """Return the benchmark report of an engine as a dict."""
+    cls = solver_class(engine)
+    cases = matrix() if cases is None else cases
+    report = {
+        'engine': engine,
+        'solver': cls.__name__,
+        'machine': {
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+        },
+        'results': list(itertools.chain.from_iterable(
+            run_case(cls, case, repeat) for case in cases)),
+    }
+    if baseline is not None:
+        report['comparison'] = compare(report['results'], baseline, threshold)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--engine', default='numpy', choices=['numpy', 'cuda'])
+    parser.add_argument('--output', help="the JSON file of the report")
+    parser.add_argument('--baseline', help="a JSON report to compare with")
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help="the slowdown ratio which is a regression")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--quick', action='store_true',
+                        help="run a small matrix for smoke testing")
+    args = parser.parse_args(argv)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report = benchmark(
+        args.engine,
+        cases=matrix(QUICK_BASE, QUICK) if args.quick else None,
+        repeat=args.repeat,
+        baseline=baseline,
+        threshold=args.threshold,
+    )
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    regressions = [c for c in report.get('comparison', []) if c['regression']]
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,497 @@
+"""A module for the conjugate gradient ptychography solver.
+
+The solver in this module is written against the operators of the `Ptycho`
+base class and the `array_module` hook only, so the same iterations run on any
+engine which implements those operators.
+
+"""
+
+import time
+import warnings
+
+import numpy as np
+
+from libtike.cufft.base import Ptycho
+from libtike.cufft.models import get_noise_model
+from libtike.cufft.trace import traced, tracer
+
+
+def _spectrum_index(xp, m, n):
+    """Return where the m lowest frequencies are in an unshifted FFT of n."""
+    return xp.asarray(np.fft.fftfreq(m, 1 / m).astype(int) % n)
+
+
+def _fourier_resize(xp, x, shape):
+    """Resample the last two dimensions of x to shape by Fourier cropping or
+    zero padding; the values of x are preserved, not its sum."""
+    y = xp.zeros([*x.shape[:-2], *shape], dtype='complex64')
+    m = [min(a, b) for a, b in zip(x.shape[-2:], shape)]
+    src = [_spectrum_index(xp, k, a) for k, a in zip(m, x.shape[-2:])]
+    dst = [_spectrum_index(xp, k, b) for k, b in zip(m, shape)]
+    y[..., dst[0][:, None], dst[1]] = xp.fft.fft2(x)[..., src[0][:, None],
+                                                    src[1]]
+    y = xp.fft.ifft2(y) * (np.prod(shape) / np.prod(x.shape[-2:]))
+    return y.astype('complex64')
+
+
+class ForwardCache(object):
+    """Forward products of the current psi and probe of a solver.
+
+    The products FQ_k psi and sum_k |FQ_k psi|^2 are keyed on a version of
+    psi and a version of the probe which the solver increments whenever it
+    updates them. The products are computed only when the key changes, or
+    they may be put into the cache directly when the solver can derive them
+    cheaper (the forward operator is linear in psi and in each probe mode).
+    """
+
+    def __init__(self, fwd_modes, scan, out=None):
+        self.fwd_modes = fwd_modes
+        self.scan = scan
+        self.out = out
+        self.clear()
+
+    def __call__(self, psi, probe, key):
+        """Return the farplane and intensity of psi and probe at key."""
+        if key != self.key:
+            self.put(key, *self.fwd_modes(psi, self.scan, probe, out=self.out))
+        return self.farplane, self.intensity
+
+    def put(self, key, farplane, intensity):
+        """Store the farplane and intensity of psi and probe at key."""
+        self.key = key
+        self.farplane = farplane
+        self.intensity = intensity
+
+    def clear(self):
+        """Invalidate the cached products."""
+        self.put(None, None, None)
+
+
+class CGPtycho(Ptycho):
+    """Solve the ptychography problem using congujate gradient.
+
+    This class only depends on the operators of an engine, so it is combined
+    with an engine to make a solver e.g. `CGPtychoSolver` or
+    `CGPtychoNumPySolver`.
+    """
+
+    @staticmethod
+    @traced()
+    def line_search_sqr(f, p1, p2, p3, step_length=1, step_shrink=0.5,
+                        fp1=None):
+        """Optimized line search for square functions
+            Example of otimized computation for the Gaussian model:
+            sum_j|G_j(psi+gamma dpsi)|^2 = sum_j|G_j(psi)|^2+
+                                           gamma^2*sum_j|G_j(dpsi)|^2+
+                                           gamma*sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
+            p1,p2,p3 are temp variables to avoid computing the fwd operator during the line serch
+            p1 = sum_j|G_j(psi)|^2
+            p2 = sum_j|G_j(dpsi)|^2
+            p3 = sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
+
+            Parameters	
+            ----------	
+            f : function(x)	
+                The function being optimized.	
+            p1,p2,p3 : vectors	
+                Temporarily vectors to avoid computing forward operators        
+            fp1 : float
+                The value of f(p1) when it is already known.
+        """
+        assert step_shrink > 0 and step_shrink < 1
+        m = 0  # Some tuning parameter for termination
+        if fp1 is None:
+            fp1 = f(p1) # optimize computation
+        # Decrease the step length while the step increases the cost function
+        while f(p1+step_length**2 * p2+step_length*p3) > fp1 + step_shrink * m:
+            if step_length < 1e-32:
+                warnings.warn("Line search failed for conjugate gradient.")
+                return 0
+            step_length *= step_shrink            
+        return step_length
+
+    @traced()
+    def line_search_sqr_multi(self, f, p1, p2, p3, step_length=1,
+                              step_shrink=0.5, nsteps=8, fp1=None):
+        """Optimized line search for square functions with many steps per pass.
+
+        The steps which are tried and the step which is returned are the same
+        as for `line_search_sqr`, but nsteps steps are evaluated together in
+        one pass over p1, p2, p3 in blocks of line_search_block elements of
+        the engine, so no temporaries of the full size are made on the CPU;
+        the GPU engine evaluates all elements at once, so a pass is a few
+        kernel launches. The cost at step zero is evaluated in the first pass
+        too, unless it is given as fp1.
+
+        Parameters
+        ----------
+        f : function(x, k)
+            The function being optimized for the intensities x [nsteps, ...]
+            of the elements k (a slice) of the flat p1, summed over the last
+            dimension.
+        p1,p2,p3 : vectors
+            Temporarily vectors to avoid computing forward operators
+        fp1 : float
+            The cost at step zero when it is already known.
+
+        Returns the step length and the cost at step zero.
+        """
+        assert step_shrink > 0 and step_shrink < 1
+        xp = self.array_module
+        p1, p2, p3 = (p.reshape(-1) for p in (p1, p2, p3))
+        block = self.line_search_block or p1.size
+
+        def evaluate(steps):
+            cost = xp.zeros(len(steps), dtype='float64')
+            step = xp.asarray(steps, dtype='float32')[:, np.newaxis]
+            for k in range(0, p1.size, block):
+                k = slice(k, k + block)
+                cost += f(p1[k] + step**2 * p2[k] + step * p3[k], k)
+            return self.asnumpy(cost)
+
+        while True:
+            # the steps of the sequential search, stopping at the first one
+            # which is too small
+            steps = np.cumprod([step_length] + [step_shrink] * (nsteps - 1))
+            steps = steps[:np.argmax(np.append(steps < 1e-32, True)) + 1]
+            if fp1 is None:
+                cost = evaluate(np.append(0, steps))
+                fp1, cost = cost[0], cost[1:]
+            else:
+                cost = evaluate(steps)
+            accepted = np.flatnonzero(cost <= fp1)
+            if accepted.size:
+                return float(steps[accepted[0]]), float(fp1)
+            if steps[-1] < 1e-32:
+                warnings.warn("Line search failed for conjugate gradient.")
+                return 0, float(fp1)
+            step_length = steps[-1] * step_shrink
+    
+    @traced()
+    def run(
+            self,
+            data,
+            psi,
+            scan,
+            probe,
+            piter,
+            model='gaussian',
+            recover_prb=False,
+            levels=None,
+            callback=None,
+            verbose=False,
+            rtol=None,
+            utol=None,
+            max_time=None,
+            max_failures=None,
+            outside=0.0,
+            outside_max=0.0,
+    ):
+        """Conjugate gradients for ptychography.
+
+        Parameters
+        ----------
+        model : str or NoiseModel
+            The noise model to use for the gradient, e.g. 'gaussian',
+            'poisson', or any other item of `noise_models`.
+        piter : int
+            The number of gradient steps to take.
+        recover_prb : bool
+            Whether to recover the probe or assume the given probe is correct.
+        levels : list of (int, int)
+            A coarse to fine schedule of (factor, piter) which is solved
+            before the piter full resolution iterations. At each level the
+            detector is cropped to ndet / factor frequencies, so the object
+            and the probe have factor times larger pixels. The update of each
+            level is upsampled into the next level as its starting point.
+            The factors must divide ndet and nprb.
+        callback : function(dict)
+            Called after each iteration with the metrics of the iteration,
+            which have the 'level' factor during the coarse levels.
+        verbose : bool
+            Whether to print the metrics every 8 iterations.
+        rtol : float
+            Stop when the cost decreases by less than rtol times the cost.
+        utol : float
+            Stop when the relative update ||gammapsi*dpsi|| / ||psi|| of the
+            object is less than utol.
+        max_time : float
+            Stop after the iteration during which max_time seconds passed.
+        max_failures : int
+            Stop after the object line search failed this many times in a
+            row.
+        outside : float
+            The squared norm of the object pixels which are not in psi, e.g.
+            outside of the crops of `run_batch`, which is added to ||psi||^2
+            in the relative update, so the update does not depend on the crop.
+        outside_max : float
+            The largest amplitude of the object pixels which are not in psi,
+            which bounds max|psi| in the normalization of the probe gradient.
+
+        Returns a dict with the new 'psi' and 'probe', the 'stop' reason (one
+        of 'piter', 'rtol', 'utol', 'max_time', or 'max_failures') and the
+        'history', a list with the metrics of each iteration: the 'cost'
+        before the iteration, the step sizes 'gammapsi' and 'gammaprb', the
+        gradient norms 'gradpsi' and 'gradprb', the relative 'update' of the
+        object, and the wall time in seconds spent in 'fwd', 'adj',
+        'line_search', 'probe', and in total 'time'. These are computed from
+        quantities which the iteration needs anyway.
+
+        The data may have any real dtype (e.g. uint16 counts or float16); it
+        is expanded to float32 once when the data term of the model is made.
+        The probe may have any number of modes, probe.shape[1]; all modes
+        are transformed at once. Passing it as the nmodes of the engine
+        makes the plans of that many modes at construction instead of in the
+        first iteration.
+
+        """
+        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
+        xp = self.array_module
+        ws = self.workspace
+        if levels:
+            psi, probe = self._coarse_to_fine(
+                data, psi, scan, probe, levels,
+                model=model, recover_prb=recover_prb, callback=callback,
+                verbose=verbose)
+        # interpolation tables are computed once for all iterations
+        scan = self.prepare_scan(scan)
+        shape = [self.ptheta, self.nscan, self.ndet, self.ndet]
+        shape_modes = [self.ptheta, probe.shape[1], *shape[1:]]
+
+        model = get_noise_model(model)
+        # the data term of the noise model is computed once in float32
+        dterm = model.data_term(xp, data, ws.empty('dterm', shape, 'float32'))
+
+        # minimization functional of intensities x at the flat elements k
+        def minf(x, k):
+            return xp.sum(model.cost(xp, x, dterm.reshape(-1)[k]), axis=-1)
+
+        # 2 * sum_k Re(a_k * conj(b_k)) into out
+        def cross(a, b, out):
+            # the object and probe steps have products of different shapes
+            tmp = ws.empty('cross' if a.ndim == 5 else 'cross_probe', a.shape)
+            xp.conj(b, out=tmp)
+            tmp *= a
+            if a.ndim == 5:
+                xp.sum(tmp.real, axis=1, out=out)
+            else:
+                out[:] = tmp.real
+            out *= 2
+            return out
+
+        if verbose:
+            print("# congujate gradient parameters\n"
+                  "iteration, step size object, step size probe, function min"
+                  )  # csv column headers
+        gammaprb = 0
+        history = []
+        # wall time of stages; the device is synchronized to measure them
+        clock = [time.perf_counter()]
+
+        def lap(stage=None):
+            self.synchronize()
+            now = time.perf_counter()
+            if stage is not None:
+                tracer.complete(stage, clock[0], now - clock[0], iteration=i)
+            elapsed, clock[0] = now - clock[0], now
+            return elapsed
+
+        # forward products are reused until psi or the probe is updated
+        cache = ForwardCache(self.fwd_modes, scan, out=(
+            ws.empty('fpsi', shape_modes),
+            ws.empty('absfpsi', shape, 'float32'),
+        ))
+        psi_version = prb_version = 0
+        start = time.perf_counter()
+        failures = 0
+        stop = 'piter'
+        for i in range(piter):
+            lap()
+            metrics = {'iteration': i, 'fwd': 0.0, 'gradprb': 0.0}
+            # 1) object retrieval subproblem with fixed probes
+            # forward operators associated with each probe and the sum of
+            # their abs values squared
+            fpsi, absfpsi = cache(psi, probe, (psi_version, prb_version))
+            metrics['fwd'] += lap('fwd')
+            # take gradients; the probe of each mode is scaled by its max
+            # abs value squared before the fused adjoint operator
+            prbscl = probe / xp.max(
+                xp.abs(probe), axis=(0, 2, 3), keepdims=True)**2
+            # the cost of psi is evaluated in the same pass as the residual
+            res, cost = self.residual(model, fpsi, absfpsi, dterm,
+                                      out=ws.empty('res', shape_modes),
+                                      cost=True)
+            gradpsi = self.adj_modes(res, scan, prbscl)
+            del res
+            metrics['adj'] = lap('adj')
+            # Dai-Yuan direction
+            gradnorm = xp.linalg.norm(gradpsi)
+            if i == 0:
+                dpsi = -gradpsi
+            else:
+                dpsi = -gradpsi + (
+                    gradnorm**2 /
+                    (xp.sum(xp.conj(dpsi) * (gradpsi - gradpsi0))) * dpsi)
+            gradpsi0 = gradpsi
+            metrics['gradpsi'] = float(gradnorm)
+
+            # Use optimized line search for square functions, note:
+            # sum_j|G_j(psi+gamma dpsi)|^2 = sum_j|G_j(psi)|^2+
+            #                               gamma^2*sum_j|G_j(dpsi)|^2+
+            #                               gamma*sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
+            # temp variables to avoid computing the fwd operator during the line serch
+            #p1 = sum_j|G_j(psi)|^2
+            #p2 = sum_j|G_j(dpsi)|^2
+            #p3 = sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
+            fdpsi, p2 = self.fwd_modes(dpsi, scan, probe, out=(
+                ws.empty('res', shape_modes),
+                ws.empty('p2', shape, 'float32'),
+            ))
+            p1 = absfpsi
+            p3 = cross(fpsi, fdpsi, ws.empty('p3', shape, 'float32'))
+            metrics['fwd'] += lap('fwd')
+            # line search
+            gammapsi, metrics['cost'] = self.line_search_sqr_multi(
+                minf, p1, p2, p3, fp1=cost)
+            gammapsi *= 0.5
+            metrics['update'] = float(
+                gammapsi * xp.linalg.norm(dpsi) /
+                (float(xp.linalg.norm(psi))**2 + outside)**0.5)
+            failures = failures + 1 if gammapsi == 0 else 0
+            # update psi; the forward operator is linear in psi
+            psi = psi + gammapsi * dpsi
+            psi_version += 1
+            fdpsi *= gammapsi
+            fpsi += fdpsi
+            cache.put((psi_version, prb_version), fpsi,
+                      self.intensity(fpsi, out=absfpsi))
+            metrics['line_search'] = lap('line_search')
+
+            if (recover_prb):
+                if(i==0):
+                    gradprb = probe*0
+                    gradprb0 = probe*0
+                    dprb = probe*0
+                gradprbnorm2 = 0
+                # the normalization is over the full objects, not the crops
+                psimax2 = max(float(xp.max(xp.abs(psi))), outside_max)**2
+                for m in range(0,probe.shape[1]):
+                    # 2) probe retrieval subproblem with fixed object
+                    # forward operators associated with each probe and the
+                    # sum of their abs values squared
+                    fprbs, absfprb = cache(psi, probe,
+                                           (psi_version, prb_version))
+                    fprb = fprbs[:, m]
+                    # take gradient
+                    gradprb[:,m] = self.adj_probe(
+                        self.residual(model, fprb, absfprb, dterm,
+                                      out=ws.empty('res1', shape))[0],
+                        scan,
+                        psi,
+                    ) / psimax2 / self.nscan
+                    # Dai-Yuan direction
+                    if (i == 0):
+                        dprb[:,m] = -gradprb[:,m]
+                    else:
+                        dprb[:,m] = -gradprb[:,m] + (
+                            xp.linalg.norm(gradprb[:,m])**2 /
+                            (xp.sum(xp.conj(dprb[:,m]) * (gradprb[:,m] - gradprb0[:,m]))) * dprb[:,m])
+                    gradprb0[:,m] = gradprb[:,m]
+                    gradprbnorm2 += float(xp.linalg.norm(gradprb[:, m]))**2
+                    # temp variables to avoid computing the fwd operator during the line serch
+                    p1 = absfprb
+                    tmp1 = fprb
+                    # the kernels read the probe of each angle densely
+                    tmp2 = self.fwd(psi, scan,
+                                    xp.ascontiguousarray(dprb[:, m]),
+                                    out=ws.empty('res1', shape))
+                    p2 = xp.abs(tmp2, out=ws.empty('p2', shape, 'float32'))
+                    p2 *= p2
+                    p3 = cross(tmp1, tmp2, ws.empty('p3', shape, 'float32'))
+                    # line search
+                    gammaprb, _ = self.line_search_sqr_multi(minf, p1, p2, p3)
+                    gammaprb *= 0.5
+                    # update probe; the forward operator is linear in each
+                    # probe mode
+                    probe[:,m] = probe[:,m] + gammaprb * dprb[:,m]
+                    prb_version += 1
+                    tmp2 *= gammaprb
+                    fprbs[:, m] += tmp2
+                    cache.put((psi_version, prb_version), fprbs,
+                              self.intensity(fprbs, out=absfprb))
+                metrics['gradprb'] = gradprbnorm2**0.5
+            metrics['probe'] = lap('probe')
+            metrics['gammapsi'] = float(gammapsi)
+            metrics['gammaprb'] = float(gammaprb)
+            metrics['time'] = sum(
+                metrics[k] for k in ('fwd', 'adj', 'line_search', 'probe'))
+            history.append(metrics)
+            if callback is not None:
+                callback(metrics)
+            if verbose and (np.mod(i, 8) == 0):
+                print("%4d, %.3e, %.3e, %.7e" %
+                      (i, gammapsi, gammaprb, metrics['cost']))
+            # check convergence
+            if (rtol is not None and i > 0 and history[-2]['cost'] -
+                    metrics['cost'] < rtol * abs(history[-2]['cost'])):
+                stop = 'rtol'
+            elif utol is not None and metrics['update'] < utol:
+                stop = 'utol'
+            elif (max_time is not None and
+                  time.perf_counter() - start >= max_time):
+                stop = 'max_time'
+            elif max_failures is not None and failures >= max_failures:
+                stop = 'max_failures'
+            if stop != 'piter':
+                break
+
+        return {
+            'psi': psi,
+            'probe': probe,
+            'history': history,
+            'stop': stop,
+        }
+
+    def _coarse_to_fine(self, data, psi, scan, probe, levels, **kwargs):
+        """Return psi and probe improved by solving at coarser resolutions.
+
+        The coarse grids have an extra pixel, so the coarse patches of scan
+        positions near the edge of the fine grid stay inside the grid. The
+        callback of the kwargs is called with the metrics of each level.
+        """
+        xp = self.array_module
+        scan = self.prepare_scan(scan).scan
+        callback = kwargs.pop('callback', None)
+        for factor, piter in levels:
+
+            def level_callback(metrics, factor=factor):
+                metrics['level'] = factor
+                callback(metrics)
+
+            assert self.ndet % factor == 0, f"{factor} does not divide ndet"
+            assert self.nprb % factor == 0, f"{factor} does not divide nprb"
+            nz = -(-self.nz // factor) + 1
+            n = -(-self.n // factor) + 1
+            fine = xp.pad(psi, ((0, 0), (0, nz * factor - self.nz),
+                                (0, n * factor - self.n)), mode='edge')
+            psi_c = _fourier_resize(xp, fine, (nz, n))
+            probe_c = _fourier_resize(xp, probe, [self.nprb // factor] * 2)
+            # the farplane of the cropped detector is 1 / factor as large
+            k = _spectrum_index(xp, self.ndet // factor, self.ndet)
+            data_c = data[..., k[:, None], k].astype('float32')
+            data_c /= factor**2
+            scan_c = xp.where(xp.trunc(scan) < 0, -1, scan / factor)
+            with self._resized(self.nprb // factor, self.ndet // factor, nz,
+                               n) as coarse:
+                result = coarse.run(
+                    data_c, psi_c.copy(), scan_c.astype('float32'),
+                    probe_c.copy(), piter,
+                    callback=None if callback is None else level_callback,
+                    **kwargs)
+            # upsample the update, so the fine details of psi are kept
+            psi = psi + _fourier_resize(
+                xp, result['psi'] - psi_c, fine.shape[1:])[:, :self.nz, :self.n]
+            if kwargs.get('recover_prb'):
+                probe = probe + _fourier_resize(
+                    xp, result['probe'] - probe_c, probe.shape[2:])
+        return psi, probe
@@ -0,0 +1,347 @@
+"""A module for ptychography solvers which run on the CPU.
+
+This module implements the same forward and adjoint ptychography operators as
+the `muloperator` kernel and the cuFFT plans of `PtychoCuFFT` using NumPy and
+`scipy.fft`. It does not depend on CuPy or the compiled `ptychofft` extension,
+so it can be used on machines without a GPU, and as a reference for the GPU
+engine.
+
+```python
+with CGPtychoNumPySolver(nscan, nprb, ndet, ptheta, nz, n) as solver:
+    result = solver.run_batch(data, psi, scan, probe, piter=piter)
+```
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import scipy.fft
+
+from libtike.cufft.base import PreparedScan, Ptycho
+from libtike.cufft.cg import CGPtycho
+from libtike.cufft.minibatch import MinibatchPtycho
+from libtike.cufft.registry import registry
+from libtike.cufft.trace import traced, tracer
+
+
+class PtychoNumPy(Ptycho):
+    """Base class for ptychography solvers using NumPy and scipy.fft.
+
+    This class is a drop in replacement for `PtychoCuFFT`. The operators match
+    the `muloperator` kernel: bilinear interpolation of the object at subpixel
+    scan positions, skipping of scan positions which are negative, centering
+    the probe in a larger detector, and 1/ndet scaling of the FFTs.
+
+    Attribtues
+    ----------
+    nscan : int
+        The number of scan positions at each angular view.
+    nprb : int
+        The pixel width and height of the probe illumination.
+    ndet, ndet : int
+        The pixel width and height of the detector.
+    ptheta : int
+        The number of angular partitions of the data.
+    n, nz : int
+        The pixel width and height of the reconstructed grid.
+    nmodes : int
+        The number of probe modes of the solver. The `*_modes` operators
+        accept probes of any number of modes, as `PtychoCuFFT` does.
+    workers : int
+        The number of threads used by scipy.fft.
+    """
+
+    array_module = np
+    asnumpy = staticmethod(np.asarray)
+    # the number of scan positions transformed by each scipy.fft call
+    fft_chunk = 256
+
+    def __init__(self, nscan, probe_shape, detector_shape, ntheta, nz, n,
+                 nmodes=1, workers=None):
+        """Please see help(PtychoNumPy) for more info."""
+        self.ptheta = ntheta
+        self.nz = nz
+        self.n = n
+        self.nscan = nscan
+        self.ndet = detector_shape
+        self.nprb = probe_shape
+        self.nmodes = nmodes
+        # the FFT configuration is shared by solvers of the same shape
+        self.key = ('scipy.fft', detector_shape, workers)
+        self.workers = registry.acquire(
+            self.key, lambda: self._plan(detector_shape, workers))
+
+    @staticmethod
+    def _plan(ndet, workers):
+        """Return the number of FFT workers after warming up their plans."""
+        workers = os.cpu_count() if workers is None else workers
+        x = np.zeros([1, ndet, ndet], dtype='complex64')
+        scipy.fft.ifft2(scipy.fft.fft2(x, workers=workers), workers=workers)
+        return workers
+
+    def _resized(self, nprb, ndet, nz, n):
+        """Return a new solver of this class with different sizes."""
+        return type(self)(self.nscan, nprb, ndet, self.ptheta, nz, n,
+                          nmodes=self.nmodes, workers=self.workers)
+
+    def free(self):
+        """Return the FFT configuration to the registry."""
+        if self.key is not None:
+            registry.release(self.key)
+            self.key = None
+        if getattr(self, '_threads', None) is not None:
+            self._threads.shutdown()
+            self._threads = None
+
+    def prepare_scan(self, scan):
+        """Return a PreparedScan with flat gather indices and weights.
+
+        The tables are flat object indices with shape [ptheta, nscan, nprb,
+        nprb] which point to the min corner of the four object pixels used
+        for interpolation, the shifts from that corner to the other three
+        pixels, and the four bilinear weights with shape [ptheta, nscan, 1,
+        1]. The weights of negative scan positions are zero.
+
+        For the adjoint, the valid positions are also split into batches
+        whose patches do not overlap. The positions are binned into tiles
+        of nprb + 1 pixels; positions in tiles of the same parity which have
+        the same rank within their tile never overlap, so each batch can be
+        accumulated into the object without conflicts.
+        """
+        if isinstance(scan, PreparedScan):
+            return scan
+        # modf splits as in the kernel; -0.5 is not a negative position
+        sxf, sx = np.modf(scan[..., 1])
+        syf, sy = np.modf(scan[..., 0])
+        valid = (sx >= 0) & (sy >= 0)
+        sx = np.where(valid, sx, 0).astype(np.intp)
+        sy = np.where(valid, sy, 0).astype(np.intp)
+        sxf = np.where(valid, sxf, 0).astype('float32')
+        syf = np.where(valid, syf, 0).astype('float32')
+        corner = (sx + sy * self.n +
+                  np.arange(self.ptheta)[:, np.newaxis] * self.nz * self.n)
+        i = np.arange(self.nprb)
+        index = (corner[..., np.newaxis, np.newaxis] +
+                 i[np.newaxis, :] + i[:, np.newaxis] * self.n)
+        weights = [
+            (w * valid)[..., np.newaxis, np.newaxis] for w in (
+                (1 - sxf) * (1 - syf),
+                sxf * (1 - syf),
+                (1 - sxf) * syf,
+                sxf * syf,
+            )
+        ]
+        # color the positions by tile parity and rank within their tile
+        tile = self.nprb + 1
+        ty, tx = sy // tile, sx // tile
+        key = ((np.arange(self.ptheta)[:, np.newaxis] *
+                (self.nz // tile + 1) + ty) * (self.n // tile + 1) + tx)
+        positions = np.flatnonzero(valid)
+        bins = np.argsort(key.reshape(-1)[positions], kind='stable')
+        positions = positions[bins]
+        first = np.r_[True, np.diff(key.reshape(-1)[positions]) != 0]
+        rank = np.arange(len(positions))
+        rank -= np.maximum.accumulate(np.where(first, rank, 0))
+        color = rank * 4 + ((ty % 2) * 2 + tx % 2).reshape(-1)[positions]
+        batches = np.argsort(color, kind='stable')
+        positions = positions[batches]
+        color = color[batches]
+        batches = np.split(positions, np.flatnonzero(np.diff(color)) + 1)
+        return PreparedScan(
+            scan,
+            valid,
+            index=index,
+            shifts=(0, 1, self.n, self.n + 1),
+            weights=weights,
+            batches=[b for b in batches if len(b)],
+        )
+
+    def _patches(self, psi, scan):
+        """Interpolate the object at the prepared scan positions."""
+        flat = psi.reshape(-1)
+        patches = np.zeros(scan.index.shape, dtype='complex64')
+        for shift, weight in zip(scan.shifts, scan.weights):
+            # gather from a shifted view instead of shifting the indices
+            patches += weight * flat[shift:][scan.index]
+        return patches
+
+    def _crop(self, nearplane):
+        """Return a view of the probe sized region of the nearplane."""
+        lo = (self.ndet - self.nprb) // 2
+        return nearplane[..., lo:lo + self.nprb, lo:lo + self.nprb]
+
+    def _chunks(self, size=None):
+        """Return slices of at most size (default fft_chunk) scan positions."""
+        size = self.fft_chunk if size is None else size
+        return [
+            slice(j, min(j + size, self.nscan))
+            for j in range(0, self.nscan, size)
+        ]
+
+    @traced()
+    def residual(self, model, farplane, intensity, d, out=None, cost=False):
+        """Return the residual farplane * (1 - d / g(intensity)) of a model.
+
+        The residual and the cost are computed together in blocks of scan
+        positions on `workers` threads, so each block is read once and the
+        temporaries are only block sized. Please see Ptycho.residual.
+        """
+        if out is None:
+            out = np.empty_like(farplane)
+        modes = farplane.ndim > intensity.ndim
+
+        def block(j):
+            ratio = model.ratio(np, intensity[:, j], d[:, j])
+            if modes:
+                np.multiply(farplane[:, :, j], ratio[:, np.newaxis],
+                            out=out[:, :, j])
+            else:
+                np.multiply(farplane[:, j], ratio, out=out[:, j])
+            if cost:
+                return np.sum(model.cost(np, intensity[:, j], d[:, j]),
+                              dtype='float64')
+
+        if getattr(self, '_threads', None) is None:
+            self._threads = ThreadPoolExecutor(self.workers)
+        size = min(self.fft_chunk, -(-self.nscan // self.workers))
+        totals = list(self._threads.map(block, self._chunks(size)))
+        return out, float(sum(totals)) if cost else None
+
+    def _fwd(self, psi, scan, probe, out=None):
+        """Forward operator for probes with shape [ptheta, nmodes, ...]."""
+        scan = self.prepare_scan(scan)
+        nearplane = self._zeros(
+            out,
+            [self.ptheta, probe.shape[1], self.nscan, self.ndet, self.ndet],
+        )
+        # the object is interpolated once for all of the modes
+        self._crop(nearplane)[:] = (
+            np.float32(1 / self.ndet) * probe[:, :, np.newaxis] *
+            self._patches(psi, scan)[:, np.newaxis])
+        # transform in place in chunks, so the FFT temporaries stay small
+        for j in self._chunks():
+            with tracer.span('fft', shape=nearplane[:, :, j].shape):
+                nearplane[:, :, j] = scipy.fft.fft2(
+                    nearplane[:, :, j], norm='backward', workers=self.workers,
+                    overwrite_x=True)
+        return nearplane
+
+    def _ifft_crop(self, farplane, j):
+        """Return the probe sized region of the inverse FFT of a chunk."""
+        # cuFFT does not normalize the inverse transform
+        with tracer.span('ifft', shape=farplane[:, :, j].shape):
+            return self._crop(
+                scipy.fft.ifft2(farplane[:, :, j], norm='forward',
+                                workers=self.workers))
+
+    def _adj(self, farplane, scan, probe, out=None):
+        """Adjoint operator for probes with shape [ptheta, nmodes, ...]."""
+        scan = self.prepare_scan(scan)
+        # the modes are summed before scattering into the object
+        patches = np.empty(scan.index.shape, dtype='complex64')
+        for j in self._chunks():
+            patches[:, j] = np.float32(1 / self.ndet) * np.sum(
+                np.conj(probe[:, :, np.newaxis]) *
+                self._ifft_crop(farplane, j),
+                axis=1,
+            )
+        psi = self._zeros(out, [self.ptheta, self.nz, self.n])
+        flat = psi.reshape(-1)
+        index = scan.index.reshape(-1, self.nprb, self.nprb)
+        patches = patches.reshape(-1, self.nprb, self.nprb)
+        weights = [w.reshape(-1, 1, 1) for w in scan.weights]
+        # patches of a batch do not overlap, so there are no conflicts
+        for batch in scan.batches:
+            for shift, weight in zip(scan.shifts, weights):
+                flat[shift:][index[batch]] += weight[batch] * patches[batch]
+        return psi
+
+    def _adj_probe(self, farplane, scan, psi, out=None):
+        """Adjoint probe operator for farplanes with a modes dimension."""
+        scan = self.prepare_scan(scan)
+        patches = np.conj(self._patches(psi, scan))
+        probe = self._zeros(
+            out, [self.ptheta, farplane.shape[1], self.nprb, self.nprb])
+        for j in self._chunks():
+            probe += np.float32(1 / self.ndet) * np.sum(
+                self._ifft_crop(farplane, j) * patches[:, np.newaxis, j],
+                axis=2,
+            )
+        return probe
+
+    @traced()
+    def fwd(self, psi, scan, probe, out=None):
+        """Ptychography transform (FQ)."""
+        assert psi.dtype == np.complex64, f"{psi.dtype}"
+        assert probe.dtype == np.complex64, f"{probe.dtype}"
+        if out is not None:
+            out = out[:, np.newaxis]
+        return self._fwd(psi, scan, probe[:, np.newaxis], out)[:, 0]
+
+    @traced()
+    def adj(self, farplane, scan, probe, out=None):
+        """Adjoint ptychography transform (Q*F*)."""
+        assert farplane.dtype == np.complex64, f"{farplane.dtype}"
+        assert probe.dtype == np.complex64, f"{probe.dtype}"
+        return self._adj(farplane[:, np.newaxis], scan, probe[:, np.newaxis],
+                         out)
+
+    @traced()
+    def adj_probe(self, farplane, scan, psi, out=None):
+        """Adjoint ptychography probe transform (O*F*), object is fixed."""
+        assert farplane.dtype == np.complex64, f"{farplane.dtype}"
+        assert psi.dtype == np.complex64, f"{psi.dtype}"
+        if out is not None:
+            out = out[:, np.newaxis]
+        return self._adj_probe(farplane[:, np.newaxis], scan, psi, out)[:, 0]
+
+    @traced()
+    def fwd_modes(self, psi, scan, probe, out=None):
+        """Ptychography transform (FQ_k) of all probe modes at once.
+
+        Returns the farplane [ptheta, nmodes, nscan, ndet, ndet] and the
+        intensity sum_k |FQ_k psi|^2 [ptheta, nscan, ndet, ndet]. Both are
+        written into the arrays of the out tuple when it is given.
+        """
+        assert psi.dtype == np.complex64, f"{psi.dtype}"
+        assert probe.dtype == np.complex64, f"{probe.dtype}"
+        farplane, intensity = (None, None) if out is None else out
+        farplane = self._fwd(psi, scan, probe, farplane)
+        return farplane, self.intensity(farplane, intensity)
+
+    def intensity(self, farplane, out=None):
+        """Return the intensity sum_k |farplane_k|^2 of all probe modes.
+
+        The intensity is computed in blocks of scan positions, so the
+        temporaries are only block sized. Please see Ptycho.intensity.
+        """
+        if out is None:
+            out = np.empty([farplane.shape[0], *farplane.shape[2:]],
+                           dtype='float32')
+        for j in self._chunks():
+            np.sum(np.abs(farplane[:, :, j])**2, axis=1, out=out[:, j])
+        return out
+
+    @traced()
+    def adj_modes(self, farplane, scan, probe, out=None):
+        """Adjoint ptychography transform (sum_k Q_k*F*) of all probe modes."""
+        assert farplane.dtype == np.complex64, f"{farplane.dtype}"
+        assert probe.dtype == np.complex64, f"{probe.dtype}"
+        return self._adj(farplane, scan, probe, out)
+
+    @traced()
+    def adj_probe_modes(self, farplane, scan, psi, out=None):
+        """Adjoint ptychography probe transform (O*F*) of all probe modes."""
+        assert farplane.dtype == np.complex64, f"{farplane.dtype}"
+        assert psi.dtype == np.complex64, f"{psi.dtype}"
+        return self._adj_probe(farplane, scan, psi, out)
+
+
+class CGPtychoNumPySolver(CGPtycho, PtychoNumPy):
+    """Solve the ptychography problem using congujate gradient on the CPU."""
+
+
+class MinibatchPtychoNumPySolver(MinibatchPtycho, PtychoNumPy):
+    """Solve the ptychography problem using minibatch updates on the CPU."""
@@ -0,0 +1,203 @@
+"""A module for the stochastic minibatch ptychography solver.
+
+Instead of computing the gradient over all of the scan positions of a view,
+the solver in this module updates the object and the probe after each
+minibatch of positions, so every pass over the data (epoch) makes many
+updates. The engine's operators are sized for one minibatch, which keeps the
+farplane temporaries small no matter how many positions a view has.
+
+```python
+with MinibatchPtychoSolver(batch_size, nprb, ndet, ptheta, nz, n) as solver:
+    result = solver.run_batch(data, psi, scan, probe, piter=nepochs)
+```
+
+"""
+
+import time
+
+import numpy as np
+
+from libtike.cufft.base import Ptycho
+from libtike.cufft.models import get_noise_model
+from libtike.cufft.trace import traced
+
+
+class MinibatchPtycho(Ptycho):
+    """Solve the ptychography problem using stochastic minibatch updates.
+
+    The step sizes of each minibatch are the least squares optimal steps of
+    the object and probe updates for the linearized farplane residual (as in
+    LSQ-ML), so no line search is needed. Like `CGPtycho`, this class only
+    depends on the operators of an engine, and the nscan of the engine is
+    the number of positions in a minibatch.
+    """
+
+    def batches(self, scan, order='random', rng=None):
+        """Return the position indices [ptheta, nscan] of each minibatch.
+
+        Positions are grouped in random order, or in spatially compact groups
+        of neighbors for order='compact'. The last minibatch is padded with
+        -1, and negative positions are always left out.
+        """
+        scan = np.asarray(self.asnumpy(scan))
+        batches = []
+        for view in scan:
+            ids = np.flatnonzero(np.all(np.trunc(view) >= 0, axis=-1))
+            if order == 'random':
+                ids = rng.permutation(ids)
+            elif order == 'compact':
+                # serpentine bands of rows, so consecutive positions are near
+                nbands = max(1, round(np.sqrt(ids.size / self.nscan)))
+                band = np.argsort(np.argsort(view[ids, 0])) * nbands // max(
+                    ids.size, 1)
+                x = np.where(band % 2, -view[ids, 1], view[ids, 1])
+                ids = ids[np.lexsort((x, band))]
+            else:
+                raise ValueError(f"{order} is not one of ['random', 'compact'].")
+            nbatch = -(-ids.size // self.nscan)
+            view_batches = np.full([nbatch * self.nscan], -1)
+            view_batches[:ids.size] = ids
+            batches.append(view_batches.reshape(nbatch, self.nscan))
+        nbatch = max(len(b) for b in batches)
+        return [
+            np.stack([
+                b[k] if k < len(b) else np.full(self.nscan, -1)
+                for b in batches
+            ]) for k in range(nbatch)
+        ]
+
+    @traced()
+    def run(
+            self,
+            data,
+            psi,
+            scan,
+            probe,
+            piter,
+            model='gaussian',
+            recover_prb=False,
+            order='random',
+            step=1.0,
+            seed=0,
+            callback=None,
+            outside=0.0,
+            outside_max=0.0,
+    ):
+        """Minibatch updates for ptychography.
+
+        Parameters
+        ----------
+        data, scan : array
+            The data and scan positions of all positions of the views.
+        piter : int
+            The number of passes over all minibatches (epochs).
+        model : str or NoiseModel
+            The noise model to use for the gradient.
+        recover_prb : bool
+            Whether to recover the probe or assume the given probe is correct.
+        order : str
+            The grouping of positions into minibatches; 'random' groups
+            differ in each epoch, 'compact' groups are spatial neighbors.
+        step : float
+            A relaxation factor of the least squares steps.
+        seed : int
+            The seed of the random minibatches.
+        callback : function(dict)
+            Called after each epoch with the metrics of the epoch.
+        outside, outside_max : float
+            The squared norm and the largest amplitude of the object pixels
+            which are not in psi; they are unused, because the steps of
+            minibatches depend only on the pixels in psi.
+
+        Returns a dict with the new 'psi' and 'probe' and the 'history', a
+        list with the summed 'cost' of the minibatches before their updates
+        and the wall 'time' of each epoch.
+        """
+        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
+        xp = self.array_module
+        ws = self.workspace
+        model = get_noise_model(model)
+        rng = np.random.default_rng(seed)
+        shape = [self.ptheta, self.nscan, self.ndet, self.ndet]
+        shape_modes = [self.ptheta, probe.shape[1], *shape[1:]]
+        dterm = model.data_term(xp, data,
+                                ws.empty('dterm', data.shape, 'float32'))
+        views = xp.arange(self.ptheta)[:, np.newaxis]
+        prepared = {}
+
+        def gather(ids):
+            """Return the prepared scan and data term of a minibatch."""
+            key = ids.tobytes()
+            if key not in prepared:
+                missing = xp.asarray(ids < 0)
+                index = xp.asarray(np.maximum(ids, 0))
+                batch_scan = xp.where(missing[..., np.newaxis], -1,
+                                      scan[views, index])
+                prepared[key] = self.prepare_scan(
+                    batch_scan.astype('float32'))
+            batch_data = ws.empty('data', shape, 'float32')
+            batch_data[:] = dterm[views, xp.asarray(np.maximum(ids, 0))]
+            # padded positions have no data, so add no cost
+            batch_data[xp.asarray(ids < 0)] = 0
+            return prepared[key], batch_data
+
+        history = []
+        for i in range(piter):
+            start = time.perf_counter()
+            if order == 'random':
+                # random minibatches are not reused, so are not cached
+                prepared.clear()
+            cost = 0
+            for ids in self.batches(scan, order, rng):
+                batch_scan, batch_data = gather(ids)
+                farplane, intensity = self.fwd_modes(
+                    psi, batch_scan, probe, out=(
+                        ws.empty('farplane', shape_modes),
+                        ws.empty('intensity', shape, 'float32'),
+                    ))
+                res, batch_cost = self.residual(
+                    model, farplane, intensity, batch_data,
+                    out=ws.empty('res', shape_modes), cost=True)
+                cost += batch_cost
+                dpsi = -self.adj_modes(res, batch_scan, probe)
+                if recover_prb:
+                    dprb = -self.adj_probe_modes(res, batch_scan, psi)
+                    fdprb, _ = self.fwd_modes(psi, batch_scan, dprb, out=(
+                        ws.empty('fdprb', shape_modes),
+                        intensity,
+                    ))
+                fdpsi, _ = self.fwd_modes(dpsi, batch_scan, probe,
+                                          out=(farplane, intensity))
+                # least squares steps minimizing |res + a fdpsi + b fdprb|^2
+                if recover_prb:
+                    # the inner products are moved to the host one by one,
+                    # because numpy cannot convert 0-d device arrays
+                    A = np.array([
+                        [float(xp.vdot(fdpsi, fdpsi).real),
+                         float(xp.vdot(fdpsi, fdprb).real)],
+                        [float(xp.vdot(fdprb, fdpsi).real),
+                         float(xp.vdot(fdprb, fdprb).real)],
+                    ], dtype='float64')
+                    b = -np.array([float(xp.vdot(fdpsi, res).real),
+                                   float(xp.vdot(fdprb, res).real)],
+                                  dtype='float64')
+                    A += 1e-12 * np.trace(A) * np.eye(2) + 1e-32
+                    alpha, beta = np.linalg.solve(A, b)
+                    probe = probe + np.float32(step * beta) * dprb
+                else:
+                    alpha = -float(xp.vdot(fdpsi, res).real) / (
+                        float(xp.vdot(fdpsi, fdpsi).real) + 1e-32)
+                psi = psi + np.float32(step * alpha) * dpsi
+            metrics = {
+                'iteration': i,
+                'cost': float(cost),
+                'time': time.perf_counter() - start,
+            }
+            history.append(metrics)
+            if callback is not None:
+                callback(metrics)
+        return {
+            'psi': psi,
+            'probe': probe,
+            'history': history,
+        }
@@ -0,0 +1,101 @@
+"""A module for the noise models of the measured diffraction intensities.
+
+A noise model defines the cost of the intensities of the current estimate
+given the measured data, and the residual which the gradient of that cost
+back propagates. The residual of every model has the form
+
+    farplane * (1 - d / g(intensity))
+
+where d is a data term computed once per partition, so engines evaluate it in
+one fused elementwise pass (`Ptycho.residual`). New noise models subclass
+`NoiseModel`, implement its array functions and CUDA expressions, and are
+either passed to `CGPtycho.run` directly or added to `noise_models`.
+
+"""
+
+import numpy as np
+
+
+class NoiseModel(object):
+    """Base class for the noise models of `CGPtycho.run`.
+
+    The array functions take the array module xp, so the same model runs on
+    every engine. The CUDA expressions of the intensity I and the data term d
+    (both float) are used by the fused kernels of GPU engines.
+
+    Attribtues
+    ----------
+    name : str
+        The unique name of the model, which must be a C identifier.
+    ratio_cuda : str
+        A CUDA expression of 1 - d / g(I).
+    cost_cuda : str
+        A CUDA expression of the cost of I.
+    """
+
+    name = None
+    ratio_cuda = None
+    cost_cuda = None
+
+    def data_term(self, xp, data, out):
+        """Return the data term d of the data in the float32 array out."""
+        out[:] = data
+        return out
+
+    def ratio(self, xp, intensity, d, out=None):
+        """Return 1 - d / g(intensity), the scale of the farplane residual."""
+        raise NotImplementedError("Cannot scale with a base class.")
+
+    def cost(self, xp, intensity, d):
+        """Return the cost of each intensity."""
+        raise NotImplementedError("Cannot compute the cost of a base class.")
+
+
+class Gaussian(NoiseModel):
+    """Gaussian noise of the amplitudes; d is the square root of the data."""
+
+    name = 'gaussian'
+    ratio_cuda = '1 - d / (sqrt(I) + 1e-32f)'
+    cost_cuda = '(sqrt(fabsf(I)) - d) * (sqrt(fabsf(I)) - d)'
+
+    def data_term(self, xp, data, out):
+        out[:] = data
+        return xp.sqrt(out, out=out)
+
+    def ratio(self, xp, intensity, d, out=None):
+        out = xp.sqrt(intensity, out=out)
+        out += np.float32(1e-32)
+        xp.divide(d, out, out=out)
+        return xp.subtract(1, out, out=out)
+
+    def cost(self, xp, intensity, d):
+        return (xp.sqrt(xp.abs(intensity)) - d)**2
+
+
+class Poisson(NoiseModel):
+    """Poisson noise of the intensities; d is the data."""
+
+    name = 'poisson'
+    ratio_cuda = '1 - d / (I + 1e-32f)'
+    cost_cuda = 'fabsf(I) - d * logf(fabsf(I) + 1e-32f)'
+
+    def ratio(self, xp, intensity, d, out=None):
+        out = xp.add(intensity, np.float32(1e-32), out=out)
+        xp.divide(d, out, out=out)
+        return xp.subtract(1, out, out=out)
+
+    def cost(self, xp, intensity, d):
+        return xp.abs(intensity) - d * xp.log(xp.abs(intensity) + 1e-32)
+
+
+# the noise models which may be chosen by name
+noise_models = {model.name: model for model in (Gaussian(), Poisson())}
+
+
+def get_noise_model(model):
+    """Return the NoiseModel called model, or model if it is one."""
+    if isinstance(model, NoiseModel):
+        return model
+    if model not in noise_models:
+        raise ValueError(f"{model} is not one of {list(noise_models)}.")
+    return noise_models[model]
@@ -0,0 +1,249 @@
+"""A module for solving angles which have different numbers of positions.
+
+In the packed layout, the valid positions of all angles are stored end to
+end, and offsets [ntheta + 1] mark where the positions of each angle start,
+so the data [npositions, ndet, ndet] contain no padding patterns. `pack`
+converts the padded layout to the packed one.
+
+The engines transform views of [ptheta, nscan] positions, so a group of
+consecutive angles is solved as a single view instead: the objects of the
+group are stacked vertically into one tall object, and the positions of each
+angle are shifted down to its object. Patches never cross from one object
+into the next, so this is the same problem as solving the angles separately,
+but only the last few positions of a group are padding. The data of a group
+are one contiguous slice of the packed data. The probe of a view is shared
+by all of its positions, so only consecutive angles with the same probe are
+grouped.
+
+```python
+offsets, scan, data = pack(scan, data)
+with PackedPtycho(CGPtychoSolver, nprb, ndet, ptheta, nz, n) as packed:
+    result = packed.run_batch(data, psi, scan, probe, offsets, piter=piter)
+```
+
+"""
+
+import numpy as np
+
+
+def pack(scan, *arrays):
+    """Return the offsets and the packed scan and arrays of a padded layout.
+
+    Negative positions of the scan [ntheta, nscan, 2] are dropped, and so are
+    the same entries of the arrays, e.g. the data [ntheta, nscan, ...].
+    """
+    valid = np.all(np.trunc(scan) >= 0, axis=-1)
+    offsets = np.concatenate([[0], np.cumsum(np.sum(valid, axis=1))])
+    return (offsets, scan[valid], *(np.asarray(x)[valid] for x in arrays))
+
+
+class PackedPtycho(object):
+    """Solve groups of angles of a packed layout with one solver.
+
+    This class is a context manager. The angles are grouped in order, so
+    that a group has at most ptheta angles, at most nscan positions, and
+    angles with the same probe.
+
+    Parameters
+    ----------
+    cls : type
+        The solver class, e.g. `CGPtychoSolver` or `CGPtychoNumPySolver`.
+    probe_shape, detector_shape, ptheta, nz, n, nmodes
+        The sizes as for the solver class.
+    nscan : int
+        The number of positions of a group. By default, the largest of the
+        mean number of positions of ptheta angles and the positions of any
+        one angle.
+    kwargs : dict
+        Other keyword arguments of the solver's constructor.
+    """
+
+    def __init__(self, cls, probe_shape, detector_shape, ptheta, nz, n,
+                 nscan=None, nmodes=1, **kwargs):
+        """Please see help(PackedPtycho) for more info."""
+        self.cls = cls
+        self.nprb = probe_shape
+        self.ndet = detector_shape
+        self.ptheta = ptheta
+        self.nz = nz
+        self.n = n
+        self.nscan = nscan
+        self.nmodes = nmodes
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        """Return self at start of a with-block."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Nothing to free; the solver only lives during each call."""
+        pass
+
+    def plan(self, offsets, probe=None, ptheta=None):
+        """Return the number of positions of a group and its angle slices.
+
+        When the probes [ntheta, ...] are given, a group only has angles
+        whose probes are equal. A group has at most ptheta angles, by default
+        the ptheta of this instance.
+        """
+        ptheta = self.ptheta if ptheta is None else ptheta
+        counts = np.diff(offsets)
+        nscan = self.nscan
+        if nscan is None:
+            nscan = max(int(np.max(counts, initial=1)),
+                        int(np.ceil(np.mean(counts) * ptheta)))
+        assert np.all(counts <= nscan), f"An angle has over {nscan} positions."
+        groups = []
+        start = 0
+        for t in range(1, len(counts) + 1):
+            if (t == len(counts) or t - start == ptheta or
+                    offsets[t + 1] - offsets[start] > nscan or
+                (probe is not None and
+                 not np.array_equal(probe[t], probe[start]))):
+                groups.append(slice(start, t))
+                start = t
+        return nscan, groups
+
+    def _solver(self, nscan, ptheta):
+        """Return a solver of groups of ptheta angles."""
+        return self.cls(nscan, self.nprb, self.ndet, 1, ptheta * self.nz,
+                        self.n, nmodes=self.nmodes, **self.kwargs)
+
+    def _scan(self, scan, offsets, ids, nscan):
+        """Return the scan [1, nscan, 2] of a group on its tall object."""
+        positions = slice(offsets[ids.start], offsets[ids.stop])
+        count = positions.stop - positions.start
+        # the positions are shifted down to the object of their angle
+        group_scan = np.full([1, nscan, 2], -1, dtype='float32')
+        group_scan[0, :count] = scan[positions]
+        group_scan[0, :count, 0] += self.nz * (np.repeat(
+            np.arange(ids.stop - ids.start),
+            np.diff(offsets[ids.start:ids.stop + 1])))
+        return group_scan
+
+    def _gather(self, packed, offsets, ids, nscan, dtype):
+        """Return the packed data [1, nscan, ...] of a group with padding."""
+        positions = slice(offsets[ids.start], offsets[ids.stop])
+        group = np.zeros([1, nscan, *packed.shape[1:]], dtype=dtype)
+        group[0, :positions.stop - positions.start] = packed[positions]
+        return group
+
+    def _tall(self, psi, ids, ptheta):
+        """Return the tall object [1, ptheta * nz, n] of a group."""
+        tall = np.zeros([1, ptheta * self.nz, self.n], dtype='complex64')
+        tall[0, :(ids.stop - ids.start) * self.nz] = psi[ids].reshape(
+            -1, self.n)
+        return tall
+
+    def _split(self, tall, ids):
+        """Return the objects [nangles, nz, n] of a tall object."""
+        return tall[0, :(ids.stop - ids.start) * self.nz].reshape(
+            -1, self.nz, self.n)
+
+    def run_batch(self, data, psi, scan, probe, offsets, **kwargs):
+        """Run the solver on each group of angles.
+
+        Parameters
+        ----------
+        data, scan : array
+            The packed data [npositions, ndet, ndet] and scan [npositions, 2].
+        psi, probe : array
+            The objects [ntheta, nz, n] and probes [ntheta, nmodes, nprb,
+            nprb] of the angles.
+        offsets : array
+            The first position of each angle and the number of positions.
+
+        The remaining kwargs are passed to the run method of the solver. The
+        'history' and 'stop' of the result list those of each group. When
+        the probe is recovered, the probe of a group is written to all of its
+        angles.
+        """
+        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
+        offsets = np.asarray(offsets)
+        nscan, groups = self.plan(offsets, probe)
+        psi = np.array(psi)
+        probe = np.array(probe)
+        out = {'psi': psi, 'probe': probe, 'history': [], 'stop': []}
+        with self._solver(nscan, self.ptheta) as slv:
+            xp = slv.array_module
+            for ids in groups:
+                result = slv.run(
+                    xp.asarray(
+                        self._gather(data, offsets, ids, nscan, data.dtype)),
+                    xp.asarray(self._tall(psi, ids, self.ptheta)),
+                    xp.asarray(self._scan(scan, offsets, ids, nscan)),
+                    xp.asarray(probe[ids.start:ids.start + 1]),
+                    **kwargs,
+                )
+                psi[ids] = self._split(slv.asnumpy(result['psi']), ids)
+                probe[ids] = slv.asnumpy(result['probe'])
+                for key in ('history', 'stop'):
+                    if key in result:
+                        out[key].append(result[key])
+        return out
+
+    def fwd_ptycho_batch(self, psi, scan, probe, offsets):
+        """Batch of Ptychography transform (FQ) of a packed layout.
+
+        Returns the packed farplane [npositions, ndet, ndet] of the objects
+        [ntheta, nz, n] and the probes [ntheta, nprb, nprb].
+        """
+        offsets = np.asarray(offsets)
+        nscan, groups = self.plan(offsets, probe)
+        out = np.empty([offsets[-1], self.ndet, self.ndet], dtype='complex64')
+        with self._solver(nscan, self.ptheta) as slv:
+            xp = slv.array_module
+            for ids in groups:
+                farplane = slv.asnumpy(slv.fwd(
+                    xp.asarray(self._tall(psi, ids, self.ptheta)),
+                    xp.asarray(self._scan(scan, offsets, ids, nscan)),
+                    xp.asarray(probe[ids.start:ids.start + 1]),
+                ))
+                out[offsets[ids.start]:offsets[ids.stop]] = farplane[
+                    0, :offsets[ids.stop] - offsets[ids.start]]
+        return out
+
+    def adj_ptycho_batch(self, farplane, scan, probe, offsets):
+        """Batch of adjoint ptychography transform (Q*F*) of a packed layout.
+
+        Returns the objects [ntheta, nz, n] of the packed farplane
+        [npositions, ndet, ndet] and the probes [ntheta, nprb, nprb].
+        """
+        offsets = np.asarray(offsets)
+        nscan, groups = self.plan(offsets, probe)
+        out = np.empty([len(offsets) - 1, self.nz, self.n], dtype='complex64')
+        with self._solver(nscan, self.ptheta) as slv:
+            xp = slv.array_module
+            for ids in groups:
+                tall = slv.asnumpy(slv.adj(
+                    xp.asarray(self._gather(farplane, offsets, ids, nscan,
+                                            'complex64')),
+                    xp.asarray(self._scan(scan, offsets, ids, nscan)),
+                    xp.asarray(probe[ids.start:ids.start + 1]),
+                ))
+                out[ids] = self._split(tall, ids)
+        return out
+
+    def adj_ptycho_batch_prb(self, farplane, scan, psi, offsets):
+        """Batch of adjoint ptychography probe transform (O*F*) of a packed
+        layout.
+
+        Returns the probes [ntheta, nprb, nprb] of the packed farplane
+        [npositions, ndet, ndet] and the objects [ntheta, nz, n]. The probe
+        of a view sums over all of its positions, so each angle is its own
+        view.
+        """
+        offsets = np.asarray(offsets)
+        nscan, groups = self.plan(offsets, ptheta=1)
+        out = np.empty([len(offsets) - 1, self.nprb, self.nprb],
+                       dtype='complex64')
+        with self._solver(nscan, 1) as slv:
+            xp = slv.array_module
+            for ids in groups:
+                out[ids] = slv.asnumpy(slv.adj_probe(
+                    xp.asarray(self._gather(farplane, offsets, ids, nscan,
+                                            'complex64')),
+                    xp.asarray(self._scan(scan, offsets, ids, nscan)),
+                    xp.asarray(self._tall(psi, ids, 1)),
+                ))
+        return out
@@ -0,0 +1,226 @@
+"""A module for solving angle partitions in parallel on many devices.
+
+Angle partitions of `run_batch` are independent, so they may be solved at the
+same time by a pool of worker processes, each of which owns one solver
+instance (e.g. one `CGPtychoSolver` per GPU, or one `CGPtychoNumPySolver` per
+CPU worker). The inputs and results are kept in shared memory, so only the
+indices of a partition are sent to the workers.
+
+```python
+with ParallelPtycho(CGPtychoSolver, (nscan, nprb, ndet, ptheta, nz, n),
+                    devices=[0, 1, 2, 3]) as pool:
+    result = pool.run_batch(data, psi, scan, probe, piter=piter)
+```
+
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import sys
+import warnings
+
+import numpy as np
+
+from libtike.cufft.base import roi
+
+# the solver instance owned by a worker process
+_solver = None
+
+
+def _attach(name):
+    """Return the shared memory block called name without tracking it.
+
+    Spawned workers share the resource tracker of the parent, which tracks
+    the block since it created it; registering or unregistering it again
+    here would undo the parent's registration.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedArray(object):
+    """A numpy array in shared memory which can be attached by name."""
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = _attach(name)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def copy(cls, array):
+        """Return a shared array initialized with a copy of array."""
+        shared = cls(array.shape, array.dtype)
+        shared.array[:] = array
+        return shared
+
+    def __reduce__(self):
+        """Pickle by name, so attaching does not copy the array."""
+        return (type(self), (self.shape, self.dtype, self.shm.name))
+
+    def close(self, unlink=False):
+        """Detach from the shared memory and optionally free it."""
+        self.array = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _init_worker(cls, args, kwargs, devices):
+    """Create the solver of a worker process on the next free device."""
+    global _solver
+    cls.use_device(devices.get())
+    _solver = cls(*args, **kwargs).__enter__()
+
+
+def _solve(ids, data, psi, scan, probe, kwargs):
+    """Solve one partition of the shared arrays with the worker's solver."""
+    try:
+        result = _solver.run_batch(
+            data.array[ids],
+            psi.array[ids],
+            scan.array[ids],
+            probe.array[ids],
+            **kwargs,
+        )
+        psi.array[ids] = result['psi']
+        probe.array[ids] = result['probe']
+    finally:
+        for x in (data, psi, scan, probe):
+            x.close()
+    # the lists of the partition's run_batch, which has one entry each
+    return {key: result[key] for key in ('history', 'stop') if key in result}
+
+
+class ParallelPtycho(object):
+    """Solve angle partitions on a pool of worker processes.
+
+    This class is a context manager. Each worker process owns one solver
+    instance which is created once and reused for all of the partitions
+    which the worker solves.
+
+    Parameters
+    ----------
+    cls : type
+        The solver class, e.g. `CGPtychoSolver` or `CGPtychoNumPySolver`.
+    args : tuple
+        The positional arguments of the solver's constructor.
+    kwargs : dict
+        The keyword arguments of the solver's constructor.
+    devices : list
+        The device of each worker; one worker process is started per item.
+        Use None items for engines which do not have devices.
+    retries : int
+        The number of times a failed partition is resubmitted. Partitions
+        are also resubmitted to a new pool if a worker process dies.
+    """
+
+    def __init__(self, cls, args, kwargs=None, devices=(None,), retries=1):
+        """Please see help(ParallelPtycho) for more info."""
+        self.cls = cls
+        self.args = tuple(args)
+        self.kwargs = {} if kwargs is None else dict(kwargs)
+        self.devices = list(devices)
+        self.retries = retries
+        self.ptheta = args[3]
+        self.context = multiprocessing.get_context('spawn')
+        self.pool = None
+
+    def __enter__(self):
+        """Return self at start of a with-block."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Stop the worker processes at interruptions or with-block exit."""
+        self.free()
+
+    def _start(self):
+        """Start a pool with one worker process per device."""
+        devices = self.context.Queue()
+        for device in self.devices:
+            devices.put(device)
+        self.pool = ProcessPoolExecutor(
+            max_workers=len(self.devices),
+            mp_context=self.context,
+            initializer=_init_worker,
+            initargs=(self.cls, self.args, self.kwargs, devices),
+        )
+
+    def free(self):
+        """Stop the worker processes."""
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def run_batch(self, data, psi, scan, probe, **kwargs):
+        """Run by dividing the work into batches solved by the workers.
+
+        The partitions are the same as in `Ptycho.run_batch`, so the result
+        is the same as solving with a single solver instance. As there, the
+        'history' and 'stop' of the result list those of each partition in
+        order when the solver returns them.
+        """
+        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
+        crop = kwargs.pop('crop', True)
+        if crop is True:
+            crop = roi(scan, self.args[1], *self.args[4:6])
+        shared = [SharedArray.copy(x) for x in (data, psi, scan, probe)]
+        try:
+            todo = {
+                k: np.arange(k, min(k + self.ptheta, scan.shape[0]))
+                for k in range(0, scan.shape[0], self.ptheta)
+            }
+            attempts = dict.fromkeys(todo, 0)
+            reports = {}
+            while todo:
+                if self.pool is None:
+                    self._start()
+                # the crops of all partitions have the same shape, as they
+                # do for a single solver instance
+                futures = {
+                    k: self.pool.submit(
+                        _solve, ids, *shared,
+                        dict(kwargs, crop=crop and (crop[0][ids], crop[1])))
+                    for k, ids in todo.items()
+                }
+                for k, future in futures.items():
+                    try:
+                        reports[k] = future.result()
+                    except BrokenProcessPool as e:
+                        # a worker died; restart the pool for the remainder
+                        self.free()
+                        error = e
+                    except Exception as e:
+                        error = e
+                    else:
+                        del todo[k]
+                        continue
+                    attempts[k] += 1
+                    if attempts[k] > self.retries:
+                        raise RuntimeError(
+                            f"Angle partition {k} failed {attempts[k]} times."
+                        ) from error
+                    warnings.warn(f"Retrying angle partition {k}: {error!r}")
+            out = {
+                'psi': shared[1].array.copy(),
+                'probe': shared[3].array.copy(),
+            }
+            for k in sorted(reports):
+                for key, value in reports[k].items():
+                    out.setdefault(key, []).extend(value)
+            return out
+        finally:
+            for x in shared:
+                x.close(unlink=True)
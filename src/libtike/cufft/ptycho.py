@@ -14,30 +14,52 @@ data = cp.load(...)
 with CustomPtychoSolver(...) as solver:
     # call the solver with solver specific parameters
     result = solver.run(data, ...)
-# solver memory is automatically freed at with-block exit
+# the work arrays of the solver are freed at with-block exit
 ```
 
 Context managers are capable of gracefully handling interruptions (CTRL+C).
 
-"""
+The FFT plans and scratch memory of the engines are shared through
+`registry`, so they stay on the device as idle after the with-block exits,
+for the next solver of the same shape, until the idle resources exceed
+`registry.capacity`. Call `registry.clear()` to free all idle plans, e.g.
+before allocating other large arrays on the device.
 
-import signal
-import sys
-import warnings
+"""
 
 import cupy as cp
-import numpy as np
 
+from libtike.cufft.base import Ptycho
+from libtike.cufft.cg import CGPtycho
+from libtike.cufft.minibatch import MinibatchPtycho
 from libtike.cufft.ptychofft import ptychofft
-
-
-class PtychoCuFFT(ptychofft):
+from libtike.cufft.registry import registry
+from libtike.cufft.trace import traced
+
+# sum_k |farplane_k|^2 over the modes axis in one pass
+_intensity = cp.ReductionKernel(
+    'T farplane',
+    'float32 intensity',
+    'real(farplane) * real(farplane) + imag(farplane) * imag(farplane)',
+    'a + b',
+    'intensity = a',
+    '0',
+    'intensity',
+)
+
+
+class PtychoCuFFT(Ptycho):
     """Base class for ptychography solvers using the cuFFT library.
 
     This class is a context manager which provides the basic operators required
     to implement a ptychography solver. It also manages memory automatically,
     and provides correct cleanup for interruptions or terminations.
 
+    The cuFFT plans and the FFT buffer are held by a `ptychofft` instance
+    which is shared with all other solvers of the same shape on the same
+    device through `libtike.cufft.registry`. Solvers which share plans must
+    not be used from different threads at the same time.
+
     Attribtues
     ----------
     nscan : int
@@ -50,313 +72,252 @@ class PtychoCuFFT(ptychofft):
         The number of angular partitions of the data.
     n, nz : int
         The pixel width and height of the reconstructed grid.
+    nmodes : int
+        The number of probe modes whose plans are made at construction. The
+        `*_modes` operators accept any number of modes; the plans of other
+        numbers are made when first used.
+    device : int
+        The CUDA device which was current when the solver was made.
+    streams : dict
+        The non-blocking 'stage' and 'drain' streams of the device, which
+        copy the partitions of `run_batch` while another one is solved.
     """
 
     array_module = cp
-    asnumpy = cp.asnumpy
-
-    def __init__(self, nscan, probe_shape, detector_shape, ntheta, nz, n):
+    asnumpy = staticmethod(cp.asnumpy)
+    # small blocks would make thousands of kernel launches per line search
+    line_search_block = None
+    # the fused residual and cost kernels of each noise model
+    _kernels = {}
+
+    def __init__(self, nscan, probe_shape, detector_shape, ntheta, nz, n,
+                 nmodes=1):
         """Please see help(PtychoCuFFT) for more info."""
-        super().__init__(ntheta, nz, n, nscan, detector_shape, probe_shape)
-
-    def __enter__(self):
-        """Return self at start of a with-block."""
-        return self
-
-    def __exit__(self, type, value, traceback):
-        """Free GPU memory due at interruptions or with-block exit."""
-        self.free()
-
-    @classmethod
-    def _batch(self, function, output, *inputs):
-        """Does data shuffle between host and device."""
-        xp = self.array_module
-        # TODO: handle the case when ptheta does not divide ntheta evenly
-        for ids in range(0, inputs[0].shape[0]):
-            inputs_gpu = [xp.array(x[ids:ids+1]) for x in inputs]
-            output[ids] = function(*inputs_gpu).get()
-        return output
-
-    def fwd(self, psi, scan, probe):
+        self.ptheta = ntheta
+        self.nz = nz
+        self.n = n
+        self.nscan = nscan
+        self.ndet = detector_shape
+        self.nprb = probe_shape
+        self.nmodes = nmodes
+        # the device of the solver; helper threads must make it current
+        self.device = cp.cuda.Device().id
+        # one stream per direction is reused by all partitions
+        self.streams = {
+            'stage': cp.cuda.Stream(non_blocking=True),
+            'drain': cp.cuda.Stream(non_blocking=True),
+        }
+        # the plans and their registry keys of each number of modes used
+        self.engines = {}
+        self.keys = {}
+        self.engine = self._engine(nmodes)
+        self.key = self.keys[nmodes]
+
+    def _engine(self, nmodes):
+        """Return the ptychofft instance for probes of nmodes modes.
+
+        The plans of the nmodes of the constructor are acquired at once, and
+        the plans of other numbers of modes when they are first used.
+        """
+        if nmodes not in self.engines:
+            key = ('cufft', self.device, self.ptheta, self.nz, self.n,
+                   self.nscan, self.ndet, self.nprb, nmodes)
+            self.engines[nmodes] = registry.acquire(
+                key,
+                lambda: ptychofft(self.ptheta, self.nz, self.n, self.nscan,
+                                  self.ndet, self.nprb, nmodes),
+                # the FFT buffer and about as much plan work area
+                nbytes=2 * self.ptheta * nmodes * self.nscan * self.ndet**2 *
+                8,
+                close=ptychofft.free,
+            )
+            self.keys[nmodes] = key
+        return self.engines[nmodes]
+
+    def free(self):
+        """Return the shared plans of this solver to the registry."""
+        if self.engine is not None:
+            self.engine = None
+            self.engines = {}
+            for key in self.keys.values():
+                registry.release(key)
+            self.keys = {}
+
+    @staticmethod
+    def use_device(device):
+        """Make device the current CUDA device of this process or thread."""
+        if device is not None:
+            cp.cuda.Device(device).use()
+
+    @traced('stage')
+    def _stage(self, *arrays):
+        """Copy host arrays to the device on a separate stream."""
+        # the current device is per thread, and this may run on a helper
+        with cp.cuda.Device(self.device):
+            stream = self.streams['stage']
+            with stream:
+                arrays = [cp.array(x) for x in arrays]
+            stream.synchronize()
+        return arrays
+
+    def _ready(self):
+        """Return an event recorded after the work queued so far."""
+        return cp.cuda.get_current_stream().record()
+
+    def synchronize(self):
+        """Wait until the work queued on the current stream is complete."""
+        cp.cuda.get_current_stream().synchronize()
+
+    @traced('drain')
+    def _drain(self, arrays, ready=None):
+        """Copy device arrays to the host on a separate stream."""
+        with cp.cuda.Device(self.device):
+            stream = self.streams['drain']
+            if ready is not None:
+                stream.wait_event(ready)
+            arrays = [x.get(stream=stream) for x in arrays]
+            stream.synchronize()
+        return arrays
+
+    @traced(gpu=True)
+    def residual(self, model, farplane, intensity, d, out=None, cost=False):
+        """Return the residual farplane * (1 - d / g(intensity)) of a model.
+
+        The residual is one elementwise kernel, and the cost is one reduction
+        kernel, made from the CUDA expressions of the model. Please see
+        Ptycho.residual.
+        """
+        if model.name not in self._kernels:
+            self._kernels[model.name] = (
+                cp.ElementwiseKernel(
+                    'T farplane, float32 I, float32 d',
+                    'T out',
+                    f'out = farplane * ({model.ratio_cuda})',
+                    f'residual_{model.name}',
+                ),
+                cp.ReductionKernel(
+                    'float32 I, float32 d',
+                    'float64 cost',
+                    f'{model.cost_cuda}',
+                    'a + b',
+                    'cost = a',
+                    '0',
+                    f'cost_{model.name}',
+                ),
+            )
+        residual, reduction = self._kernels[model.name]
+        total = float(reduction(intensity, d)) if cost else None
+        if farplane.ndim > intensity.ndim:
+            intensity = intensity[:, cp.newaxis]
+            d = d[:, cp.newaxis]
+        return residual(farplane, intensity, d, out), total
+
+    @traced(gpu=True)
+    def fwd(self, psi, scan, probe, out=None):
         """Ptychography transform (FQ)."""
         assert psi.dtype == cp.complex64, f"{psi.dtype}"
-        assert scan.dtype == cp.float32, f"{scan.dtype}"
+        scan = self.prepare_scan(scan)
         assert probe.dtype == cp.complex64, f"{probe.dtype}"
-        farplane = cp.zeros([self.ptheta, self.nscan, self.ndet, self.ndet],
-                            dtype='complex64')
-        ptychofft.fwd(self, farplane.data.ptr, psi.data.ptr,
-                      scan.data.ptr, probe.data.ptr)
+        # the kernels read the probe of each angle densely, e.g. not the
+        # strided view of one mode of several
+        probe = cp.ascontiguousarray(probe)
+        farplane = out
+        if farplane is None:
+            # every element is written by the FFT, so it is not zeroed
+            farplane = cp.empty(
+                [self.ptheta, self.nscan, self.ndet, self.ndet],
+                dtype='complex64')
+        self.engine.fwd(farplane.data.ptr, psi.data.ptr,
+                        scan.scan.data.ptr, probe.data.ptr)
         return farplane
 
-    def fwd_ptycho_batch(self, psi, scan, probe):
-        """Batch of Ptychography transform (FQ)."""
-        data = np.zeros([scan.shape[0], self.nscan, self.ndet, self.ndet],
-                        dtype='complex64')
-        return self._batch(self.fwd, data, psi, scan, probe)
-
-    def adj(self, farplane, scan, probe):
+    @traced(gpu=True)
+    def adj(self, farplane, scan, probe, out=None):
         """Adjoint ptychography transform (Q*F*)."""
         assert farplane.dtype == cp.complex64, f"{farplane.dtype}"
-        assert scan.dtype == cp.float32, f"{scan.dtype}"
+        scan = self.prepare_scan(scan)
         assert probe.dtype == cp.complex64, f"{probe.dtype}"
-        psi = cp.zeros([self.ptheta, self.nz, self.n], dtype='complex64')
+        probe = cp.ascontiguousarray(probe)
+        psi = self._zeros(out, [self.ptheta, self.nz, self.n])
         flg = 0  # compute adjoint operator with respect to object
-        ptychofft.adj(self, psi.data.ptr, farplane.data.ptr,
-                      scan.data.ptr, probe.data.ptr, flg)
+        self.engine.adj(psi.data.ptr, farplane.data.ptr,
+                        scan.scan.data.ptr, probe.data.ptr, flg)
         return psi
 
-    def adj_ptycho_batch(self, farplane, scan, probe):
-        """Batch of Ptychography transform (FQ)."""
-        psi = np.zeros([scan.shape[0], self.nz, self.n], dtype='complex64')
-        return self._batch(self.adj, psi, farplane, scan, probe)
-
-    def adj_probe(self, farplane, scan, psi):
+    @traced(gpu=True)
+    def adj_probe(self, farplane, scan, psi, out=None):
         """Adjoint ptychography probe transform (O*F*), object is fixed."""
         assert farplane.dtype == cp.complex64, f"{farplane.dtype}"
-        assert scan.dtype == cp.float32, f"{scan.dtype}"
+        scan = self.prepare_scan(scan)
         assert psi.dtype == cp.complex64, f"{psi.dtype}"
-        probe = cp.zeros([self.ptheta, self.nprb, self.nprb],
-                         dtype='complex64')
+        probe = self._zeros(out, [self.ptheta, self.nprb, self.nprb])
         flg = 1  # compute adjoint operator with respect to probe
-        ptychofft.adj(self, psi.data.ptr, farplane.data.ptr,
-                      scan.data.ptr, probe.data.ptr, flg)
+        self.engine.adj(psi.data.ptr, farplane.data.ptr,
+                        scan.scan.data.ptr, probe.data.ptr, flg)
         return probe
 
-    def adj_ptycho_batch_prb(self, farplane, scan, psi):
-        """Batch of Ptychography transform (FQ)."""
-        probe = np.zeros(
-            [scan.shape[0], self.nprb, self.nprb], dtype='complex64')
-        return self._batch(self.adj_probe, probe, farplane, scan, psi)
-
-    def run(self, data, psi, scan, probe, **kwargs):
-        """Placehold for a child's solving function."""
-        raise NotImplementedError("Cannot run a base class.")
-
-    def run_batch(self, data, psi, scan, probe, **kwargs):
-        """Run by dividing the work into batches."""
-        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
-
-        psi = psi.copy()
-        probe = probe.copy()
-
-        # angle partitions in ptychography
-        for k in range(0, scan.shape[0] // self.ptheta):
-            ids = np.arange(k * self.ptheta, (k + 1) * self.ptheta)
-            # copy to GPU
-            psi_gpu = cp.array(psi[ids])
-            scan_gpu = cp.array(scan[ids])
-            prb_gpu = cp.array(probe[ids])
-            data_gpu = cp.array(data[ids])
-            # solve cg ptychography problem for the part
-            result = self.run(
-                data_gpu,
-                psi_gpu,
-                scan_gpu,
-                prb_gpu,
-                **kwargs,
-            )
-            psi[ids], probe[ids] = result['psi'].get(), result['probe'].get()
-        return {
-            'psi': psi,
-            'probe': probe,
-        }
+    @traced(gpu=True)
+    def fwd_modes(self, psi, scan, probe, out=None):
+        """Ptychography transform (FQ_k) of all probe modes at once.
 
+        Returns the farplane [ptheta, nmodes, nscan, ndet, ndet] and the
+        intensity sum_k |FQ_k psi|^2 [ptheta, nscan, ndet, ndet]. Both are
+        written into the arrays of the out tuple when it is given.
+        """
+        assert psi.dtype == cp.complex64, f"{psi.dtype}"
+        scan = self.prepare_scan(scan)
+        assert probe.dtype == cp.complex64, f"{probe.dtype}"
+        farplane, intensity = (None, None) if out is None else out
+        if farplane is None:
+            farplane = cp.empty(
+                [self.ptheta, probe.shape[1], self.nscan, self.ndet,
+                 self.ndet],
+                dtype='complex64')
+        engine = self._engine(probe.shape[1])
+        engine.fwd_modes(farplane.data.ptr, psi.data.ptr, scan.scan.data.ptr,
+                         probe.data.ptr)
+        return farplane, self.intensity(farplane, out=intensity)
+
+    @traced(gpu=True)
+    def intensity(self, farplane, out=None):
+        """Return the intensity sum_k |farplane_k|^2 of all probe modes.
+
+        The intensity is one reduction kernel over the modes, which makes no
+        temporaries. Please see Ptycho.intensity.
+        """
+        return _intensity(farplane, axis=1, out=out)
+
+    @traced(gpu=True)
+    def adj_modes(self, farplane, scan, probe, out=None):
+        """Adjoint ptychography transform (sum_k Q_k*F*) of all probe modes."""
+        assert farplane.dtype == cp.complex64, f"{farplane.dtype}"
+        scan = self.prepare_scan(scan)
+        assert probe.dtype == cp.complex64, f"{probe.dtype}"
+        psi = self._zeros(out, [self.ptheta, self.nz, self.n])
+        flg = 0  # compute adjoint operator with respect to object
+        engine = self._engine(probe.shape[1])
+        engine.adj_modes(psi.data.ptr, farplane.data.ptr, scan.scan.data.ptr,
+                         probe.data.ptr, flg)
+        return psi
 
-class CGPtychoSolver(PtychoCuFFT):
+    @traced(gpu=True)
+    def adj_probe_modes(self, farplane, scan, psi, out=None):
+        """Adjoint ptychography probe transform (O*F*) of all probe modes."""
+        assert farplane.dtype == cp.complex64, f"{farplane.dtype}"
+        scan = self.prepare_scan(scan)
+        assert psi.dtype == cp.complex64, f"{psi.dtype}"
+        probe = self._zeros(
+            out, [self.ptheta, farplane.shape[1], self.nprb, self.nprb])
+        flg = 1  # compute adjoint operator with respect to probe
+        engine = self._engine(farplane.shape[1])
+        engine.adj_modes(psi.data.ptr, farplane.data.ptr, scan.scan.data.ptr,
+                         probe.data.ptr, flg)
+        return probe
+
+
+class CGPtychoSolver(CGPtycho, PtychoCuFFT):
     """Solve the ptychography problem using congujate gradient."""
 
-    @staticmethod
-    def line_search_sqr(f, p1, p2, p3, step_length=1, step_shrink=0.5):
-        """Optimized line search for square functions
-            Example of otimized computation for the Gaussian model:
-            sum_j|G_j(psi+gamma dpsi)|^2 = sum_j|G_j(psi)|^2+
-                                           gamma^2*sum_j|G_j(dpsi)|^2+
-                                           gamma*sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
-            p1,p2,p3 are temp variables to avoid computing the fwd operator during the line serch
-            p1 = sum_j|G_j(psi)|^2
-            p2 = sum_j|G_j(dpsi)|^2
-            p3 = sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
-
-            Parameters	
-            ----------	
-            f : function(x)	
-                The function being optimized.	
-            p1,p2,p3 : vectors	
-                Temporarily vectors to avoid computing forward operators        
-        """
-        assert step_shrink > 0 and step_shrink < 1
-        m = 0  # Some tuning parameter for termination
-        fp1 = f(p1) # optimize computation
-        # Decrease the step length while the step increases the cost function
-        while f(p1+step_length**2 * p2+step_length*p3) > fp1 + step_shrink * m:
-            if step_length < 1e-32:
-                warnings.warn("Line search failed for conjugate gradient.")
-                return 0
-            step_length *= step_shrink            
-        return step_length
-    
-    def run(
-            self,
-            data,
-            psi,
-            scan,
-            probe,
-            piter,
-            model='gaussian',
-            recover_prb=False,
-    ):
-        """Conjugate gradients for ptychography.
-
-        Parameters
-        ----------
-        model : str gaussian or poisson
-            The noise model to use for the gradient.
-        piter : int
-            The number of gradient steps to take.
-        recover_prb : bool
-            Whether to recover the probe or assume the given probe is correct.
 
-        """
-        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
-
-        # minimization functional
-        def minf(fpsi):
-            if model == 'gaussian':
-                f = cp.linalg.norm(cp.sqrt(cp.abs(fpsi)) - cp.sqrt(data))**2
-            elif model == 'poisson':
-                f = cp.sum(
-                    cp.abs(fpsi) - data * cp.log(cp.abs(fpsi) + 1e-32))
-            return f
-
-        print("# congujate gradient parameters\n"
-              "iteration, step size object, step size probe, function min"
-              )  # csv column headers
-        gammaprb = 0
-        fpsi0 = cp.zeros([self.ptheta, self.nscan, self.ndet,
-                             self.ndet], dtype='complex64')
-        for i in range(piter):
-            # 1) object retrieval subproblem with fixed probes
-            # sum of forward operators associated with each probe
-            fpsi = cp.zeros([self.ptheta, self.nscan, self.ndet,
-                             self.ndet], dtype='complex64')            
-	        # sum of abs value of forward operators
-            absfpsi = data*0
-            for k in range(probe.shape[1]):
-                tmp = self.fwd(psi, scan, probe[:, k])
-                fpsi += tmp
-                absfpsi += np.abs(tmp)**2
-            fpsi0 = fpsi.copy()
-            # check positions
-            # take gradients
-            gradpsi = cp.zeros(
-                    [self.ptheta, self.nz, self.n], dtype='complex64')
-            if model == 'gaussian':                
-                for k in range(probe.shape[1]):
-                    gradpsi += self.adj(
-                        fpsi - cp.sqrt(data) * fpsi/(cp.sqrt(absfpsi)+1e-32),
-                        scan,
-                        probe[:, k],
-                    ) / (cp.max(cp.abs(probe[:, k]))**2)
-            elif model == 'poisson':
-                for k in range(probe.shape[1]):
-                    gradpsi += self.adj(
-                        fpsi - data * fpsi / (absfpsi + 1e-32),
-                        scan,
-                        probe[:, k],
-                    ) / (cp.max(cp.abs(probe[:, k]))**2)
-            # Dai-Yuan direction
-            if i == 0:
-                dpsi = -gradpsi
-            else:
-                dpsi = -gradpsi + (
-                    cp.linalg.norm(gradpsi)**2 /
-                    (cp.sum(cp.conj(dpsi) * (gradpsi - gradpsi0))) * dpsi)
-            gradpsi0 = gradpsi
-            
-	        
-            # Use optimized line search for square functions, note:
-            # sum_j|G_j(psi+gamma dpsi)|^2 = sum_j|G_j(psi)|^2+
-            #                               gamma^2*sum_j|G_j(dpsi)|^2+
-            #                               gamma*sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
-            # temp variables to avoid computing the fwd operator during the line serch
-            #p1 = sum_j|G_j(psi)|^2
-            #p2 = sum_j|G_j(dpsi)|^2
-            #p3 = sum_j (G_j(psi).real*G_j(psi).real+2*G_j(dpsi).imag*G_j(dpsi).imag)
-            p1 = data*0 
-            p2 = data*0
-            p3 = data*0
-            for k in range(probe.shape[1]):
-                tmp1 = self.fwd(psi, scan, probe[:, k])
-                tmp2 = self.fwd(dpsi, scan, probe[:, k])
-                p1 += cp.abs(tmp1)**2 
-                p2 += cp.abs(tmp2)**2
-                p3 += 2*(tmp1.real*tmp2.real+tmp1.imag*tmp2.imag)
-            # line search		
-            gammapsi = 0.5*self.line_search_sqr(minf,p1,p2,p3)
-            # update psi
-            psi = psi + gammapsi * dpsi
-            
-            if (recover_prb):
-                if(i==0):
-                    gradprb = probe*0
-                    gradprb0 = probe*0
-                    dprb = probe*0
-                for m in range(0,probe.shape[1]):
-                    # 2) probe retrieval subproblem with fixed object
-                    # sum of forward operators associated with each probe                    
-                    fprb = self.fwd(psi, scan, probe[:, m])
-	                # sum of abs value of forward operators
-                    absfprb = data*0
-                    for k in range(probe.shape[1]):
-                        tmp = self.fwd(psi, scan, probe[:, k])                        
-                        absfprb += np.abs(tmp)**2
-                    # take gradient
-                    if model == 'gaussian':
-                        gradprb[:,m] = self.adj_probe(
-                            fprb - cp.sqrt(data) * fprb/(cp.sqrt(absfprb)+1e-32),
-                            scan,
-                            psi,
-                        ) / cp.max(cp.abs(psi))**2 / self.nscan
-                    elif model == 'poisson':
-                        gradprb[:,m] = self.adj_probe(
-                            fprb - data * fprb / (absfprb + 1e-32),
-                            scan,
-                            psi,
-                        ) / cp.max(cp.abs(psi))**2 / self.nscan
-                    # Dai-Yuan direction
-                    if (i == 0):
-                        dprb[:,m] = -gradprb[:,m]
-                    else:
-                        dprb[:,m] = -gradprb[:,m] + (
-                            cp.linalg.norm(gradprb[:,m])**2 /
-                            (cp.sum(cp.conj(dprb[:,m]) * (gradprb[:,m] - gradprb0[:,m]))) * dprb[:,m])
-                    gradprb0[:,m] = gradprb[:,m]
-                    # temp variables to avoid computing the fwd operator during the line serch
-                    p1 = data*0
-                    p2 = data*0
-                    p3 = data*0
-                    for k in range(probe.shape[1]):
-                        tmp1 = self.fwd(psi, scan, probe[:, k])
-                        p1 += cp.abs(tmp1)**2
-                    tmp1 = self.fwd(psi, scan, probe[:, m])                        
-                    tmp2 = self.fwd(psi, scan, dprb[:, m])                                                
-                    p2 = cp.abs(tmp2)**2
-                    p3 = 2*(tmp1.real*tmp2.real+tmp1.imag*tmp2.imag)
-                    # line search		
-                    gammaprb = 0.5*self.line_search_sqr(minf,p1,p2,p3)
-                    # update probe                       
-                    probe[:,m] = probe[:,m] + gammaprb * dprb[:,m]                
-            # check convergence
-            if (np.mod(i, 8) == 0):
-                sfpsi = cp.zeros(
-                    [self.ptheta, self.nscan, self.ndet, self.ndet], dtype='complex64')
-                for k in range(probe.shape[1]):
-                    tmp = self.fwd(psi, scan, probe[:, k])
-                    sfpsi += np.abs(tmp)**2
-                print("%4d, %.3e, %.3e, %.7e" %
-                      (i, gammapsi, gammaprb, minf(sfpsi)))
-
-        return {
-            'psi': psi,
-            'probe': probe,
-        }
+class MinibatchPtychoSolver(MinibatchPtycho, PtychoCuFFT):
+    """Solve the ptychography problem using minibatch updates."""
@@ -0,0 +1,105 @@
+"""A module for sharing FFT plans and scratch memory between solvers.
+
+Creating the FFT plans and scratch buffers of an engine is expensive compared
+to solving a small problem, and solvers are often created many times with the
+same shape. Engines therefore acquire these resources from a process-wide
+registry keyed by shape instead of creating them in each constructor.
+
+```python
+registry.capacity = 4 * 2**30  # keep up to 4 GiB of idle plans
+with CGPtychoSolver(nscan, nprb, ndet, ptheta, nz, n) as solver:
+    # the plans of this shape are reused by the next solver
+    result = solver.run_batch(data, psi, scan, probe, piter=piter)
+```
+
+"""
+
+from collections import OrderedDict
+import threading
+
+
+class Registry(object):
+    """A reference counted cache of resources with LRU eviction.
+
+    A resource is created when its key is acquired for the first time and is
+    shared by everyone who acquires the same key. When its last reference is
+    released, it stays in the cache as idle. Idle resources are closed, least
+    recently used first, whenever the idle and used resources together take
+    more than capacity bytes. Resources which are in use are never closed.
+
+    Attribtues
+    ----------
+    capacity : int
+        The number of bytes above which idle resources are evicted.
+    nbytes : int
+        The number of bytes of all resources in the registry.
+    """
+
+    def __init__(self, capacity=2**30):
+        self.capacity = capacity
+        self.nbytes = 0
+        # key: [resource, refcount, nbytes, close]
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def acquire(self, key, create, nbytes=0, close=None):
+        """Return the resource of key, which is made by create() if missing.
+
+        Parameters
+        ----------
+        nbytes : int
+            The memory held by the resource, used for the capacity.
+        close : function
+            Called with the resource when it is evicted.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = [create(), 0, nbytes, close]
+                self.entries[key] = entry
+                self.nbytes += nbytes
+            entry[1] += 1
+            self.entries.move_to_end(key)
+            self.evict()
+            return entry[0]
+
+    def release(self, key):
+        """Drop one reference to the resource of key."""
+        with self.lock:
+            entry = self.entries[key]
+            assert entry[1] > 0, f"{key} was released too often"
+            entry[1] -= 1
+            self.evict()
+
+    def evict(self, capacity=None):
+        """Close idle resources until the registry fits into capacity."""
+        capacity = self.capacity if capacity is None else capacity
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if self.nbytes <= capacity:
+                    break
+                if entry[1] == 0:
+                    self._close(key)
+
+    def clear(self):
+        """Close all idle resources, also those which take no bytes."""
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry[1] == 0:
+                    self._close(key)
+
+    def _close(self, key):
+        resource, _, nbytes, close = self.entries.pop(key)
+        self.nbytes -= nbytes
+        if close is not None:
+            close(resource)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# the registry shared by all of the engines of this process
+registry = Registry()
@@ -0,0 +1,458 @@
+"""A module for a resident reconstruction service.
+
+A server process keeps its imports, device context, and solver instances
+(with their FFT plans and workspaces) warm between jobs, so starting a job
+only costs sending its arrays. Clients submit jobs over a local socket; the
+jobs are queued and solved one at a time on the server's device, while the
+metrics of each iteration and the results of each angle partition are
+streamed back to the client. Queued and running jobs may be cancelled.
+
+```bash
+python -m libtike.cufft.service --engine cuda --port 6000 --authkey 5ec7e7
+```
+
+```python
+with ReconstructionClient(('localhost', 6000), bytes.fromhex('5ec7e7')) as c:
+    job = c.submit(data, psi, scan, probe, piter=piter, recover_prb=True)
+    for kind, value in job.events():
+        print(kind, value)  # 'metrics' dicts and 'partial' results
+    result = job.result()
+```
+
+"""
+
+import argparse
+from collections import OrderedDict
+import os
+import queue
+import socket
+import threading
+import traceback
+import uuid
+from multiprocessing.connection import (Client, Listener, answer_challenge,
+                                        deliver_challenge)
+
+import numpy as np
+
+
+class Cancelled(Exception):
+    """The job was cancelled by its client."""
+
+
+def _load(x):
+    """Return an array, reading paths of .npy files lazily."""
+    if isinstance(x, (str, os.PathLike)):
+        return np.load(x, mmap_mode='r')
+    return x
+
+
+class _Connection(object):
+    """A connection which may be sent to from many threads."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            try:
+                self.conn.send(message)
+            except OSError:
+                # the client is gone; its jobs still finish
+                pass
+
+
+class _Job(object):
+    """A job of the server and the connection of its client."""
+
+    def __init__(self, key, spec, client):
+        self.key = key
+        self.spec = spec
+        self.client = client
+        self.cancelled = threading.Event()
+
+    def send(self, kind, value=None):
+        self.client.send((kind, self.key, value))
+
+
+class _Streamed(object):
+    """An output array which sends each partition as it is written."""
+
+    def __init__(self, array, name, job):
+        self.array = array
+        self.name = name
+        self.job = job
+
+    def __setitem__(self, ids, value):
+        self.array[ids] = value
+        self.job.send('partial', {
+            'name': self.name,
+            'ids': (ids.start, ids.stop),
+            'value': self.array[ids],
+        })
+
+
+class ReconstructionServer(object):
+    """Solve the jobs of clients with warm solver instances.
+
+    This class is a context manager. The solvers are keyed by the shape of
+    the problem, and up to capacity of them are kept after their jobs, least
+    recently used first evicted. A solver is closed with its `__exit__` when
+    it is evicted, when the server closes, or when a job fails in it.
+
+    Parameters
+    ----------
+    cls : type
+        The solver class, e.g. `CGPtychoSolver` or `CGPtychoNumPySolver`.
+    address : (str, int)
+        The address to listen on; port 0 picks a free port.
+    authkey : bytes
+        The key which clients must know; a random key by default.
+    ptheta : int
+        The number of angles of each partition of the solvers.
+    capacity : int
+        The number of solvers which are kept warm.
+    device : int
+        The device of the solvers.
+
+    Attribtues
+    ----------
+    address : (str, int)
+        The address on which the server listens.
+    solvers : OrderedDict
+        The warm solvers by shape.
+    """
+
+    def __init__(self, cls, address=('localhost', 0), authkey=None, ptheta=1,
+                 capacity=4, device=None):
+        """Please see help(ReconstructionServer) for more info."""
+        self.cls = cls
+        self.authkey = os.urandom(16) if authkey is None else authkey
+        self.ptheta = ptheta
+        self.capacity = capacity
+        self.device = device
+        self.solvers = OrderedDict()
+        self.jobs = {}
+        self.queue = queue.Queue()
+        # clients authenticate in their reader threads, so a client which
+        # fails the handshake cannot stop or block the accept thread
+        self.listener = Listener(address)
+        self.address = self.listener.address
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._accept, daemon=True),
+            threading.Thread(target=self._work, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        """Return self at start of a with-block."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Stop the server at interruptions or with-block exit."""
+        self.close()
+
+    def close(self):
+        """Stop accepting jobs, cancel the queued ones, and free solvers."""
+        with self.lock:
+            if not self.closed.is_set():
+                self.closed.set()
+                self._wake()
+                self.listener.close()
+                for job in list(self.jobs.values()):
+                    job.cancelled.set()
+                self.queue.put(None)
+        self.threads[1].join()
+
+    def _wake(self):
+        """Stop the accept thread, which is blocked in accept."""
+        # closing the listener does not interrupt a blocked accept, so
+        # connect once without a handshake, which never waits for the server
+        try:
+            socket.create_connection(self.address, timeout=1).close()
+        except OSError:
+            pass
+        self.threads[0].join(timeout=5)
+
+    def wait(self):
+        """Block until the server is closed, e.g. by a client."""
+        self.closed.wait()
+        self.close()
+
+    def _accept(self):
+        """Start a reader thread for each client."""
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                # only this connection fails
+                if self.closed.is_set():
+                    break
+                continue
+            if self.closed.is_set():
+                conn.close()
+                break
+            threading.Thread(target=self._read, args=(conn,),
+                             daemon=True).start()
+
+    def _read(self, conn):
+        """Authenticate one client and handle its messages."""
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+        except Exception:
+            # e.g. AuthenticationError of a wrong authkey
+            conn.close()
+            return
+        client = _Connection(conn)
+        while True:
+            try:
+                command, key, value = conn.recv()
+            except (EOFError, OSError):
+                break
+            if command == 'submit':
+                job = _Job(key, value, client)
+                if self.closed.is_set():
+                    job.send('cancelled')
+                    continue
+                self.jobs[key] = job
+                self.queue.put(job)
+                job.send('queued')
+            elif command == 'cancel':
+                if key in self.jobs:
+                    self.jobs[key].cancelled.set()
+            elif command == 'shutdown':
+                threading.Thread(target=self.close).start()
+            elif command == 'disconnect':
+                break
+        conn.close()
+
+    def solver(self, shape):
+        """Return the warm solver of a shape, creating it when missing."""
+        if shape in self.solvers:
+            self.solvers.move_to_end(shape)
+            return self.solvers[shape]
+        while len(self.solvers) >= self.capacity:
+            _, old = self.solvers.popitem(last=False)
+            old.__exit__(None, None, None)
+        nscan, nprb, ndet, nz, n, nmodes = shape
+        solver = self.cls(nscan, nprb, ndet, self.ptheta, nz, n,
+                          nmodes=nmodes).__enter__()
+        self.solvers[shape] = solver
+        return solver
+
+    def _work(self):
+        """Solve the queued jobs one at a time on the device."""
+        self.cls.use_device(self.device)
+        try:
+            for job in iter(self.queue.get, None):
+                try:
+                    if job.cancelled.is_set():
+                        raise Cancelled()
+                    job.send('started')
+                    job.send('done', self._run(job))
+                except Cancelled:
+                    job.send('cancelled')
+                except Exception:
+                    job.send('error', traceback.format_exc())
+                finally:
+                    del self.jobs[job.key]
+        finally:
+            while self.solvers:
+                _, solver = self.solvers.popitem()
+                solver.__exit__(None, None, None)
+
+    def _run(self, job):
+        """Return the result of one job."""
+        data, psi, scan, probe = (
+            _load(job.spec[name]) for name in ('data', 'psi', 'scan', 'probe'))
+        shape = (scan.shape[1], probe.shape[-1], data.shape[-1],
+                 psi.shape[-2], psi.shape[-1], probe.shape[1])
+        solver = self.solver(shape)
+
+        def callback(metrics):
+            job.send('metrics', metrics)
+            if job.cancelled.is_set():
+                raise Cancelled()
+
+        out = {
+            'psi': _Streamed(np.array(psi), 'psi', job),
+            'probe': _Streamed(np.array(probe), 'probe', job),
+        }
+        try:
+            solver.run_batch(data, psi, scan, probe, out=out,
+                             callback=callback, **job.spec['kwargs'])
+        except Cancelled:
+            raise
+        except BaseException as e:
+            # the solver may be broken; free it with the error
+            del self.solvers[shape]
+            solver.__exit__(type(e), e, e.__traceback__)
+            raise
+        return {
+            'psi': out['psi'].array,
+            'probe': out['probe'].array,
+            'history': out.get('history', []),
+            'stop': out.get('stop', []),
+        }
+
+
+class Job(object):
+    """A job submitted by a `ReconstructionClient`.
+
+    Attribtues
+    ----------
+    key : str
+        The unique key of the job.
+    status : str
+        One of 'submitted', 'queued', 'started', 'done', 'cancelled', or
+        'error'.
+    """
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.status = 'submitted'
+        self.messages = queue.Queue()
+        self.value = None
+
+    def cancel(self):
+        """Ask the server to cancel this job."""
+        self.client._send('cancel', self.key)
+
+    def events(self, timeout=None):
+        """Yield the ('metrics', dict) and ('partial', dict) events.
+
+        A 'partial' dict has the 'name' ('psi' or 'probe'), the 'ids' (start,
+        stop) of an angle partition, and its solved 'value'. The events stop
+        when the job ends.
+        """
+        while self.status not in ('done', 'cancelled', 'error'):
+            kind, value = self.messages.get(timeout=timeout)
+            if kind in ('metrics', 'partial'):
+                yield kind, value
+            else:
+                self.status = kind
+                self.value = value
+
+    def result(self, timeout=None):
+        """Return the result dict of the job once it is done.
+
+        Raises Cancelled if the job was cancelled, and RuntimeError with the
+        server's traceback if the job failed.
+        """
+        for _ in self.events(timeout):
+            pass
+        if self.status == 'cancelled':
+            raise Cancelled(f"Job {self.key} was cancelled.")
+        if self.status == 'error':
+            raise RuntimeError(f"Job {self.key} failed:\n{self.value}")
+        return self.value
+
+
+class ReconstructionClient(object):
+    """Submit jobs to a `ReconstructionServer`.
+
+    This class is a context manager.
+    """
+
+    def __init__(self, address, authkey):
+        """Please see help(ReconstructionClient) for more info."""
+        self.conn = Client(address, authkey=authkey)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def __enter__(self):
+        """Return self at start of a with-block."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Disconnect at interruptions or with-block exit."""
+        self.close()
+
+    def close(self):
+        """Disconnect from the server; submitted jobs still run."""
+        # the reader closes the connection once the server hangs up, since
+        # closing it while the reader receives may confuse a reused handle
+        try:
+            self._send('disconnect')
+        except OSError:
+            pass
+        self.reader.join()
+
+    def _send(self, command, key=None, value=None):
+        with self.lock:
+            self.conn.send((command, key, value))
+
+    def _read(self):
+        """Pass the messages of the server to their jobs."""
+        while True:
+            try:
+                kind, key, value = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            self.jobs[key].messages.put((kind, value))
+        self.conn.close()
+        for job in self.jobs.values():
+            job.messages.put(('error', "The connection to the server closed."))
+
+    def submit(self, data, psi, scan, probe, **kwargs):
+        """Return a Job which runs solver.run_batch on the server.
+
+        The arrays may be paths of .npy files on the server, which are read
+        lazily. The kwargs are passed to run_batch, except for callback,
+        which is how the metrics are streamed.
+        """
+        key = uuid.uuid4().hex
+        job = self.jobs[key] = Job(key, self)
+        self._send('submit', key, {
+            'data': data,
+            'psi': psi,
+            'scan': scan,
+            'probe': probe,
+            'kwargs': kwargs,
+        })
+        return job
+
+    def shutdown(self):
+        """Ask the server to close."""
+        self._send('shutdown')
+
+
+def main(argv=None):
+    from libtike.cufft.benchmark import solver_class
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--engine', default='numpy', choices=['numpy', 'cuda'])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--authkey', help="a hex key; random by default")
+    parser.add_argument('--ptheta', type=int, default=1)
+    parser.add_argument('--capacity', type=int, default=4,
+                        help="the number of solvers which are kept warm")
+    parser.add_argument('--device', type=int)
+    args = parser.parse_args(argv)
+    server = ReconstructionServer(
+        solver_class(args.engine),
+        address=(args.host, args.port),
+        authkey=None if args.authkey is None else bytes.fromhex(args.authkey),
+        ptheta=args.ptheta,
+        capacity=args.capacity,
+        device=args.device,
+    )
+    host, port = server.address
+    print(f"Listening on {host}:{port} with authkey {server.authkey.hex()}",
+          flush=True)
+    try:
+        server.wait()
+    except KeyboardInterrupt:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
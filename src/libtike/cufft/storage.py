@@ -0,0 +1,92 @@
+"""A module for compact storage of diffraction intensities.
+
+Detector counts are small integers, so the data of `run` and `run_batch` do
+not need to be float32. The solvers accept data of any real dtype (e.g.
+uint16 counts or float16) and expand it to float32 on the device one
+partition at a time, so the host memory and the host to device transfers
+shrink by the ratio of the item sizes.
+
+```python
+data = compact(data)  # uint16 if the counts fit
+data = CompressedArray(data)  # lossless, decompressed per partition
+result = solver.run_batch(data, psi, scan, probe, piter=piter)
+```
+
+"""
+
+import zlib
+
+import numpy as np
+
+
+def compact(data):
+    """Return data as uint16 counts if that is lossless, else unchanged."""
+    data = np.asarray(data)
+    if (data.dtype.kind == 'f' and data.size > 0 and data.min() >= 0 and
+            data.max() <= np.iinfo('uint16').max and
+            np.all(np.mod(data, 1) == 0)):
+        return data.astype('uint16')
+    return data
+
+
+class CompressedArray(object):
+    """A read-only array compressed losslessly with zlib.
+
+    The array is compressed in chunks along the first dimension, and slicing
+    along the first dimension decompresses only the chunks which are read,
+    so it can be passed to `run_batch` like other lazy arrays.
+
+    Attribtues
+    ----------
+    shape : tuple
+        The shape of the uncompressed array.
+    dtype : np.dtype
+        The dtype of the uncompressed array.
+    chunk : int
+        The number of items of the first dimension in each chunk.
+    nbytes : int
+        The number of bytes of the compressed chunks.
+    """
+
+    def __init__(self, array, chunk=1, level=1):
+        array = np.asarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.chunk = chunk
+        self.chunks = [
+            zlib.compress(np.ascontiguousarray(array[k:k + chunk]), level)
+            for k in range(0, self.shape[0], chunk)
+        ]
+        self.nbytes = sum(len(c) for c in self.chunks)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read(self, k):
+        """Return the decompressed chunk k."""
+        x = np.frombuffer(zlib.decompress(self.chunks[k]), dtype=self.dtype)
+        return x.reshape(-1, *self.shape[1:])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, )
+        ids = key[0]
+        if isinstance(ids, slice):
+            start, stop, step = ids.indices(self.shape[0])
+            if start >= stop:
+                return np.empty([0, *self.shape[1:]], dtype=self.dtype)
+            first, last = start // self.chunk, (stop - 1) // self.chunk
+            x = np.concatenate([self._read(k) for k in range(first, last + 1)])
+            ids = slice(start - first * self.chunk, stop - first * self.chunk,
+                        step)
+        else:
+            x = np.asarray(self)
+        return x[(ids, *key[1:])]
+
+    def __array__(self, dtype=None, copy=None):
+        x = np.concatenate([self._read(k) for k in range(len(self.chunks))])
+        return x if dtype is None else x.astype(dtype)
@@ -0,0 +1,280 @@
+"""A module for generating synthetic ptychography datasets.
+
+The objects, probes, scan trajectories, and noisy diffraction data are
+generated procedurally for any number of angles and sizes. The angles are
+generated in partitions, which are written to .npy memmaps or to an HDF5 file
+as soon as they are made, so datasets may be much larger than memory. Every
+angle has its own random generator seeded by the seed and the angle, so the
+dataset does not depend on the size of the partitions.
+
+```python
+generate('dataset/', ntheta=1000, nscan=2000, ndet=128, nprb=64, nz=1024,
+         n=1024, nmodes=4, trajectory='fermat', noise='poisson')
+dataset = load('dataset/')
+result = solver.run_batch(dataset['data'], psi, dataset['scan'],
+                          dataset['probe'], piter=piter)
+```
+
+"""
+
+import os
+
+import numpy as np
+import scipy.fft
+
+
+def _rng(seed, *keys):
+    """Return the random generator of seed and keys, e.g. an angle."""
+    return np.random.default_rng([seed, *keys])
+
+
+def make_object(nz, n, rng, feature=8, phase=1.0, absorption=0.2):
+    """Return a random complex object of smooth features.
+
+    The phase and the absorption are white noise low pass filtered to
+    features of about feature pixels and scaled to at most phase radians
+    and absorption (so the amplitude is at least exp(-absorption)).
+    """
+    fy = scipy.fft.fftfreq(nz)[:, np.newaxis]
+    fx = scipy.fft.fftfreq(n)[np.newaxis, :]
+    lowpass = np.exp(-(fy**2 + fx**2) * (np.pi * feature)**2)
+
+    def field():
+        x = scipy.fft.ifft2(scipy.fft.fft2(rng.standard_normal([nz, n])) *
+                            lowpass).real
+        x -= x.min()
+        return x / max(x.max(), 1e-32)
+
+    return np.exp(1j * phase * field() -
+                  absorption * field()).astype('complex64')
+
+
+def make_probe(nprb, nmodes=1, photons=1e6, defocus=1.0, decay=0.5):
+    """Return orthogonal probe modes [nmodes, nprb, nprb].
+
+    The modes are Hermite-Gaussian beams with a quadratic (defocus) phase.
+    The power of each mode is decay times the power of the previous one, and
+    the total power is photons, which is also about the number of counts of
+    a diffraction pattern of an object of unit amplitude.
+    """
+    x = (np.arange(nprb) - (nprb - 1) / 2) / (nprb / 8)
+    gauss = np.exp(-x**2 / 2)
+    hermite = [np.ones_like(x), 2 * x]
+    while len(hermite) < nmodes:
+        k = len(hermite)
+        hermite.append(2 * x * hermite[-1] - 2 * (k - 1) * hermite[-2])
+    # the orders (p, q) with the lowest p + q first
+    orders = sorted(
+        ((p, q) for p in range(nmodes) for q in range(nmodes)),
+        key=lambda pq: (sum(pq), pq[1]),
+    )[:nmodes]
+    phase = np.exp(1j * defocus * (x[:, np.newaxis]**2 + x**2) / 2)
+    probe = np.array([
+        np.outer(hermite[q] * gauss, hermite[p] * gauss) * phase
+        for p, q in orders
+    ])
+    power = decay**np.arange(nmodes)
+    power *= photons / power.sum()
+    norm = np.sqrt(np.sum(np.abs(probe)**2, axis=(1, 2)))
+    probe *= (np.sqrt(power) / norm)[:, np.newaxis, np.newaxis]
+    return probe.astype('complex64')
+
+
+def raster_scan(nscan, ny, nx, rng=None, jitter=0.0):
+    """Return nscan raster positions [nscan, 2] in [0, ny) x [0, nx).
+
+    The positions may be jittered by a uniform jitter in pixels, which
+    avoids the periodic artifacts of a perfect raster.
+    """
+    side = int(np.ceil(np.sqrt(nscan)))
+    margin = jitter if jitter > 0 else 0
+    y, x = np.meshgrid(
+        np.linspace(margin, ny - 1 - margin, side),
+        np.linspace(margin, nx - 1 - margin, side),
+        indexing='ij',
+    )
+    scan = np.stack([y, x], axis=-1).reshape(-1, 2)[:nscan]
+    if jitter > 0:
+        scan = scan + rng.uniform(-jitter, jitter, scan.shape)
+    return scan.astype('float32')
+
+
+def _fit(y, x, ny, nx):
+    """Scale positions around zero to fill [0, ny) x [0, nx)."""
+    scale = min(ny - 1, nx - 1) / max(np.ptp(y), np.ptp(x), 1e-32)
+    y = (y - y.min()) * scale + (ny - 1 - np.ptp(y) * scale) / 2
+    x = (x - x.min()) * scale + (nx - 1 - np.ptp(x) * scale) / 2
+    return np.stack([y, x], axis=-1).astype('float32')
+
+
+def spiral_scan(nscan, ny, nx):
+    """Return nscan positions on an Archimedean spiral of even spacing."""
+    k = np.arange(nscan)
+    theta = np.sqrt(4 * np.pi * k)
+    return _fit(theta * np.sin(theta), theta * np.cos(theta), ny, nx)
+
+
+def fermat_scan(nscan, ny, nx):
+    """Return nscan positions on a Fermat spiral (golden angle sampling)."""
+    k = np.arange(nscan)
+    theta = k * np.pi * (3 - np.sqrt(5))
+    r = np.sqrt(k)
+    return _fit(r * np.sin(theta), r * np.cos(theta), ny, nx)
+
+
+trajectories = {
+    'raster': raster_scan,
+    'spiral': spiral_scan,
+    'fermat': fermat_scan,
+}
+
+
+def add_noise(intensity, rng, noise='poisson', sigma=0.5):
+    """Return noisy intensities.
+
+    Poisson noise draws counts; gaussian noise adds normal noise with a
+    standard deviation of sigma to the amplitudes.
+    """
+    if noise == 'poisson':
+        return rng.poisson(intensity).astype('float32')
+    if noise == 'gaussian':
+        amplitude = np.sqrt(intensity) + sigma * rng.standard_normal(
+            intensity.shape)
+        return (amplitude**2).astype('float32')
+    if noise is None:
+        return intensity.astype('float32')
+    raise ValueError(f"{noise} is not one of ['poisson', 'gaussian', None].")
+
+
+def _create(path, shapes, compression=None):
+    """Return writable arrays of shapes in memory, .npy files, or HDF5."""
+    if path is None:
+        return None, {
+            name: np.empty(shape, dtype) for name, (shape, dtype) in
+            shapes.items()
+        }
+    if str(path).endswith(('.h5', '.hdf5')):
+        import h5py
+        f = h5py.File(path, 'w')
+        return f, {
+            name: f.create_dataset(name, shape, dtype,
+                                   chunks=(1, *shape[1:]),
+                                   compression=compression)
+            for name, (shape, dtype) in shapes.items()
+        }
+    os.makedirs(path, exist_ok=True)
+    return None, {
+        name: np.lib.format.open_memmap(
+            os.path.join(path, name + '.npy'), 'w+', dtype, tuple(shape))
+        for name, (shape, dtype) in shapes.items()
+    }
+
+
+def generate(
+        path=None,
+        ntheta=1,
+        nscan=100,
+        ndet=64,
+        nprb=32,
+        nz=256,
+        n=256,
+        nmodes=1,
+        trajectory='fermat',
+        noise='poisson',
+        photons=1e6,
+        dtype='float32',
+        ptheta=1,
+        seed=0,
+        engine=None,
+        compression=None,
+):
+    """Generate a synthetic dataset, ptheta angles at a time.
+
+    Parameters
+    ----------
+    path : str
+        A directory for .npy files, a .h5 or .hdf5 file (requires h5py), or
+        None to return arrays in memory.
+    trajectory : str
+        The scan trajectory of each angle; 'raster', 'spiral', or 'fermat'.
+        The raster is jittered by half a pixel.
+    noise : str
+        The noise of the diffraction data; 'poisson', 'gaussian', or None.
+    photons : float
+        The total power of the probe modes, so roughly the counts of each
+        diffraction pattern.
+    dtype : str
+        The dtype of the data, e.g. float32 or uint16 for Poisson counts.
+        Integer data are rounded and saturate at the largest integer.
+    engine : type
+        The engine which computes the diffraction patterns; `PtychoNumPy` by
+        default.
+
+    Returns a dict of the 'data' [ntheta, nscan, ndet, ndet], the true
+    object 'psi' [ntheta, nz, n], the 'scan' [ntheta, nscan, 2], and the
+    'probe' [ntheta, nmodes, nprb, nprb]. The arrays are read lazily with
+    `load` when path is not None.
+    """
+    if engine is None:
+        from libtike.cufft.cpu import PtychoNumPy as engine
+    f, out = _create(path, {
+        'data': ([ntheta, nscan, ndet, ndet], dtype),
+        'psi': ([ntheta, nz, n], 'complex64'),
+        'scan': ([ntheta, nscan, 2], 'float32'),
+        'probe': ([ntheta, nmodes, nprb, nprb], 'complex64'),
+    }, compression)
+    probe = make_probe(nprb, nmodes, photons)
+    try:
+        with engine(nscan, nprb, ndet, ptheta, nz, n, nmodes=nmodes) as slv:
+            xp = slv.array_module
+            for k in range(0, ntheta, ptheta):
+                ids = range(k, min(k + ptheta, ntheta))
+                psi = np.ones([ptheta, nz, n], dtype='complex64')
+                # padded angles have negative positions and are skipped
+                scan = np.full([ptheta, nscan, 2], -1, dtype='float32')
+                for i, t in enumerate(ids):
+                    rng = _rng(seed, t)
+                    psi[i] = make_object(nz, n, rng)
+                    if trajectory == 'raster':
+                        scan[i] = raster_scan(nscan, nz - nprb - 1,
+                                              n - nprb - 1, rng, 0.5)
+                    else:
+                        scan[i] = trajectories[trajectory](
+                            nscan, nz - nprb - 1, n - nprb - 1)
+                _, intensity = slv.fwd_modes(
+                    xp.asarray(psi), xp.asarray(scan),
+                    xp.asarray(np.tile(probe, [ptheta, 1, 1, 1])))
+                intensity = slv.asnumpy(intensity)
+                part = slice(k, k + len(ids))
+                data = np.stack([
+                    add_noise(intensity[i], _rng(seed, t, 1), noise)
+                    for i, t in enumerate(ids)
+                ])
+                if np.dtype(dtype).kind in 'ui':
+                    # counts saturate like a detector
+                    data = np.clip(np.round(data), 0, np.iinfo(dtype).max)
+                out['data'][part] = data.astype(dtype)
+                out['psi'][part] = psi[:len(ids)]
+                out['scan'][part] = scan[:len(ids)]
+                out['probe'][part] = probe
+    finally:
+        if f is not None:
+            f.close()
+    if path is None:
+        return out
+    if f is None:
+        for x in out.values():
+            x.flush()
+    return load(path)
+
+
+def load(path):
+    """Return a dict of the lazy arrays of a dataset made by `generate`."""
+    if str(path).endswith(('.h5', '.hdf5')):
+        import h5py
+        f = h5py.File(path, 'r')
+        return {name: f[name] for name in ('data', 'psi', 'scan', 'probe')}
+    return {
+        name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        for name in ('data', 'psi', 'scan', 'probe')
+    }
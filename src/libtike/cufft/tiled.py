@@ -0,0 +1,181 @@
+"""A module for solving views which are too large for one device.
+
+The scan positions of each view are partitioned into a grid of spatial tiles.
+Each tile is solved on a window of the object which covers the patches of its
+positions, so neighboring windows overlap by about one probe width (the
+halo). After every few iterations, the windows are stitched into the full
+object by averaging the overlaps weighted by the illumination of each tile,
+and the next iterations of each tile start from the stitched object.
+
+All tiles are padded to the same number of positions and the same window
+size, so one solver instance (and one set of FFT plans) of the tile size is
+reused for all of the tiles, and only one tile is on the device at a time.
+
+```python
+with TiledPtycho(CGPtychoSolver, nscan, nprb, ndet, ptheta, nz, n,
+                 tiles=(4, 4)) as tiled:
+    result = tiled.run_batch(data, psi, scan, probe, piter=piter, sync=4)
+```
+
+"""
+
+import numpy as np
+
+
+class TiledPtycho(object):
+    """Solve views in spatial tiles with a solver sized for one tile.
+
+    This class is a context manager.
+
+    Parameters
+    ----------
+    cls : type
+        The solver class, e.g. `CGPtychoSolver` or `CGPtychoNumPySolver`.
+    nscan, probe_shape, detector_shape, ntheta, nz, n, nmodes
+        The sizes of the full problem as for the solver class.
+    tiles : (int, int)
+        The number of tiles along the vertical and horizontal dimensions.
+    kwargs : dict
+        Other keyword arguments of the solver's constructor.
+    """
+
+    def __init__(self, cls, nscan, probe_shape, detector_shape, ntheta, nz, n,
+                 tiles=(2, 2), nmodes=1, **kwargs):
+        """Please see help(TiledPtycho) for more info."""
+        self.cls = cls
+        self.nscan = nscan
+        self.nprb = probe_shape
+        self.ndet = detector_shape
+        self.ptheta = ntheta
+        self.nz = nz
+        self.n = n
+        self.tiles = tuple(tiles)
+        self.nmodes = nmodes
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        """Return self at start of a with-block."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Nothing to free; tile solvers only live during run_batch."""
+        pass
+
+    def plan(self, scan):
+        """Return the positions and window origins of the tiles of scan.
+
+        Returns a list with the indices of the positions of each tile of each
+        view, an array of window origins [ntheta, ntiles, 2], and the window
+        shape which is shared by all tiles.
+        """
+        ty, tx = self.tiles
+        members = []
+        lo = np.zeros([scan.shape[0], ty * tx, 2], dtype=int)
+        hi = np.zeros([scan.shape[0], ty * tx, 2], dtype=int)
+        for t in range(scan.shape[0]):
+            corner = np.trunc(scan[t])
+            valid = np.all(corner >= 0, axis=-1)
+            row = np.clip(corner[:, 0] * ty // self.nz, 0, ty - 1)
+            col = np.clip(corner[:, 1] * tx // self.n, 0, tx - 1)
+            tile = (row * tx + col).astype(int)
+            members.append([])
+            for k in range(ty * tx):
+                ids = np.flatnonzero(valid & (tile == k))
+                members[t].append(ids)
+                if ids.size:
+                    lo[t, k] = corner[ids].min(axis=0)
+                    # patches read one pixel past the probe to interpolate
+                    hi[t, k] = corner[ids].max(axis=0) + self.nprb + 1
+        shape = np.minimum(np.max(hi - lo, axis=(0, 1)), [self.nz, self.n])
+        origin = np.minimum(lo, np.array([self.nz, self.n]) - shape)
+        return members, origin, tuple(int(s) for s in shape)
+
+    def _illumination(self, scan, probe, shape):
+        """Return the illumination sum_j |probe|^2 of positions in a window."""
+        weight = np.zeros(shape, dtype='float32')
+        power = np.sum(np.abs(probe)**2, axis=0)
+        for y, x in np.trunc(scan[np.all(scan >= 0, axis=-1)]).astype(int):
+            weight[y:y + self.nprb, x:x + self.nprb] += power
+        return weight
+
+    def run_batch(self, data, psi, scan, probe, piter, sync=1, **kwargs):
+        """Run piter iterations on all views, stitching every sync iterations.
+
+        The views are solved ptheta at a time. The remaining kwargs are
+        passed to the run method of the solver. When the probe is recovered,
+        the probes of the tiles are averaged weighted by their number of
+        positions.
+        """
+        assert probe.ndim == 4, "probe needs 4 dimensions, not %d" % probe.ndim
+        ntheta = scan.shape[0]
+        members, origin, (wz, wn) = self.plan(scan)
+        nscan = max(ids.size for view in members for ids in view)
+        psi = np.array(psi)
+        probe = np.array(probe)
+        ty, tx = self.tiles
+        with self.cls(nscan, self.nprb, self.ndet, self.ptheta, wz, wn,
+                      nmodes=self.nmodes, **self.kwargs) as slv:
+            for k in range(0, ntheta, self.ptheta):
+                views = list(range(k, min(k + self.ptheta, ntheta)))
+                # gather the data, shifted scan, and weights of each tile once
+                # on the host; a tile is staged to the device for each run
+                tiles = []
+                for j in range(ty * tx):
+                    if not any(members[t][j].size for t in views):
+                        continue
+                    tile_data = np.zeros(
+                        [self.ptheta, nscan, self.ndet, self.ndet],
+                        dtype=data.dtype)
+                    tile_scan = np.full([self.ptheta, nscan, 2], -1,
+                                        dtype='float32')
+                    weight = np.zeros([self.ptheta, wz, wn], dtype='float32')
+                    count = np.zeros(self.ptheta)
+                    for i, t in enumerate(views):
+                        ids = members[t][j]
+                        tile_data[i, :ids.size] = data[t][ids]
+                        tile_scan[i, :ids.size] = scan[t][ids] - origin[t, j]
+                        weight[i] = self._illumination(tile_scan[i],
+                                                       probe[t], (wz, wn))
+                        count[i] = ids.size
+                    tiles.append((j, tile_data, tile_scan, weight, count))
+                for start in range(0, piter, sync):
+                    total = np.zeros([self.ptheta, self.nz, self.n],
+                                     dtype='complex64')
+                    weights = np.zeros([self.ptheta, self.nz, self.n],
+                                       dtype='float32')
+                    probes = np.zeros([self.ptheta, *probe.shape[1:]],
+                                      dtype='complex64')
+                    counts = np.zeros(self.ptheta)
+                    for j, tile_data, tile_scan, weight, count in tiles:
+                        window = np.zeros([self.ptheta, wz, wn],
+                                          dtype='complex64')
+                        for i, t in enumerate(views):
+                            y, x = origin[t, j]
+                            window[i] = psi[t, y:y + wz, x:x + wn]
+                        tile_probe = np.zeros_like(probes)
+                        tile_probe[:len(views)] = probe[views]
+                        result = slv.run(
+                            *slv._stage(tile_data, window, tile_scan,
+                                        tile_probe),
+                            min(sync, piter - start),
+                            **kwargs,
+                        )
+                        window = slv.asnumpy(result['psi'])
+                        probes += (count[:, np.newaxis, np.newaxis,
+                                         np.newaxis] *
+                                   slv.asnumpy(result['probe']))
+                        # free the tile on the device before the next one
+                        del result
+                        counts += count
+                        for i, t in enumerate(views):
+                            y, x = origin[t, j]
+                            total[i, y:y + wz, x:x + wn] += (weight[i] *
+                                                             window[i])
+                            weights[i, y:y + wz, x:x + wn] += weight[i]
+                    # stitch; pixels which no tile illuminates are kept
+                    for i, t in enumerate(views):
+                        lit = weights[i] > 0
+                        psi[t][lit] = total[i][lit] / weights[i][lit]
+                        if kwargs.get('recover_prb') and counts[i] > 0:
+                            probe[t] = probes[i] / counts[i]
+        return {'psi': psi, 'probe': probe}
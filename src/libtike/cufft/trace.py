@@ -0,0 +1,205 @@
+"""A module for tracing the timeline of the operators and solvers.
+
+The tracer records nested spans of the host threads with their array shapes
+and the bytes which they move, and exports them as Chrome trace JSON which
+can be opened in chrome://tracing or https://ui.perfetto.dev. Spans of GPU
+engines also record CUDA events on the current stream, which are exported
+as a separate device track. Tracing is disabled by default; then each traced
+call only checks one flag.
+
+```python
+with tracing('trace.json'):
+    result = solver.run_batch(data, psi, scan, probe, piter=piter)
+```
+
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# the track of the device events in the exported trace
+GPU_TID = 0
+
+
+def _describe(args):
+    """Return the shapes and the total bytes of the arrays in args."""
+    shapes = []
+    nbytes = 0
+    for x in args:
+        if isinstance(x, (list, tuple)):
+            # e.g. the arrays of a copy or an out tuple
+            nested = _describe(x)
+            shapes.extend(nested['shapes'])
+            nbytes += nested['bytes']
+        elif hasattr(x, 'nbytes') and hasattr(x, 'shape'):
+            shapes.append(list(x.shape))
+            nbytes += int(x.nbytes)
+    return {'shapes': shapes, 'bytes': nbytes}
+
+
+class _Span(object):
+    """An open span of a Tracer."""
+
+    __slots__ = ('tracer', 'name', 'args', 'start', 'events')
+
+    def __init__(self, tracer, name, args, gpu):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.events = tracer._record_event() if gpu else None
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        stop = time.perf_counter()
+        if self.events is not None:
+            self.tracer._gpu.append(
+                (self.name, self.args, self.events,
+                 self.tracer._record_event()))
+        self.tracer.complete(self.name, self.start, stop - self.start,
+                             **self.args)
+
+
+class Tracer(object):
+    """Record spans of host time and device events.
+
+    Attribtues
+    ----------
+    enabled : bool
+        Whether spans are recorded.
+    events : list
+        The recorded Chrome trace events of the host.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.clear()
+
+    def clear(self):
+        """Drop all recorded events."""
+        self.events = []
+        self._gpu = []
+        self._origin = time.perf_counter()
+        self._reference = None
+
+    def enable(self):
+        """Start recording spans."""
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording spans; the recorded events are kept."""
+        self.enabled = False
+
+    def _us(self, seconds):
+        """Return microseconds since the origin of the trace."""
+        return (seconds - self._origin) * 1e6
+
+    def _record_event(self):
+        """Return a CUDA event recorded on the current stream."""
+        import cupy as cp
+        event = cp.cuda.Event()
+        event.record()
+        if self._reference is None:
+            # device times are relative to this event at this host time
+            self._reference = (event, time.perf_counter())
+        return event
+
+    def span(self, name, gpu=False, **args):
+        """Return a context manager which records a span called name.
+
+        The args (e.g. sizes) are stored with the span. With gpu, CUDA events
+        are recorded at the start and the end of the span.
+        """
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return _Span(self, name, args, gpu)
+
+    def complete(self, name, start, duration, **args):
+        """Record a span which started at perf_counter() start."""
+        if self.enabled:
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': self._us(start),
+                'dur': duration * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def export(self, path=None):
+        """Return the trace as a dict, and write it as JSON to path.
+
+        Waits for the recorded device events.
+        """
+        events = list(self.events)
+        if self._gpu:
+            import cupy as cp
+            reference, host = self._reference
+            for name, args, start, stop in self._gpu:
+                stop.synchronize()
+                ts = host + cp.cuda.get_elapsed_time(reference, start) / 1e3
+                events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': self._us(ts),
+                    'dur': cp.cuda.get_elapsed_time(start, stop) * 1e3,
+                    'pid': os.getpid(),
+                    'tid': GPU_TID,
+                    'args': args,
+                })
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': os.getpid(),
+                'tid': GPU_TID,
+                'args': {'name': 'GPU'},
+            })
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+        return trace
+
+
+# the tracer of all of the engines of this process
+tracer = Tracer()
+
+
+@contextlib.contextmanager
+def tracing(path=None):
+    """Trace the with-block and export the trace to path at its end."""
+    tracer.clear()
+    tracer.enable()
+    try:
+        yield tracer
+    finally:
+        tracer.disable()
+        tracer.export(path)
+
+
+def traced(name=None, gpu=False):
+    """Decorate a method, so its calls are spans with the sizes of its args.
+
+    The span is called name, by default the name of the method.
+    """
+
+    def decorator(function):
+        label = function.__name__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return function(*args, **kwargs)
+            with _Span(tracer, label, _describe(args[1:]), gpu):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -59,7 +59,8 @@ if __name__ == "__main__":
         else:
             prb = prb0.copy()
         result = slv.run_batch(
-            data, psi, scan, prb, piter=piter, model=model, recover_prb=recover_prb)
+            data, psi, scan, prb, piter=piter, model=model, recover_prb=recover_prb,
+            verbose=True)
         psi, prb = result['psi'], result['probe']
 
     # Save result
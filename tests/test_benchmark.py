@@ -0,0 +1,26 @@
+import json
+
+from libtike.cufft import benchmark
+
+
+def test_quick_benchmark_report(tmp_path):
+    cases = benchmark.matrix(benchmark.QUICK_BASE, {'nmodes': [1, 2]})
+    assert len(cases) == 2
+    report = benchmark.benchmark('numpy', cases=cases, repeat=1)
+    operations = {r['operation'] for r in report['results']}
+    assert {'fwd', 'adj', 'adj_probe', 'cg_iteration'} <= operations
+    assert len(report['results']) == 2 * len(operations)
+    for r in report['results']:
+        assert r['patterns_per_second'] > 0 and r['peak_bytes'] > 0
+    # a baseline which was twice as fast is a regression
+    baseline = json.loads(json.dumps(report))
+    for r in baseline['results']:
+        r['seconds'] /= 2
+    comparison = benchmark.compare(report['results'], baseline)
+    assert len(comparison) == len(report['results'])
+    assert all(c['regression'] for c in comparison)
+    path = tmp_path / 'baseline.json'
+    path.write_text(json.dumps(baseline))
+    status = benchmark.main(['--quick', '--repeat', '1', '--baseline',
+                             str(path), '--output', str(tmp_path / 'new.json')])
+    assert status == 1
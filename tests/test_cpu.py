@@ -0,0 +1,523 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import libtike.cufft as pt
+
+
+def random_problem(ntheta=2, nscan=7, nprb=6, ndet=8, nz=20, n=24, nmodes=1,
+                   seed=0):
+    """Return a small random ptychography problem."""
+    rng = np.random.default_rng(seed)
+    psi = (rng.random([ntheta, nz, n]) +
+           1j * rng.random([ntheta, nz, n])).astype('complex64')
+    probe = (rng.random([ntheta, nmodes, nprb, nprb]) +
+             1j * rng.random([ntheta, nmodes, nprb, nprb])).astype('complex64')
+    scan = np.stack([
+        rng.uniform(0, nz - nprb - 1, [ntheta, nscan]),
+        rng.uniform(0, n - nprb - 1, [ntheta, nscan]),
+    ], axis=-1).astype('float32')
+    # negative positions are skipped by the operators
+    scan[0, 0] = -1
+    return psi, scan, probe
+
+
+def kernel_fwd(psi, scan, probe, ndet):
+    """Loop version of the forward muloperator kernel and the cuFFT."""
+    ptheta, nscan = scan.shape[:2]
+    nprb = probe.shape[-1]
+    nearplane = np.zeros([ptheta, nscan, ndet, ndet], dtype='complex64')
+    lo = (ndet - nprb) // 2
+    for t in range(ptheta):
+        for j in range(nscan):
+            sxf, sx = np.modf(scan[t, j, 1])
+            syf, sy = np.modf(scan[t, j, 0])
+            if sx < 0 or sy < 0:
+                continue
+            sx, sy = int(sx), int(sy)
+            for iy in range(nprb):
+                for ix in range(nprb):
+                    f = psi[t, sy + iy:sy + iy + 2, sx + ix:sx + ix + 2]
+                    tmp = (f[0, 0] * (1 - sxf) * (1 - syf) +
+                           f[0, 1] * sxf * (1 - syf) +
+                           f[1, 0] * (1 - sxf) * syf +
+                           f[1, 1] * sxf * syf)
+                    nearplane[t, j, lo + iy, lo + ix] = (
+                        probe[t, iy, ix] * tmp / ndet)
+    return np.fft.fft2(nearplane)
+
+
+def test_fwd_matches_kernel():
+    psi, scan, probe = random_problem()
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24) as slv:
+        farplane = slv.fwd(psi, scan, probe[:, 0])
+    assert farplane.dtype == np.complex64
+    np.testing.assert_allclose(farplane,
+                               kernel_fwd(psi, scan, probe[:, 0], 8),
+                               rtol=1e-4, atol=1e-5)
+
+
+def test_adjoint():
+    psi, scan, probe = random_problem()
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24) as slv:
+        t1 = slv.fwd(psi, scan, probe[:, 0])
+        t2 = slv.adj(t1, scan, probe[:, 0])
+        t3 = slv.adj_probe(t1, scan, psi)
+    a = np.sum(t1 * np.conj(t1))
+    b = np.sum(psi * np.conj(t2))
+    c = np.sum(probe[:, 0] * np.conj(t3))
+    np.testing.assert_allclose(a, b, rtol=1e-4)
+    np.testing.assert_allclose(a, c, rtol=1e-4)
+
+
+def test_cg_decreases_cost():
+    psi0, scan, probe = random_problem(ntheta=1, nscan=12)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        result = slv.run_batch(data, psi, scan, probe, piter=4)
+        before = np.linalg.norm(
+            np.abs(slv.fwd(psi, scan, probe[:, 0])) - np.sqrt(data))
+        after = np.linalg.norm(
+            np.abs(slv.fwd(result['psi'], scan, probe[:, 0])) - np.sqrt(data))
+    assert after < before
+
+
+def test_modes_match_single_mode_operators():
+    psi, scan, probe = random_problem(nmodes=3)
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24, nmodes=3) as slv:
+        farplane, intensity = slv.fwd_modes(psi, scan, probe)
+        psi1 = slv.adj_modes(farplane, scan, probe)
+        probe1 = slv.adj_probe_modes(farplane, scan, psi)
+        for k in range(3):
+            np.testing.assert_allclose(farplane[:, k],
+                                       slv.fwd(psi, scan, probe[:, k]),
+                                       rtol=1e-5, atol=1e-6)
+            np.testing.assert_allclose(
+                probe1[:, k], slv.adj_probe(farplane[:, k], scan, psi),
+                rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(
+            intensity, np.sum(np.abs(farplane)**2, axis=1), rtol=1e-5)
+        # the mode by mode accumulation of the base class
+        out = np.empty_like(intensity)
+        assert pt.Ptycho.intensity(slv, farplane, out=out) is out
+        np.testing.assert_allclose(out, intensity, rtol=1e-5)
+        np.testing.assert_allclose(
+            psi1,
+            sum(slv.adj(farplane[:, k], scan, probe[:, k]) for k in range(3)),
+            rtol=1e-4, atol=1e-4)
+
+
+def test_cg_modes_recover_probe():
+    psi0, scan, probe = random_problem(ntheta=1, nscan=12, nmodes=2)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24, nmodes=2) as slv:
+        _, data = slv.fwd_modes(psi0, scan, probe)
+        psi = np.ones_like(psi0)
+        result = slv.run_batch(data, psi, scan, probe, piter=4,
+                               recover_prb=True)
+        before = np.linalg.norm(
+            np.sqrt(slv.fwd_modes(psi, scan, probe)[1]) - np.sqrt(data))
+        after = np.linalg.norm(
+            np.sqrt(slv.fwd_modes(result['psi'], scan, result['probe'])[1]) -
+            np.sqrt(data))
+    assert after < before
+
+
+def test_run_batch_pipeline_matches_serial():
+    psi0, scan, probe = random_problem(ntheta=5, nscan=12)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        serial = slv.run_batch(data, psi, scan, probe, piter=2)
+        for nbuffers in (2, 3):
+            result = slv.run_batch(data, psi, scan, probe, piter=2,
+                                   nbuffers=nbuffers)
+            np.testing.assert_array_equal(result['psi'], serial['psi'])
+            np.testing.assert_array_equal(result['probe'], serial['probe'])
+
+
+def test_batch_uneven_partitions():
+    psi, scan, probe = random_problem(ntheta=5)
+    with pt.PtychoNumPy(7, 6, 8, 1, 20, 24) as slv:
+        farplane = slv.fwd_ptycho_batch(psi, scan, probe[:, 0])
+        adj = slv.adj_ptycho_batch(farplane, scan, probe[:, 0])
+        adj_prb = slv.adj_ptycho_batch_prb(farplane, scan, psi)
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24) as slv:
+        out = np.empty_like(farplane)
+        assert slv.fwd_ptycho_batch(psi, scan, probe[:, 0], out=out) is out
+        np.testing.assert_allclose(out, farplane, rtol=1e-6)
+        np.testing.assert_allclose(
+            slv.adj_ptycho_batch(farplane, scan, probe[:, 0]), adj, rtol=1e-6)
+        np.testing.assert_allclose(
+            slv.adj_ptycho_batch_prb(farplane, scan, psi), adj_prb, rtol=1e-6)
+
+
+def test_run_batch_uneven_partitions():
+    psi0, scan, probe = random_problem(ntheta=3, nscan=12)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        result = slv.run_batch(data, psi, scan, probe, piter=2)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24) as slv:
+        last = slv.run_batch(data[2:], psi[2:], scan[2:], probe[2:], piter=2)
+    np.testing.assert_allclose(result['psi'][2:], last['psi'],
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_parallel_run_batch_matches_serial():
+    psi0, scan, probe = random_problem(ntheta=5, nscan=12)
+    args = (12, 6, 8, 2, 20, 24)
+    with pt.CGPtychoNumPySolver(*args) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        serial = slv.run_batch(data, psi, scan, probe, piter=2)
+    with pt.ParallelPtycho(pt.CGPtychoNumPySolver, args,
+                           devices=[None, None]) as pool:
+        result = pool.run_batch(data, psi, scan, probe, piter=2)
+        # every partition reports its own stop reason
+        stopped = pool.run_batch(data, psi, scan, probe, piter=2, utol=1e9)
+    np.testing.assert_array_equal(result['psi'], serial['psi'])
+    np.testing.assert_array_equal(result['probe'], serial['probe'])
+    assert result['stop'] == serial['stop'] == ['piter'] * 3
+    assert stopped['stop'] == ['utol'] * 3
+    assert len(result['history']) == len(serial['history']) == 3
+    for report, expected in zip(result['history'], serial['history']):
+        assert [h['cost'] for h in report] == [h['cost'] for h in expected]
+
+
+def test_run_batch_out_of_core(tmp_path):
+    psi0, scan, probe = random_problem(ntheta=5, nscan=12)
+
+    class Lazy(object):
+        """An array source which records the slices read from it."""
+
+        def __init__(self, array):
+            self.array = array
+            self.shape = array.shape
+            self.ndim = array.ndim
+            self.reads = []
+
+        def __getitem__(self, key):
+            self.reads.append(key)
+            return self.array[key]
+
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        expected = slv.run_batch(data, psi, scan, probe, piter=2)
+        stored = np.lib.format.open_memmap(
+            tmp_path / 'data.npy', mode='w+', dtype=data.dtype,
+            shape=data.shape)
+        stored[:] = data
+        out = {
+            'psi': np.lib.format.open_memmap(
+                tmp_path / 'psi.npy', mode='w+', dtype=psi.dtype,
+                shape=psi.shape),
+            'probe': np.lib.format.open_memmap(
+                tmp_path / 'probe.npy', mode='w+', dtype=probe.dtype,
+                shape=probe.shape),
+        }
+        lazy = Lazy(stored)
+        result = slv.run_batch(lazy, psi, scan, probe, piter=2, out=out)
+    assert result is out
+    assert lazy.reads == [slice(0, 2), slice(2, 4), slice(4, 5)]
+    np.testing.assert_array_equal(np.load(tmp_path / 'psi.npy'),
+                                  expected['psi'])
+    np.testing.assert_array_equal(np.load(tmp_path / 'probe.npy'),
+                                  expected['probe'])
+
+
+def test_operators_out_and_workspace():
+    psi, scan, probe = random_problem(nmodes=2)
+    with pt.CGPtychoNumPySolver(7, 6, 8, 2, 20, 24, nmodes=2) as slv:
+        slv.fft_chunk = 3
+        farplane, intensity = slv.fwd_modes(psi, scan, probe)
+        out = (np.ones_like(farplane), np.ones_like(intensity))
+        assert slv.fwd_modes(psi, scan, probe, out=out)[0] is out[0]
+        np.testing.assert_allclose(out[0], farplane, rtol=1e-6)
+        np.testing.assert_allclose(out[1], intensity, rtol=1e-6)
+        psi1 = np.ones_like(psi)
+        assert slv.adj_modes(farplane, scan, probe, out=psi1) is psi1
+        np.testing.assert_allclose(psi1, slv.adj_modes(farplane, scan, probe))
+        slv.run(intensity, psi, scan, probe, piter=1)
+        assert slv.workspace.peak >= farplane.nbytes
+    assert slv.workspace.nbytes == 0
+
+
+def test_prepared_scan():
+    psi, scan, probe = random_problem()
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24) as slv:
+        prepared = slv.prepare_scan(scan)
+        assert slv.prepare_scan(prepared) is prepared
+        np.testing.assert_array_equal(prepared.valid[0], [0, 1, 1, 1, 1, 1, 1])
+        farplane = slv.fwd(psi, prepared, probe[:, 0])
+        np.testing.assert_array_equal(farplane,
+                                      slv.fwd(psi, scan, probe[:, 0]))
+        np.testing.assert_array_equal(slv.adj(farplane, prepared, probe[:, 0]),
+                                      slv.adj(farplane, scan, probe[:, 0]))
+
+
+def test_adjoint_batches_match_atomic_accumulation():
+    # a dense raster where many patches overlap
+    psi, _, probe = random_problem(ntheta=2, nscan=64, nz=32, n=32)
+    y, x = np.meshgrid(np.arange(8) * 2.3, np.arange(8) * 2.7, indexing='ij')
+    scan = np.tile(np.stack([y, x], axis=-1).reshape(1, 64, 2),
+                   [2, 1, 1]).astype('float32')
+    scan[1, 5] = -1
+    with pt.PtychoNumPy(64, 6, 8, 2, 32, 32) as slv:
+        prepared = slv.prepare_scan(scan)
+        assert sum(len(b) for b in prepared.batches) == 127
+        for batch in prepared.batches:
+            index = prepared.index.reshape(-1, 36)[batch]
+            assert len(np.unique(index)) == index.size
+        farplane = slv.fwd(psi, scan, probe[:, 0])
+        result = slv.adj(farplane, prepared, probe[:, 0])
+        # accumulate with np.add.at like the atomicAdd of the kernel
+        nearplane = np.fft.ifft2(farplane) * 64
+        patches = np.conj(probe[:, 0, np.newaxis]) * nearplane[:, :, 1:7, 1:7]
+        expected = np.zeros_like(psi)
+        for shift, weight in zip(prepared.shifts, prepared.weights):
+            np.add.at(expected.reshape(-1)[shift:], prepared.index,
+                      weight * patches / 8)
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_run_batch_compact_data():
+    psi0, scan, probe = random_problem(ntheta=3, nscan=12)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24) as slv:
+        data = np.round(
+            1e3 * np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2)
+        psi = np.ones_like(psi0)
+        expected = slv.run_batch(data.astype('float32'), psi, scan, probe,
+                                 piter=2, model='poisson')
+        counts = pt.compact(data)
+        assert counts.dtype == np.uint16
+        compressed = pt.CompressedArray(counts, chunk=2)
+        assert compressed.nbytes < counts.nbytes
+        np.testing.assert_array_equal(compressed[1:3], counts[1:3])
+        for x in (counts, compressed):
+            result = slv.run_batch(x, psi, scan, probe, piter=2,
+                                   model='poisson')
+            np.testing.assert_allclose(result['psi'], expected['psi'],
+                                       rtol=1e-5, atol=1e-5)
+    assert pt.compact(data + 0.5).dtype == data.dtype
+
+
+def test_cg_coarse_to_fine_levels():
+    # a smooth object which is resolved well at coarse levels
+    yy, xx = np.mgrid[:64, :64]
+    psi0 = np.exp(1j * np.sin(yy / 9) * np.cos(xx / 7))[np.newaxis]
+    psi0 = psi0.astype('complex64')
+    y, x = np.meshgrid(np.arange(8) * 6.3, np.arange(8) * 6.1, indexing='ij')
+    scan = np.stack([y, x], axis=-1).reshape(1, 64, 2).astype('float32')
+    py, px = np.mgrid[:12, :12] - 6
+    probe = np.exp(-(py**2 + px**2) / 20)[np.newaxis, np.newaxis]
+    probe = probe.astype('complex64')
+    with pt.CGPtychoNumPySolver(64, 12, 24, 1, 64, 64, workers=1) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+
+        def cost(psi):
+            return np.linalg.norm(
+                np.abs(slv.fwd(psi, scan, probe[:, 0])) - np.sqrt(data))
+
+        psi = np.ones_like(psi0)
+        plain = slv.run_batch(data, psi, scan, probe.copy(), piter=8)
+        reports = []
+        multires = slv.run_batch(data, psi, scan, probe.copy(), piter=8,
+                                 levels=[(4, 32), (2, 16)],
+                                 callback=reports.append)
+    assert cost(multires['psi']) < 0.5 * cost(plain['psi'])
+    # the coarse levels report their iterations too
+    assert [m.get('level') for m in reports] == [4] * 32 + [2] * 16 + [None] * 8
+
+
+def test_cg_metrics_history(capsys):
+    psi0, scan, probe = random_problem(ntheta=3, nscan=12, nmodes=2)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24, nmodes=2) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        seen = []
+        result = slv.run_batch(data, np.ones_like(psi0), scan, probe,
+                               piter=3, recover_prb=True, callback=seen.append)
+    assert capsys.readouterr().out == ''
+    # one history per partition, one record per iteration
+    assert len(result['history']) == 2
+    assert seen == result['history'][0] + result['history'][1]
+    for record in seen:
+        assert record['gradpsi'] > 0 and record['gradprb'] > 0
+        assert record['time'] >= record['fwd'] >= 0
+    costs = [record['cost'] for record in result['history'][0]]
+    assert costs[-1] < costs[0]
+
+
+def test_cg_early_stopping():
+    psi0, scan, probe = random_problem(ntheta=1, nscan=12)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        full = slv.run_batch(data, psi, scan, probe, piter=16)
+        assert full['stop'] == ['piter'] and len(full['history'][0]) == 16
+        for criterion, value in [('rtol', 0.5), ('utol', 1.0),
+                                 ('max_time', 0.0)]:
+            result = slv.run_batch(data, psi, scan, probe, piter=16,
+                                   **{criterion: value})
+            assert result['stop'] == [criterion]
+            assert len(result['history'][0]) < 16
+            # the iterations which were run are the same
+            for a, b in zip(result['history'][0], full['history'][0]):
+                assert a['cost'] == b['cost']
+
+
+def test_line_search_multi_matches_sequential():
+    rng = np.random.default_rng(0)
+    d = rng.random(1000).astype('float32')
+    p1 = rng.random(1000).astype('float32')
+    with pt.CGPtychoNumPySolver(7, 6, 8, 2, 20, 24) as slv:
+        # steps which are accepted after none, a few, and many shrinks, in
+        # blocks and in one block as on the GPU
+        for scale, block in itertools.product((1e-3, 1, 1e3), (300, None)):
+            slv.line_search_block = block
+            p2 = scale * rng.random(1000).astype('float32')
+            p3 = -scale * rng.random(1000).astype('float32')
+            expected = slv.line_search_sqr(
+                lambda x: np.sum((np.sqrt(np.abs(x)) - d)**2), p1, p2, p3)
+            step, cost = slv.line_search_sqr_multi(
+                lambda x, k: np.sum((np.sqrt(np.abs(x)) - d[k])**2, axis=-1),
+                p1, p2, p3, nsteps=4)
+            assert step == expected
+            np.testing.assert_allclose(cost, np.sum((np.sqrt(p1) - d)**2),
+                                       rtol=1e-5)
+
+
+def test_fused_residual_and_custom_noise_model():
+    rng = np.random.default_rng(0)
+    farplane = (rng.random([2, 3, 7, 8, 8]) +
+                1j * rng.random([2, 3, 7, 8, 8])).astype('complex64')
+    intensity = np.sum(np.abs(farplane)**2, axis=1)
+    d = rng.random([2, 7, 8, 8]).astype('float32')
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24, workers=3) as slv:
+        for model in pt.noise_models.values():
+            res, cost = slv.residual(model, farplane, intensity, d, cost=True)
+            expected, expected_cost = pt.Ptycho.residual(
+                slv, model, farplane, intensity, d, cost=True)
+            np.testing.assert_allclose(res, expected, rtol=1e-6)
+            np.testing.assert_allclose(cost, expected_cost, rtol=1e-5)
+            res, cost = slv.residual(model, farplane[:, 0], intensity, d)
+            np.testing.assert_allclose(res, expected[:, 0], rtol=1e-6)
+            assert cost is None
+
+    class Amplitude(pt.Gaussian):
+        """The gaussian model with a name of its own."""
+        name = 'amplitude'
+
+    psi0, scan, probe = random_problem(ntheta=1, nscan=12)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        gaussian = slv.run_batch(data, psi, scan, probe, piter=2)
+        custom = slv.run_batch(data, psi, scan, probe, piter=2,
+                               model=Amplitude())
+    np.testing.assert_array_equal(custom['psi'], gaussian['psi'])
+
+
+def test_minibatch_batches_cover_positions():
+    _, scan, _ = random_problem(ntheta=2, nscan=12)
+    scan[1, 5] = -1
+    with pt.MinibatchPtychoNumPySolver(5, 6, 8, 2, 20, 24) as slv:
+        for order in ['random', 'compact']:
+            batches = slv.batches(scan, order, np.random.default_rng(0))
+            assert all(b.shape == (2, 5) for b in batches)
+            ids = np.stack(batches, axis=1).reshape(2, -1)
+            for t in range(2):
+                valid = np.flatnonzero(np.all(scan[t] >= 0, axis=-1))
+                assert sorted(ids[t][ids[t] >= 0]) == list(valid)
+
+
+def test_minibatch_converges_faster_than_cg():
+    psi0, scan, probe = random_problem(ntheta=1, nscan=12, nmodes=2)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24, nmodes=2) as cg, \
+            pt.MinibatchPtychoNumPySolver(4, 6, 8, 1, 20, 24,
+                                          nmodes=2) as slv:
+        _, data = cg.fwd_modes(psi0, scan, probe)
+        psi = np.ones_like(psi0)
+
+        def misfit(result):
+            _, intensity = cg.fwd_modes(result['psi'], scan, result['probe'])
+            return np.linalg.norm(np.sqrt(intensity) - np.sqrt(data))
+
+        expected = misfit(cg.run_batch(data, psi, scan, probe, piter=4,
+                                       recover_prb=True))
+        for order in ['random', 'compact']:
+            result = slv.run_batch(data, psi, scan, probe, piter=4,
+                                   order=order, recover_prb=True)
+            assert len(result['history'][0]) == 4
+            assert misfit(result) < expected
+
+
+@pytest.mark.parametrize('name', [
+    'MinibatchPtychoNumPySolver',
+    'MinibatchPtychoSolver',
+])
+def test_minibatch_recovers_probe_on_each_engine(name):
+    if not hasattr(pt, name):
+        pytest.skip(f"{name} is not available")
+    psi0, scan, probe = random_problem(ntheta=2, nscan=12, nmodes=2)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24) as cg:
+        _, data = cg.fwd_modes(psi0, scan, probe)
+    with getattr(pt, name)(4, 6, 8, 2, 20, 24, nmodes=2) as slv:
+        result = slv.run_batch(data, np.ones_like(psi0), scan, probe * 0.9,
+                               piter=2, recover_prb=True)
+    assert np.all(np.isfinite(result['probe']))
+    assert not np.array_equal(result['probe'], probe * 0.9)
+
+
+def test_run_batch_crops_to_region_of_interest():
+    psi0, scan, probe = random_problem(ntheta=3, nscan=12, nz=64, n=80)
+    # the positions cover a small part of the grid, at different places
+    scan = scan * 0.3 + np.array([[[5, 9]], [[30, 40]], [[20, 2]]])
+    scan[0, 0] = -1
+    scan = scan.astype('float32')
+    origin, shape = pt.roi(scan, 6, 64, 80)
+    assert shape[0] < 64 and shape[1] < 80
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 64, 80) as slv:
+        data = np.abs(slv.fwd_ptycho_batch(psi0, scan, probe[:, 0]))**2
+        psi = np.ones_like(psi0)
+        full = slv.run_batch(data, psi, scan, probe, piter=3, crop=False)
+        result = slv.run_batch(data, psi, scan, probe, piter=3)
+        # the solver of the crops is reused by the next call
+        cropped = slv._crops[shape]
+        slv.run_batch(data, psi, scan, probe, piter=1)
+        assert slv._crops == {shape: cropped}
+    assert slv._crops == {}
+    np.testing.assert_allclose(
+        [h['cost'] for h in result['history'][0]],
+        [h['cost'] for h in full['history'][0]], rtol=1e-4)
+    np.testing.assert_allclose(
+        [h['update'] for h in result['history'][0]],
+        [h['update'] for h in full['history'][0]], rtol=1e-3)
+    np.testing.assert_allclose(result['psi'], full['psi'], rtol=1e-4,
+                               atol=1e-4)
+    for t, (y, x) in enumerate(origin):
+        outside = np.ones([64, 80], dtype=bool)
+        outside[y:y + shape[0], x:x + shape[1]] = False
+        np.testing.assert_array_equal(result['psi'][t][outside], 1)
+        # an object which is brighter outside of the crops
+        psi[t][outside] = 3
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 64, 80) as slv:
+        full = slv.run_batch(data, psi, scan, probe, piter=3, crop=False,
+                             recover_prb=True)
+        result = slv.run_batch(data, psi, scan, probe, piter=3,
+                               recover_prb=True)
+    np.testing.assert_allclose(result['probe'], full['probe'], rtol=1e-4,
+                               atol=1e-4)
+    np.testing.assert_allclose(result['psi'], full['psi'], rtol=1e-4,
+                               atol=1e-4)
+
+
+def test_modes_do_not_need_nmodes_argument():
+    psi0, scan, probe = random_problem(ntheta=1, nscan=12, nmodes=2)
+    with pt.CGPtychoNumPySolver(12, 6, 8, 1, 20, 24) as slv:
+        _, data = slv.fwd_modes(psi0, scan, probe)
+        result = slv.run_batch(data, np.ones_like(psi0), scan, probe,
+                               piter=2, recover_prb=True)
+    assert result['probe'].shape == probe.shape
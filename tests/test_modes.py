@@ -68,7 +68,8 @@ if __name__ == "__main__":
         else:
             prb = prb_real.copy()
         result = slv.run_batch(
-             data, psi, scan, prb, piter=piter, model=model, recover_prb=recover_prb)
+             data, psi, scan, prb, piter=piter, model=model, recover_prb=recover_prb,
+             verbose=True)
         psi, prb = result['psi'], result['probe']
 
     # save result
@@ -0,0 +1,77 @@
+import numpy as np
+
+import libtike.cufft as pt
+from libtike.cufft import synthetic
+from libtike.cufft.packed import PackedPtycho, pack
+
+
+def ragged_problem():
+    dataset = synthetic.generate(None, ntheta=3, nscan=40, ndet=16, nprb=8,
+                                 nz=40, n=40, noise=None, photons=1e4)
+    scan = dataset['scan']
+    # the angles have 40, 25, and 10 positions
+    scan[1, 25:] = -1
+    scan[2, :30] = -1
+    dataset['data'][np.any(scan < 0, axis=-1)] = 0
+    return dataset, scan
+
+
+def test_pack_and_plan():
+    dataset, scan = ragged_problem()
+    offsets, packed_scan, data = pack(scan, dataset['data'])
+    np.testing.assert_array_equal(offsets, [0, 40, 65, 75])
+    np.testing.assert_array_equal(packed_scan[40:65], scan[1, :25])
+    np.testing.assert_array_equal(data[65:], dataset['data'][2, 30:])
+    with PackedPtycho(pt.CGPtychoNumPySolver, 8, 16, 2, 40, 40,
+                      nscan=50) as packed:
+        nscan, groups = packed.plan(offsets)
+    assert nscan == 50
+    assert groups == [slice(0, 1), slice(1, 3)]
+    # angles with different probes are not grouped
+    probe = dataset['probe'].copy()
+    probe[2] *= 2
+    with PackedPtycho(pt.CGPtychoNumPySolver, 8, 16, 3, 40, 40) as packed:
+        _, groups = packed.plan(offsets, probe)
+    assert groups == [slice(0, 2), slice(2, 3)]
+
+
+def test_packed_matches_padded():
+    dataset, scan = ragged_problem()
+    psi = np.ones_like(dataset['psi'])
+    probe = dataset['probe']
+    with pt.CGPtychoNumPySolver(40, 8, 16, 3, 40, 40) as slv:
+        expected = slv.run_batch(dataset['data'], psi, scan, probe, piter=4)
+    offsets, packed_scan, data = pack(scan, dataset['data'])
+    with PackedPtycho(pt.CGPtychoNumPySolver, 8, 16, 3, 40, 40) as packed:
+        result = packed.run_batch(data, psi, packed_scan, probe, offsets,
+                                  piter=4)
+    # one group of all three angles with 75 instead of 3 * 40 positions
+    assert len(result['history']) == 1
+    np.testing.assert_allclose(
+        [h['cost'] for h in result['history'][0]],
+        [h['cost'] for h in expected['history'][0]], rtol=1e-4)
+    np.testing.assert_allclose(result['psi'], expected['psi'], rtol=1e-3,
+                               atol=1e-3)
+
+
+def test_packed_operators_match_padded():
+    dataset, scan = ragged_problem()
+    psi = dataset['psi']
+    probe = dataset['probe'][:, 0].copy()
+    probe[2] *= 0.5
+    offsets, packed_scan = pack(scan)
+    valid = np.all(scan >= 0, axis=-1)
+    with pt.CGPtychoNumPySolver(40, 8, 16, 3, 40, 40) as slv:
+        farplane = slv.fwd_ptycho_batch(psi, scan, probe)
+        expected_psi = slv.adj_ptycho_batch(farplane, scan, probe)
+        expected_prb = slv.adj_ptycho_batch_prb(farplane, scan, psi)
+    with PackedPtycho(pt.CGPtychoNumPySolver, 8, 16, 2, 40, 40) as packed:
+        result = packed.fwd_ptycho_batch(psi, packed_scan, probe, offsets)
+        np.testing.assert_allclose(result, farplane[valid], rtol=1e-4,
+                                   atol=1e-4)
+        np.testing.assert_allclose(
+            packed.adj_ptycho_batch(result, packed_scan, probe, offsets),
+            expected_psi, rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(
+            packed.adj_ptycho_batch_prb(result, packed_scan, psi, offsets),
+            expected_prb, rtol=1e-3, atol=1e-3)
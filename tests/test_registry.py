@@ -0,0 +1,57 @@
+import numpy as np
+
+import libtike.cufft as pt
+from libtike.cufft.registry import Registry, registry
+
+
+def test_acquire_shares_until_evicted():
+    closed = []
+    cache = Registry(capacity=100)
+    a = cache.acquire('a', object, nbytes=60, close=closed.append)
+    assert cache.acquire('a', object, nbytes=60) is a
+    cache.release('a')
+    cache.release('a')
+    # idle resources are kept while they fit
+    assert 'a' in cache and not closed
+    b = cache.acquire('b', object, nbytes=60, close=closed.append)
+    assert closed == [a] and 'a' not in cache
+    # resources in use are not evicted even above capacity
+    cache.acquire('c', object, nbytes=60, close=closed.append)
+    assert closed == [a] and cache.nbytes == 120
+    cache.release('b')
+    cache.acquire('c', object)
+    assert closed == [a, b]
+
+
+def test_lru_order():
+    closed = []
+    cache = Registry(capacity=30)
+    for key in 'abc':
+        cache.acquire(key, lambda: key, nbytes=10, close=closed.append)
+        cache.release(key)
+    cache.acquire('a', None)
+    cache.release('a')
+    cache.acquire('d', lambda: 'd', nbytes=10, close=closed.append)
+    assert closed == ['b']
+    cache.clear()
+    assert len(cache) == 1 and closed == ['b', 'c', 'a']
+
+
+def test_clear_closes_resources_without_bytes():
+    closed = []
+    cache = Registry(capacity=100)
+    cache.acquire('a', lambda: 'a', nbytes=0, close=closed.append)
+    cache.acquire('b', lambda: 'b', nbytes=0, close=closed.append)
+    cache.release('a')
+    cache.clear()
+    assert closed == ['a'] and 'b' in cache
+
+
+def test_solvers_share_plans():
+    with pt.PtychoNumPy(7, 6, 8, 2, 20, 24, workers=1) as slv:
+        assert registry.entries[slv.key][1] == 1
+        with pt.PtychoNumPy(5, 6, 8, 1, 20, 24, workers=1) as other:
+            assert other.key == slv.key
+            assert registry.entries[slv.key][1] == 2
+        key = slv.key
+    assert registry.entries[key][1] == 0
@@ -0,0 +1,68 @@
+from multiprocessing import AuthenticationError
+
+import numpy as np
+import pytest
+
+import libtike.cufft as pt
+from libtike.cufft import synthetic
+from libtike.cufft.service import (Cancelled, ReconstructionClient,
+                                   ReconstructionServer)
+
+
+def problem():
+    d = synthetic.generate(ntheta=3, nscan=12, ndet=8, nprb=6, nz=20, n=24)
+    return d['data'], np.ones_like(d['psi']), d['scan'], d['probe']
+
+
+def test_service_streams_and_matches_run_batch():
+    data, psi, scan, probe = problem()
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24) as slv:
+        expected = slv.run_batch(data, psi, scan, probe, piter=3)
+    with ReconstructionServer(pt.CGPtychoNumPySolver, ptheta=2) as server, \
+            ReconstructionClient(server.address, server.authkey) as client:
+        for _ in range(2):
+            job = client.submit(data, psi, scan, probe, piter=3)
+            events = list(job.events())
+            result = job.result()
+            np.testing.assert_allclose(result['psi'], expected['psi'],
+                                       rtol=1e-5, atol=1e-6)
+            assert [k for k, v in events].count('metrics') == 2 * 3
+            partial = [v['ids'] for k, v in events
+                       if k == 'partial' and v['name'] == 'psi']
+            assert partial == [(0, 2), (2, 3)]
+        # the second job reused the warm solver of the first
+        assert len(server.solvers) == 1
+
+
+def test_service_cancel_and_error(tmp_path):
+    data, psi, scan, probe = problem()
+    np.save(tmp_path / 'data.npy', data)
+    with ReconstructionServer(pt.CGPtychoNumPySolver) as server, \
+            ReconstructionClient(server.address, server.authkey) as client:
+        job = client.submit(str(tmp_path / 'data.npy'), psi, scan, probe,
+                            piter=10**6)
+        queued = client.submit(data, psi, scan, probe, piter=1)
+        for kind, value in job.events():
+            if kind == 'metrics':
+                job.cancel()
+                queued.cancel()
+        with pytest.raises(Cancelled):
+            job.result()
+        with pytest.raises(Cancelled):
+            queued.result()
+        failed = client.submit(data, psi, scan, probe, piter=1, unknown=1)
+        with pytest.raises(RuntimeError, match='unknown'):
+            failed.result()
+        # the failed solver was freed and the server still works
+        assert len(server.solvers) == 0
+        assert client.submit(data, psi, scan, probe, piter=1).result()
+
+
+def test_service_survives_wrong_authkey():
+    data, psi, scan, probe = problem()
+    with ReconstructionServer(pt.CGPtychoNumPySolver) as server:
+        with pytest.raises(AuthenticationError):
+            ReconstructionClient(server.address, b'wrong')
+        with ReconstructionClient(server.address, server.authkey) as client:
+            assert client.submit(data, psi, scan, probe, piter=1).result()
+    assert not server.threads[0].is_alive()
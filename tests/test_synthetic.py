@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from libtike.cufft import synthetic
+
+SIZES = dict(ntheta=3, nscan=20, ndet=16, nprb=8, nz=32, n=40)
+
+
+def test_generate_is_reproducible_and_streamed(tmp_path):
+    memory = synthetic.generate(None, nmodes=2, ptheta=2, seed=3, **SIZES)
+    stored = synthetic.generate(tmp_path / 'dataset', nmodes=2, ptheta=1,
+                                seed=3, **SIZES)
+    assert isinstance(stored['data'], np.memmap)
+    for name, x in memory.items():
+        np.testing.assert_allclose(stored[name], x, rtol=1e-6)
+    assert memory['data'].shape == (3, 20, 16, 16)
+    assert memory['probe'].shape == (3, 2, 8, 8)
+    other = synthetic.generate(None, nmodes=2, seed=4, **SIZES)
+    assert not np.allclose(other['data'], memory['data'])
+
+
+@pytest.mark.parametrize('trajectory', ['raster', 'spiral', 'fermat'])
+def test_trajectories_fit_in_the_object(trajectory):
+    dataset = synthetic.generate(None, trajectory=trajectory, noise=None,
+                                 **SIZES)
+    scan = dataset['scan']
+    assert scan.min() >= 0
+    assert np.all(scan[..., 0] < 32 - 8 - 1)
+    assert np.all(scan[..., 1] < 40 - 8 - 1)
+    # without noise, each pattern has about as many counts as photons
+    np.testing.assert_allclose(np.sum(dataset['data'], axis=(2, 3)), 1e6,
+                               rtol=0.5)
+
+
+def test_probe_modes_are_orthogonal():
+    probe = synthetic.make_probe(16, nmodes=4, photons=10)
+    gram = np.einsum('ayx,byx->ab', probe, np.conj(probe))
+    np.testing.assert_allclose(np.trace(gram), 10, rtol=1e-5)
+    np.testing.assert_allclose(gram - np.diag(np.diag(gram)), 0, atol=1e-3)
+
+
+def test_poisson_counts():
+    dataset = synthetic.generate(None, dtype='uint16', photons=1e3, **SIZES)
+    assert dataset['data'].dtype == np.uint16
+
+
+def test_hdf5(tmp_path):
+    pytest.importorskip('h5py')
+    dataset = synthetic.generate(tmp_path / 'dataset.h5', **SIZES)
+    assert dataset['data'].shape == (3, 20, 16, 16)
@@ -0,0 +1,44 @@
+import numpy as np
+
+import libtike.cufft as pt
+from libtike.cufft import synthetic
+from libtike.cufft.tiled import TiledPtycho
+
+
+def test_tiles_cover_their_patches():
+    dataset = synthetic.generate(None, ntheta=2, nscan=50, ndet=16, nprb=8,
+                                 nz=64, n=48, noise=None)
+    scan = dataset['scan']
+    with TiledPtycho(pt.CGPtychoNumPySolver, 50, 8, 16, 2, 64, 48,
+                     tiles=(3, 2)) as tiled:
+        members, origin, (wz, wn) = tiled.plan(scan)
+    assert wz < 64 and wn < 48
+    for t in range(2):
+        ids = np.sort(np.concatenate(members[t]))
+        np.testing.assert_array_equal(ids, np.arange(50))
+        for j, ids in enumerate(members[t]):
+            shifted = np.trunc(scan[t, ids]) - origin[t, j]
+            assert np.all(shifted >= 0)
+            assert np.all(shifted[:, 0] + 8 + 1 <= wz)
+            assert np.all(shifted[:, 1] + 8 + 1 <= wn)
+
+
+def test_tiled_converges_like_monolithic():
+    dataset = synthetic.generate(None, ntheta=2, nscan=64, ndet=16, nprb=8,
+                                 nz=48, n=48, noise=None, photons=1e4,
+                                 trajectory='raster')
+    data, scan, probe = dataset['data'], dataset['scan'], dataset['probe']
+    psi = np.ones_like(dataset['psi'])
+    with pt.CGPtychoNumPySolver(64, 8, 16, 2, 48, 48) as slv:
+
+        def cost(psi):
+            _, intensity = slv.fwd_modes(psi, scan, probe)
+            return np.linalg.norm(np.sqrt(intensity) - np.sqrt(data))
+
+        monolithic = slv.run_batch(data, psi, scan, probe, piter=32)
+        with TiledPtycho(pt.CGPtychoNumPySolver, 64, 8, 16, 2, 48, 48,
+                         tiles=(2, 2)) as tiled:
+            result = tiled.run_batch(data, psi, scan, probe, piter=32,
+                                     sync=8)
+        assert cost(result['psi']) < 0.1 * cost(psi)
+        assert cost(result['psi']) < 2 * cost(monolithic['psi'])
@@ -0,0 +1,40 @@
+import json
+
+import numpy as np
+
+import libtike.cufft as pt
+from libtike.cufft import synthetic
+from libtike.cufft.trace import tracer, tracing
+
+
+def test_tracing_exports_nested_spans(tmp_path):
+    d = synthetic.generate(ntheta=3, nscan=12, ndet=8, nprb=6, nz=20, n=24)
+    psi = np.ones_like(d['psi'])
+    with pt.CGPtychoNumPySolver(12, 6, 8, 2, 20, 24) as slv:
+        with tracing(tmp_path / 'trace.json'):
+            slv.run_batch(d['data'], psi, d['scan'], d['probe'], piter=2)
+        # nothing is recorded when tracing is disabled
+        count = len(tracer.events)
+        slv.run_batch(d['data'], psi, d['scan'], d['probe'], piter=1)
+        assert len(tracer.events) == count
+    with open(tmp_path / 'trace.json') as f:
+        events = json.load(f)['traceEvents']
+    names = {e['name'] for e in events}
+    assert {'partition', 'stage', 'drain', 'run', 'fwd_modes', 'adj_modes',
+            'fft', 'ifft', 'residual', 'line_search_sqr_multi', 'fwd', 'adj',
+            'line_search', 'probe'} <= names
+    assert sum(e['name'] == 'partition' for e in events) == 2
+    # the staged objects are cropped to the region of interest
+    _, (nz, n) = pt.roi(d['scan'], 6, 20, 24)
+    stage = next(e for e in events if e['name'] == 'stage')
+    assert stage['args']['shapes'][1] == [2, nz, n]
+    assert stage['args']['bytes'] == (d['data'][:2].nbytes + 2 * nz * n * 8 +
+                                      d['scan'][:2].nbytes +
+                                      d['probe'][:2].nbytes)
+    # the FFTs are nested in the operator spans of the same thread
+    for fft in (e for e in events if e['name'] == 'fft'):
+        assert any(
+            e['name'] == 'fwd_modes' and e['tid'] == fft['tid'] and
+            e['ts'] <= fft['ts'] and
+            fft['ts'] + fft['dur'] <= e['ts'] + e['dur'] + 1e-3
+            for e in events)